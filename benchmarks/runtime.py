@@ -0,0 +1,394 @@
+"""Execution time of code generated by `module_code` against CPython's compiler.
+
+Each program is written twice, as an s-expression and as Python source,
+both defining `run(n)`. The table reports seconds of `run(n)` for each,
+and `ratio`, the time of the s-expression over the time of the Python source.
+
+Ratios are compared with `runtime_baseline.json`, keyed by the Python version,
+and a program is flagged when its ratio exceeds the baseline by `--tolerance`.
+The exit code is 1 if any program is flagged.
+
+    python benchmarks/runtime.py            # compare with the baseline
+    python benchmarks/runtime.py --save     # record the baseline of this Python
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+from py_sexpr.terms import *
+from py_sexpr.stack_vm.emit import module_code, SWITCH_LEAF_SIZE
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runtime_baseline.json")
+
+
+def _run(*stmts):
+    return define("run", ["n"], block(*stmts))
+
+
+def _incr(n: str, value):
+    return aug_assign(n, BinOp.ADD, value)
+
+
+def while_sum():
+    return _run(
+        assign_star("i", 0),
+        assign_star("s", 0),
+        loop(cmp(var("i"), Compare.LT, var("n")), block(_incr("s", var("i")), _incr("i", 1))),
+        var("s"),
+    )
+
+
+WHILE_SUM = """
+def run(n):
+    i = 0
+    s = 0
+    while i < n:
+        s += i
+        i += 1
+    return s
+"""
+
+
+def for_range_sum():
+    return _run(
+        assign_star("i", 0),
+        assign_star("s", 0),
+        for_range("i", 0, var("n"), _incr("s", var("i"))),
+        var("s"),
+    )
+
+
+FOR_RANGE_SUM = """
+def run(n):
+    s = 0
+    for i in range(0, n):
+        s += i
+    return s
+"""
+
+
+def closures():
+    return _run(
+        assign_star("i", 0),
+        assign_star("f", None),
+        assign_star("s", 0),
+        for_range(
+            "i",
+            0,
+            var("n"),
+            block(
+                assign("f", define(None, ["x"], binop(var("x"), BinOp.ADD, var("i")))),
+                _incr("s", call(var("f"), 1)),
+            ),
+        ),
+        var("s"),
+    )
+
+
+CLOSURES = """
+def run(n):
+    s = 0
+    for i in range(0, n):
+        f = lambda x: x + i
+        s += f(1)
+    return s
+"""
+
+
+def records():
+    return block(
+        define(
+            "Point",
+            ["x", "y", "this"],
+            block(
+                set_item(var("this"), "x", var("x")),
+                set_item(var("this"), "y", var("y")),
+                var("this"),
+            ),
+        ),
+        _run(
+            assign_star("i", 0),
+            assign_star("p", None),
+            assign_star("s", 0),
+            for_range(
+                "i",
+                0,
+                var("n"),
+                block(
+                    assign("p", new(var("Point"), var("i"), 1)),
+                    ite(isa(var("p"), var("Point")), _incr("s", get_item(var("p"), "x")), None),
+                ),
+            ),
+            var("s"),
+        ),
+    )
+
+
+RECORDS = """
+def Point(x, y, this):
+    this["x"] = x
+    this["y"] = y
+    return this
+
+def run(n):
+    s = 0
+    for i in range(0, n):
+        p = Point(i, 1, {})
+        p[".t"] = Point
+        if p.get(".t") is Point:
+            s += p["x"]
+    return s
+"""
+
+
+def ite_tree():
+    # a chain of 8 `ite`s classifying `i % 8`
+    term = 0
+    for k in reversed(range(8)):
+        term = ite(cmp(var("k"), Compare.EQ, k), k * 10, term)
+    return _run(
+        assign_star("i", 0),
+        assign_star("k", 0),
+        assign_star("s", 0),
+        for_range(
+            "i",
+            0,
+            var("n"),
+            block(assign("k", binop(var("i"), BinOp.MODULO, 8)), _incr("s", term)),
+        ),
+        var("s"),
+    )
+
+
+ITE_TREE = """
+def run(n):
+    s = 0
+    for i in range(0, n):
+        k = i % 8
+        s += (0 if k == 0 else 10 if k == 1 else 20 if k == 2 else 30 if k == 3 else
+              40 if k == 4 else 50 if k == 5 else 60 if k == 6 else 70 if k == 7 else 0)
+    return s
+"""
+
+
+def lens_merge():
+    return _run(
+        assign_star("i", 0),
+        assign_star("base", record(a=1, b=2)),
+        assign_star("r", None),
+        for_range("i", 0, var("n"), assign("r", lens(var("base"), record(k=var("i"))))),
+        var("r"),
+    )
+
+
+LENS_MERGE = """
+def run(n):
+    base = {"a": 1, "b": 2}
+    r = None
+    for i in range(0, n):
+        r = {**base, **{"k": i}}
+    return r
+"""
+
+
+def switch_dispatch():
+    return _run(
+        assign_star("i", 0),
+        assign_star("s", 0),
+        for_range(
+            "i",
+            0,
+            var("n"),
+            _incr(
+                "s",
+                switch(binop(var("i"), BinOp.MODULO, 16), [(k, k * 3) for k in range(16)], 0),
+            ),
+        ),
+        var("s"),
+    )
+
+
+def _search_source(keys: list, indent: str) -> str:
+    """Python source of the binary search `switch` compiles to,
+    so that the ratio compares code generation rather than algorithms.
+    """
+    if len(keys) <= SWITCH_LEAF_SIZE:
+        return "".join(
+            "{}{} k == {}:\n{}    s += {}\n".format(indent, "elif" if i else "if", k, indent, k * 3)
+            for i, k in enumerate(keys)
+        )
+    mid = len(keys) // 2
+    return "{}if k < {}:\n{}{}else:\n{}".format(
+        indent,
+        keys[mid],
+        _search_source(keys[:mid], indent + "    "),
+        indent,
+        _search_source(keys[mid:], indent + "    "),
+    )
+
+
+SWITCH_DISPATCH = (
+    """
+def run(n):
+    s = 0
+    for i in range(0, n):
+        k = i % 16
+"""
+    + _search_source(list(range(16)), "        ")
+    + """
+    return s
+"""
+)
+
+
+def comprehension():
+    return _run(
+        assign_star("x", 0),
+        list_comp(
+            "x",
+            call(var("range"), var("n")),
+            binop(var("x"), BinOp.MULTIPLY, var("x")),
+            cmp(binop(var("x"), BinOp.MODULO, 3), Compare.EQ, 0),
+        ),
+    )
+
+
+COMPREHENSION = """
+def run(n):
+    return [x * x for x in range(n) if x % 3 == 0]
+"""
+
+
+def method_calls():
+    return _run(
+        assign_star("i", 0),
+        assign_star("xs", call(var("list"))),
+        for_range("i", 0, var("n"), call_method(var("xs"), "append", var("i"))),
+        call(var("len"), var("xs")),
+    )
+
+
+METHOD_CALLS = """
+def run(n):
+    xs = list()
+    for i in range(0, n):
+        xs.append(i)
+    return len(xs)
+"""
+
+PROGRAMS = [
+    ("while_sum", while_sum, WHILE_SUM),
+    ("for_range_sum", for_range_sum, FOR_RANGE_SUM),
+    ("closures", closures, CLOSURES),
+    ("records", records, RECORDS),
+    ("ite_tree", ite_tree, ITE_TREE),
+    ("lens_merge", lens_merge, LENS_MERGE),
+    ("switch_dispatch", switch_dispatch, SWITCH_DISPATCH),
+    ("comprehension", comprehension, COMPREHENSION),
+    ("method_calls", method_calls, METHOD_CALLS),
+]
+
+
+def version_key() -> str:
+    return "{}.{}".format(*sys.version_info[:2])
+
+
+def load_run(code):
+    scope = {}
+    exec(code, scope)
+    return scope["run"]
+
+
+def measure(runs: list, n: int, number: int, repeat: int) -> list:
+    """Best seconds per call of each function.
+    Rounds of the functions are interleaved, so that they see the same machine noise.
+    """
+    best = [float("inf")] * len(runs)
+    for _ in range(repeat):
+        for i, run in enumerate(runs):
+            elapsed = timeit.timeit(lambda: run(n), number=number) / number
+            best[i] = min(best[i], elapsed)
+    return best
+
+
+def bench(n: int = 10000, number: int = 10, repeat: int = 15) -> dict:
+    results = {}
+    for name, make_sexpr, source in PROGRAMS:
+        run_sexpr = load_run(module_code(make_sexpr(), filename="<sexpr:{}>".format(name)))
+        run_python = load_run(compile(source, "<python:{}>".format(name), "exec"))
+        expected = run_python(n)
+        actual = run_sexpr(n)
+        if actual != expected:
+            raise AssertionError("{}: {!r} != {!r}".format(name, actual, expected))
+        sexpr_time, python_time = measure([run_sexpr, run_python], n, number, repeat)
+        results[name] = {
+            "sexpr": sexpr_time,
+            "python": python_time,
+            "ratio": sexpr_time / python_time,
+        }
+    return results
+
+
+def flag_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Names of programs whose ratio exceeds the baseline ratio by `tolerance`."""
+    flagged = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is not None and result["ratio"] > expected * (1 + tolerance):
+            flagged.append(name)
+    return flagged
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=10000, help="argument of each run(n)")
+    parser.add_argument("--number", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=15)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="record ratios as the baseline")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args(argv)
+
+    results = bench(args.n, args.number, args.repeat)
+    try:
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+    baseline = baselines.get(version_key(), {})
+    flagged = flag_regressions(results, baseline, args.tolerance)
+
+    if args.json:
+        print(json.dumps({"python": version_key(), "results": results, "flagged": flagged}, indent=2))
+    else:
+        print(
+            "{:<16} {:>10} {:>10} {:>7} {:>9}".format("program", "sexpr", "python", "ratio", "baseline")
+        )
+        for name, result in results.items():
+            expected = baseline.get(name)
+            print(
+                "{:<16} {:>10.6f} {:>10.6f} {:>7.3f} {:>9} {}".format(
+                    name,
+                    result["sexpr"],
+                    result["python"],
+                    result["ratio"],
+                    "-" if expected is None else "{:.3f}".format(expected),
+                    "REGRESSION" if name in flagged else "",
+                )
+            )
+
+    if args.save:
+        baselines[version_key()] = {
+            name: round(result["ratio"], 3) for name, result in results.items()
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+    return 1 if flagged else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Dispatch costs of `switch` against a chain of `ite`s.
+
+Run `python benchmarks/switch.py`, which prints nanoseconds per dispatch
+of each lowering over int and str keys of growing case counts.
+The strategy of `switch` is forced by patching its thresholds.
+"""
+import random
+import timeit
+from py_sexpr.terms import *
+from py_sexpr.stack_vm import emit
+from py_sexpr.stack_vm.emit import module_code
+
+SIZES = (2, 4, 8, 16, 32, 64, 256, 2048)
+STRATEGIES = {
+    "chain": dict(SWITCH_CHAIN_MAX=1 << 30),
+    "tree": dict(SWITCH_CHAIN_MAX=0, SWITCH_TREE_MAX=1 << 30),
+    "table": dict(SWITCH_CHAIN_MAX=0, SWITCH_TREE_MAX=0),
+    "auto": {},
+}
+
+
+def ite_chain(keys):
+    term = "default"
+    for key in reversed(keys):
+        term = ite(cmp(var("x"), Compare.EQ, key), key, term)
+    return define("f", ["x"], term)
+
+
+def switch_of(keys):
+    return define("f", ["x"], switch(var("x"), [(key, key) for key in keys], "default"))
+
+
+def compile_with(term, **thresholds):
+    saved = {name: getattr(emit, name) for name in thresholds}
+    try:
+        for name, value in thresholds.items():
+            setattr(emit, name, value)
+        return eval(module_code(term), {})
+    finally:
+        for name, value in saved.items():
+            setattr(emit, name, value)
+
+
+def measure(f, probes, number=20):
+    def run():
+        for each in probes:
+            f(each)
+
+    return min(timeit.repeat(run, number=number, repeat=5)) / number / len(probes) * 1e9
+
+
+def main():
+    rng = random.Random(42)
+    print("{:<5} {:>5} {:>10}".format("keys", "cases", "ite") + "".join(
+        "{:>10}".format(name) for name in STRATEGIES
+    ))
+    for kind in ("int", "str"):
+        for n in SIZES:
+            keys = list(range(n)) if kind == "int" else ["k{}".format(i) for i in range(n)]
+            probes = [rng.choice(keys) for _ in range(2000)]
+            row = [measure(compile_with(ite_chain(keys)), probes)]
+            for name, thresholds in STRATEGIES.items():
+                if name == "tree" and kind == "str":
+                    row.append(float("nan"))
+                    continue
+                row.append(measure(compile_with(switch_of(keys), **thresholds), probes))
+            print("{:<5} {:>5}".format(kind, n) + "".join("{:>10.1f}".format(t) for t in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Elementwise `for_range` loops before and after `py_sexpr.opt.vectorize`.
+
+Run `python benchmarks/vectorize.py`, which prints microseconds per call
+of each program over NumPy arrays of growing sizes, for the scalar loop,
+the vectorized loop, and the vectorized loop given lists,
+where the guard falls back to the scalar loop.
+Loops shorter than `min_size` of `vectorize` also fall back.
+NumPy is required.
+"""
+import sys
+import timeit
+from py_sexpr.terms import *
+from py_sexpr.stack_vm.emit import module_code
+from py_sexpr.opt import vectorize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIZES = (4, 16, 32, 64, 1024, 16384)
+
+
+def item(n: str):
+    return get_item(var(n), var("i"))
+
+
+def elementwise(*stores):
+    return define(
+        "run",
+        ["out", "a", "b", "n"],
+        block(assign_star("i", 0), for_range("i", 0, var("n"), block(*stores))),
+    )
+
+
+def axpy():
+    a_k = binop(item("a"), BinOp.MULTIPLY, 2.5)
+    return elementwise(set_item(var("out"), var("i"), binop(a_k, BinOp.ADD, item("b"))))
+
+
+def clip():
+    below = cmp(item("a"), Compare.LT, item("b"))
+    return elementwise(set_item(var("out"), var("i"), ite(below, item("b"), item("a"))))
+
+
+def two_stores():
+    return elementwise(
+        set_item(var("out"), var("i"), binop(item("a"), BinOp.SUBTRACT, item("b"))),
+        set_item(var("out"), var("i"), binop(item("out"), BinOp.MULTIPLY, item("out"))),
+    )
+
+
+PROGRAMS = [("axpy", axpy), ("clip", clip), ("two_stores", two_stores)]
+
+
+def load_run(term):
+    return eval(module_code(block(term, var("run"))), {})
+
+
+def measure(f, args, number: int) -> float:
+    return min(timeit.repeat(lambda: f(*args), number=number, repeat=5)) / number * 1e6
+
+
+def main() -> int:
+    if numpy is None:
+        print("NumPy is required")
+        return 1
+    print(
+        "{:<11} {:>6} {:>12} {:>12} {:>9} {:>12}".format(
+            "program", "size", "scalar", "vectorized", "speedup", "fallback"
+        )
+    )
+    for name, make in PROGRAMS:
+        term = make()
+        scalar = load_run(term)
+        vectorized = load_run(vectorize(term))
+        for n in SIZES:
+            a = numpy.linspace(-1.0, 1.0, n)
+            b = numpy.cos(a)
+            out1, out2 = numpy.zeros(n), numpy.zeros(n)
+            scalar(out1, a, b, n)
+            vectorized(out2, a, b, n)
+            if not numpy.allclose(out1, out2):
+                raise AssertionError(name)
+            number = max(1, 20000 // n)
+            scalar_time = measure(scalar, (out1, a, b, n), number)
+            vector_time = measure(vectorized, (out2, a, b, n), number)
+            lists = (out1.tolist(), a.tolist(), b.tolist(), n)
+            fallback_time = measure(vectorized, lists, number)
+            print(
+                "{:<11} {:>6} {:>12.2f} {:>12.2f} {:>8.1f}x {:>12.2f}".format(
+                    name, n, scalar_time, vector_time, scalar_time / vector_time, fallback_time
+                )
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
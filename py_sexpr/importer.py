@@ -0,0 +1,230 @@
+"""Import serialized s-expressions as ordinary Python modules.
+
+A file `foo.sexpr` on `sys.path` holds an `SExpr` encoded by `py_sexpr.serialize`,
+or a pickled one.
+After `install()`, `import foo` compiles the term with `module_code`
+and caches the resulting code object in `__pycache__/foo.<tag>.opt-sexpr.pyc`,
+so that later imports load the bytecode directly without compiling.
+
+On Python 3.7+ the cache is a checked hash-based `.pyc`(PEP 552),
+otherwise a timestamp-based one is written.
+The header is followed by `COMPILER_VERSION`,
+so caches written by another version of py_sexpr are recompiled.
+
+Use `python -m py_sexpr.importer <dir-or-file>...` to precompile files in bulk.
+"""
+import os
+import sys
+import marshal
+import pickle
+from importlib.abc import MetaPathFinder
+from importlib.machinery import SourceFileLoader
+from importlib.util import MAGIC_NUMBER, cache_from_source, spec_from_file_location
+from py_sexpr.stack_vm.emit import module_code, COMPILER_VERSION
+from py_sexpr import serialize
+
+try:
+    from importlib.util import source_hash
+except ImportError:  # Python 3.6-
+    source_hash = None
+
+__all__ = [
+    "SUFFIX",
+    "SExprFinder",
+    "SExprLoader",
+    "install",
+    "uninstall",
+    "dumps",
+    "loads",
+    "compile_file",
+    "compile_dir",
+    "main",
+]
+
+SUFFIX = ".sexpr"
+CACHE_OPTIMIZATION = "sexpr"
+
+# flags of hash-based pycs, see PEP 552
+_FLAG_HASH_BASED = 0b01
+_FLAG_CHECK_SOURCE = 0b10
+
+
+def dumps(term) -> bytes:
+    """Serialize an s-expression into the content of a `.sexpr` file."""
+    return serialize.dumps(term)
+
+
+def loads(data: bytes):
+    """Deserialize the content of a `.sexpr` file."""
+    if data.startswith(serialize.MAGIC):
+        return serialize.loads(data)
+    return pickle.loads(data)
+
+
+def cache_path(path: str) -> str:
+    """The `.pyc` path of a `.sexpr` file.
+    The optimization tag avoids clashing with a sibling `.py` file.
+    """
+    return cache_from_source(path, optimization=CACHE_OPTIMIZATION)
+
+
+def _pyc_header(source: bytes, mtime: float) -> bytes:
+    version = COMPILER_VERSION.to_bytes(4, "little")
+    if source_hash is not None:
+        flags = _FLAG_HASH_BASED | _FLAG_CHECK_SOURCE
+        return MAGIC_NUMBER + flags.to_bytes(4, "little") + source_hash(source) + version
+    return (
+        MAGIC_NUMBER
+        + (int(mtime) & 0xFFFFFFFF).to_bytes(4, "little")
+        + (len(source) & 0xFFFFFFFF).to_bytes(4, "little")
+        + version
+    )
+
+
+def _header_size():
+    return 20 if source_hash is not None else 16
+
+
+def _code_to_pyc(code, source: bytes, mtime: float) -> bytes:
+    return _pyc_header(source, mtime) + marshal.dumps(code)
+
+
+def _pyc_to_code(data: bytes, source: bytes, mtime: float):
+    """Return the cached code object, or `None` if the cache is stale."""
+    size = _header_size()
+    if data[:size] != _pyc_header(source, mtime):
+        return None
+    return marshal.loads(memoryview(data)[size:])
+
+
+class SExprLoader(SourceFileLoader):
+    """Loader of `.sexpr` files, compiling them with `module_code`."""
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        return module_code(loads(data), name="<module>", filename=path)
+
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        source = self.get_data(path)
+        mtime = self.path_stats(path)["mtime"]
+        bytecode_path = cache_path(path)
+        try:
+            data = self.get_data(bytecode_path)
+        except OSError:
+            pass
+        else:
+            code = _pyc_to_code(data, source, mtime)
+            if code is not None:
+                return code
+
+        code = self.source_to_code(source, path)
+        if not sys.dont_write_bytecode:
+            try:
+                self.set_data(bytecode_path, _code_to_pyc(code, source, mtime))
+            except (NotImplementedError, OSError):
+                pass
+        return code
+
+
+class SExprFinder(MetaPathFinder):
+    """Find `<module name>.sexpr` in the search path.
+    Packages are not supported.
+    """
+
+    @classmethod
+    def find_spec(cls, fullname, path=None, target=None):
+        tail = fullname.rpartition(".")[2]
+        for entry in sys.path if path is None else path:
+            if not isinstance(entry, str):
+                continue
+            filename = os.path.join(entry or os.curdir, tail + SUFFIX)
+            if os.path.isfile(filename):
+                loader = SExprLoader(fullname, filename)
+                spec = spec_from_file_location(fullname, filename, loader=loader)
+                spec.cached = cache_path(filename)
+                return spec
+        return None
+
+    @classmethod
+    def invalidate_caches(cls):
+        pass
+
+
+def install():
+    """Enable importing `.sexpr` files.
+    The finder has lower priority than the builtin ones.
+    """
+    if SExprFinder not in sys.meta_path:
+        sys.meta_path.append(SExprFinder)
+
+
+def uninstall():
+    if SExprFinder in sys.meta_path:
+        sys.meta_path.remove(SExprFinder)
+
+
+def compile_file(path: str, force: bool = False, quiet: bool = False) -> bool:
+    """Write the `.pyc` cache of a `.sexpr` file.
+    Return `False` if compilation failed.
+    """
+    loader = SExprLoader(os.path.basename(path)[: -len(SUFFIX)], path)
+    with open(path, "rb") as f:
+        source = f.read()
+    mtime = os.stat(path).st_mtime
+    bytecode_path = cache_path(path)
+    if not force:
+        try:
+            with open(bytecode_path, "rb") as f:
+                if _pyc_to_code(f.read(), source, mtime) is not None:
+                    return True
+        except (OSError, ValueError, EOFError):
+            pass
+    if not quiet:
+        print("Compiling {!r}...".format(path))
+    try:
+        code = loader.source_to_code(source, path)
+    except Exception as e:
+        print("*** Error compiling {!r}: {}: {}".format(path, type(e).__name__, e))
+        return False
+    loader.set_data(bytecode_path, _code_to_pyc(code, source, mtime))
+    return True
+
+
+def compile_dir(directory: str, force: bool = False, quiet: bool = False) -> bool:
+    """Recursively compile all `.sexpr` files under `directory`.
+    Return `False` if any of them failed.
+    """
+    success = True
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for filename in sorted(files):
+            if filename.endswith(SUFFIX):
+                path = os.path.join(root, filename)
+                success = compile_file(path, force, quiet) and success
+    return success
+
+
+def main(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="python -m py_sexpr.importer",
+        description="Precompile {} files into .pyc caches.".format(SUFFIX),
+    )
+    parser.add_argument("paths", nargs="+", help="directories or files")
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="recompile even if up-to-date"
+    )
+    parser.add_argument("-q", "--quiet", action="store_true", help="list nothing")
+    args = parser.parse_args(argv)
+    success = True
+    for path in args.paths:
+        if os.path.isdir(path):
+            success = compile_dir(path, args.force, args.quiet) and success
+        else:
+            success = compile_file(path, args.force, args.quiet) and success
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
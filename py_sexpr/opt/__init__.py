@@ -0,0 +1,7 @@
+"""Optional passes rewriting s-expressions before compiling them."""
+from py_sexpr.opt.purity import Purity
+from py_sexpr.opt.cse import cse
+from py_sexpr.opt.licm import licm
+from py_sexpr.opt.vectorize import vectorize
+
+__all__ = ["Purity", "cse", "licm", "vectorize"]
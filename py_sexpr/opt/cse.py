@@ -0,0 +1,185 @@
+"""Common-subexpression elimination of attribute and item chains.
+
+Generated code often repeats chains like `get_attr(get_attr(var("ctx"), "env"), "x")`
+inside one `block`, each of which loads every attribute again.
+Given names of variables assumed pure in any scope, i.e., reading chains rooted at them neither has
+side effects nor fails, and gives the same value until a write to the variable,
+`cse` computes the chains used more than once into hidden locals.
+
+```python
+    main = cse(main, bases=["ctx"])
+```
+
+A write is an `assign`, `set_attr`, `set_item` or other term rebinding the variable,
+or storing into a chain rooted at it, see `py_sexpr.opt.walk.writes`.
+Writes through aliases, or by functions defined elsewhere, break the assumption.
+"""
+from typing import Dict, Iterable, List, Set
+from py_sexpr.serialize import TermView, materialize
+from py_sexpr.opt.walk import subterms, map_subterms, contains, writes, root_var
+
+__all__ = ["cse", "CSE_PREFIX"]
+
+# prefix of hidden locals, which cannot be written in Python
+CSE_PREFIX = ".cse"
+
+_KEY_TYPES = (str, int, float, bool, type(None))
+
+
+def _is_chain(term, bases: Set[str]) -> bool:
+    if not isinstance(term, tuple):
+        return False
+    hd = term[0]
+    if hd == "get_item":
+        if not isinstance(term[2], _KEY_TYPES):
+            return False
+    elif hd != "get_attr":
+        return False
+    base = term[1]
+    if isinstance(base, tuple) and base[0] == "var":
+        return base[1] in bases
+    return _is_chain(base, bases)
+
+
+def _depth(chain) -> int:
+    n = 0
+    while chain[0] != "var":
+        chain = chain[1]
+        n += 1
+    return n
+
+
+def _occurrences(term, bases: Set[str], always: bool, out: list):
+    """Append each chain in `term` with if it's always evaluated."""
+    if not isinstance(term, tuple):
+        return
+    if _is_chain(term, bases):
+        out.append((term, always))
+    for sub, sub_always in subterms(term):
+        _occurrences(sub, bases, always and sub_always, out)
+
+
+def _replace(term, chain, n: str):
+    if term == chain:
+        return ("var", n)
+    if not isinstance(term, tuple):
+        return term
+    return map_subterms(term, lambda sub, _: _replace(sub, chain, n))
+
+
+class _CSE:
+    def __init__(self, bases: Set[str], min_uses: int):
+        self.bases = bases
+        self.min_uses = min_uses
+        self.n_locals = 0
+
+    def new_local(self) -> str:
+        n = "{}{}".format(CSE_PREFIX, self.n_locals)
+        self.n_locals += 1
+        return n
+
+    def term(self, term):
+        if not isinstance(term, tuple):
+            return term
+        hd = term[0]
+        if hd == "func":
+            return self.func(term)
+        if hd == "block":
+            return self.block(term)
+        return map_subterms(term, lambda sub, _: self.term(sub))
+
+    def func(self, term):
+        # each function body has its own hidden locals
+        return term[:2] + (self.term(term[2]),) + term[3:]
+
+    def block(self, term):
+        stmts = list(term[1:])
+        bases = set(self.bases)
+        # jumps to labels may skip the definitions
+        if bases and not contains(term, ("label",)):
+            # functions defined here may write the bases when called
+            for each in _funcs(stmts):
+                bases.difference_update(writes(each))
+            if bases:
+                stmts = self.eliminate(stmts, bases)
+        return ("block",) + tuple(self.term(each) for each in stmts)
+
+    def eliminate(self, stmts: list, bases: Set[str]) -> list:
+        names = {}  # type: Dict[tuple, str]
+        while True:
+            found = self.select(stmts, bases)
+            if found is None:
+                return stmts
+            chain, segments = found
+            n = names.get(chain)
+            if n is None:
+                n = names[chain] = self.new_local()
+            # later segments first, keeping the indices of the earlier ones
+            for start, end in reversed(segments):
+                for i in range(start, end):
+                    stmts[i] = _replace(stmts[i], chain, n)
+                stmts.insert(start, ("assign_star", n, chain))
+
+    def select(self, stmts: list, bases: Set[str]):
+        """The deepest chain used at least `min_uses` times in segments without writes,
+        and the ranges of statements to share it.
+        """
+        stmt_writes = [writes(each) & bases for each in stmts]
+        stmt_chains = []
+        for each in stmts:
+            out = []  # type: list
+            _occurrences(each, bases, True, out)
+            stmt_chains.append(out)
+
+        candidates = []  # type: List[tuple]
+        seen = set()  # type: Set[tuple]
+        for chains in stmt_chains:
+            for chain, _ in chains:
+                if chain not in seen:
+                    seen.add(chain)
+                    candidates.append(chain)
+        candidates.sort(key=_depth, reverse=True)
+
+        for chain in candidates:
+            root = root_var(chain)
+            segments = []
+            start = None
+            uses = 0
+            for i, chains in enumerate(stmt_chains + [None]):
+                if chains is None or root in stmt_writes[i]:
+                    if start is not None and uses >= self.min_uses:
+                        segments.append((start, i))
+                    start = None
+                    uses = 0
+                    continue
+                if start is None and (chain, True) in chains:
+                    # the first statement sure to evaluate the chain
+                    start = i
+                if start is not None:
+                    uses += sum(1 for each, _ in chains if each == chain)
+            if segments:
+                return chain, segments
+        return None
+
+
+def _funcs(stmts: Iterable) -> list:
+    result = []
+    stack = list(stmts)
+    while stack:
+        term = stack.pop()
+        if not isinstance(term, tuple):
+            continue
+        if term[0] == "func":
+            result.append(term)
+            continue
+        stack.extend(sub for sub, _ in subterms(term))
+    return result
+
+
+def cse(sexpr, bases: Iterable[str], min_uses: int = 2):
+    """Compute chains rooted at `bases` used `min_uses` times or more once per `block`."""
+    if min_uses < 2:
+        raise ValueError("min_uses must be at least 2")
+    if isinstance(sexpr, TermView):
+        sexpr = materialize(sexpr)
+    return _CSE(set(bases), min_uses).term(sexpr)
@@ -0,0 +1,189 @@
+"""Loop-invariant code motion.
+
+`licm` moves the subterms of `loop` and `for_in` giving the same value
+in each iteration into hidden locals assigned before the loop.
+
+```python
+    main = licm(main, Purity(bases=["ctx"], functions=["len"]))
+```
+
+A subterm is invariant if it's pure in the `Purity` model,
+and reads no variable the loop writes.
+Variables other than the fast locals from `ScopeSolver`, i.e., globals and cells,
+as well as calls of `Purity.functions`,
+are only invariant if the loop has no `EFFECTS`, which may change them.
+Iterators of `for_in` other than a `range` call may run any code in each iteration.
+
+Only subterms evaluated in each iteration are moved.
+They get evaluated even if the loop runs no iteration, hence none may fail:
+attributes and items are only moved if rooted at `Purity.bases`,
+and `FAILING_BINOPS` like divisions only if `Purity.failing_operators`.
+The iterable of `for_in` is still evaluated before them.
+"""
+from typing import Dict, List, Set
+from py_sexpr.serialize import TermView, materialize
+from py_sexpr.stack_vm.emit import ScopeSolver, SymType
+from py_sexpr.opt.walk import subterms, map_subterms, contains, bound_names, root_var, writes
+from py_sexpr.opt.purity import Purity
+
+__all__ = ["licm", "LICM_PREFIX"]
+
+# prefix of hidden locals, which cannot be written in Python
+LICM_PREFIX = ".licm"
+
+_REQUIRES = ("assign", "aug_assign", "for_in", "async_for_in", "list_comp", "set_comp", "dict_comp")
+
+
+def _solve(term, sc: ScopeSolver, scopes: Dict[int, ScopeSolver]):
+    """Enter and require symbols like `Builder`, recording the scope of each `func`."""
+    if not isinstance(term, tuple):
+        return
+    hd = term[0]
+    if hd == "var":
+        sc.require(term[1])
+    elif hd == "assign_star":
+        for n in bound_names(term[1]):
+            sc.enter(n)
+    elif hd in _REQUIRES:
+        for n in bound_names(term[1]):
+            sc.require(n)
+    elif hd == "func":
+        args, body, name, defaults = term[1:5]
+        if name:
+            sc.enter(name)
+        for each in defaults:
+            _solve(each, sc, scopes)
+        sub = sc.sub_scope()
+        for n in args:
+            sub.enter(n)
+        scopes[id(term)] = sub
+        _solve(body, sub, scopes)
+        return
+    for sub, _ in subterms(term):
+        _solve(sub, sc, scopes)
+
+
+def _is_range(term) -> bool:
+    if not (isinstance(term, tuple) and term[0] == "call"):
+        return False
+    f = term[1]
+    return isinstance(f, tuple) and f[0] == "var" and f[1] == "range"
+
+
+class _LICM:
+    def __init__(self, purity: Purity, scopes: Dict[int, ScopeSolver], scope: ScopeSolver):
+        self.purity = purity
+        self.scopes = scopes
+        self.scope = scope
+        self.n_locals = 0
+
+    def new_local(self) -> str:
+        n = "{}{}".format(LICM_PREFIX, self.n_locals)
+        self.n_locals += 1
+        return n
+
+    def is_fast(self, n: str) -> bool:
+        scope = self.scope
+        if scope.parent is None:
+            return False
+        if n.startswith(LICM_PREFIX):
+            return True
+        sym = scope.output.syms_bound.get(n)
+        return sym is not None and sym.ty is SymType.bound
+
+    def term(self, term):
+        if not isinstance(term, tuple):
+            return term
+        hd = term[0]
+        if hd == "func":
+            scope = self.scope
+            self.scope = self.scopes[id(term)]
+            try:
+                body = self.term(term[2])
+            finally:
+                self.scope = scope
+            return term[:2] + (body,) + term[3:]
+        # inner loops first, whose hoisted terms may move further
+        term = map_subterms(term, lambda sub, _: self.term(sub))
+        if hd in ("loop", "for_in"):
+            return self.hoist(term)
+        return term
+
+    def invariant(self, term, variant: Set[str], stable: bool) -> bool:
+        if not isinstance(term, tuple):
+            return True
+        hd = term[0]
+        if hd == "const":
+            return True
+        if hd == "var":
+            n = term[1]
+            return n not in variant and (stable or self.is_fast(n))
+        purity = self.purity
+        if hd in ("get_attr", "get_item"):
+            root = root_var(term)
+            if not (root in purity.bases and root not in variant):
+                return False
+        elif hd in ("bin", "un", "cmp"):
+            if not purity.is_pure_operator(term):
+                return False
+        elif not (stable and purity.is_pure_call(term)):
+            return False
+        return all(self.invariant(sub, variant, stable) for sub, _ in subterms(term))
+
+    def collect(self, term, variant: Set[str], stable: bool, found: List[tuple]):
+        """Find the outermost invariant subterms evaluated in each iteration."""
+        if not isinstance(term, tuple) or term[0] in ("var", "const"):
+            return
+        if self.invariant(term, variant, stable):
+            if term not in found:
+                found.append(term)
+            return
+        for sub, always in subterms(term):
+            if always:
+                self.collect(sub, variant, stable, found)
+
+    def hoist(self, term):
+        # jumps into the loop would skip the assignments
+        if contains(term, ("label",)):
+            return term
+        variant = writes(term)
+        # the iterable of `for_in` is evaluated once, before the iterations
+        parts = term[1:] if term[0] == "loop" else term[3:]
+        stable = not any(self.purity.has_effects(each) for each in parts)
+        if term[0] == "for_in" and not _is_range(term[2]):
+            stable = False
+        found = []  # type: List[tuple]
+        for each in parts:
+            self.collect(each, variant, stable, found)
+        if not found:
+            return term
+        names = [(each, self.new_local()) for each in found]
+
+        def replace(sub, _=None):
+            for each, n in names:
+                if sub == each:
+                    return ("var", n)
+            return map_subterms(sub, replace)
+
+        if term[0] == "loop":
+            term = ("loop", replace(term[1]), replace(term[2]))
+        else:
+            term = term[:3] + (replace(term[3]),)
+        hoisted = tuple(("assign_star", n, each) for each, n in names)
+        if term[0] == "for_in" and self.purity.has_effects(term[2]):
+            # the effects of the iterable come first
+            it = self.new_local()
+            hoisted = (("assign_star", it, term[2]),) + hoisted
+            term = term[:2] + (("var", it),) + term[3:]
+        return ("block",) + hoisted + (term,)
+
+
+def licm(sexpr, purity: Purity = Purity()):
+    """Move invariant subterms of `loop` and `for_in` before the loops."""
+    if isinstance(sexpr, TermView):
+        sexpr = materialize(sexpr)
+    outermost = ScopeSolver.outermost()
+    scopes = {}  # type: Dict[int, ScopeSolver]
+    _solve(sexpr, outermost, scopes)
+    outermost.resolve()
+    return _LICM(purity, scopes, outermost).term(sexpr)
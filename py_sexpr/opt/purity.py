@@ -0,0 +1,91 @@
+"""What passes may assume about evaluating s-expressions.
+
+Python code can run anywhere, e.g., in `__add__` or `__getattr__`,
+hence a pass moving or sharing computation needs assumptions from the user.
+"""
+import attr
+from typing import FrozenSet, Iterable
+from py_sexpr.stack_vm.instructions import BinOp
+from py_sexpr.opt.walk import subterms
+
+__all__ = ["Purity", "EFFECTS", "FAILING_BINOPS"]
+
+# terms which may run arbitrary code, or let other code run
+EFFECTS = frozenset(
+    [
+        "call",
+        "call_method",
+        "call_kw",
+        "call_star",
+        "new",
+        "yield_",
+        "yield_from",
+        "await_",
+        "set_attr",
+        "set_item",
+        "aug_set_attr",
+        "aug_set_item",
+    ]
+)
+
+# `bin` operators failing on some numbers, e.g., by zero division, or on all of them
+FAILING_BINOPS = frozenset(
+    [
+        BinOp.POWER,
+        BinOp.MATRIX_MULTIPLY,
+        BinOp.FLOOR_DIVIDE,
+        BinOp.TRUE_DIVIDE,
+        BinOp.MODULO,
+        BinOp.SUBSCR,
+        BinOp.LSHIFT,
+        BinOp.RSHIFT,
+    ]
+)
+
+
+def _frozen(xs: Iterable[str]) -> FrozenSet[str]:
+    return frozenset(xs)
+
+
+@attr.s(frozen=True)
+class Purity:
+    """A purity model.
+
+    A pure term neither has side effects nor fails,
+    and its value only changes with the variables it reads,
+    or the attributes and items of them.
+    """
+
+    # variables whose attribute and item chains only change by writes rooted at them
+    bases = attr.ib(default=frozenset(), converter=_frozen)  # type: FrozenSet[str]
+    # functions, referred by `var`, pure when their arguments are
+    functions = attr.ib(default=frozenset(), converter=_frozen)  # type: FrozenSet[str]
+    # if `bin`, `un` and `cmp` over pure operands are pure, as for numbers and strings
+    operators = attr.ib(default=True)  # type: bool
+    # if the `FAILING_BINOPS` over pure operands are pure as well, i.e., they don't fail
+    failing_operators = attr.ib(default=False)  # type: bool
+
+    def is_pure_operator(self, term) -> bool:
+        if term[0] not in ("bin", "un", "cmp") or not self.operators:
+            return False
+        return term[0] != "bin" or self.failing_operators or term[2] not in FAILING_BINOPS
+
+    def is_pure_call(self, term) -> bool:
+        if term[0] != "call":
+            return False
+        f = term[1]
+        return isinstance(f, tuple) and f[0] == "var" and f[1] in self.functions
+
+    def has_effects(self, term) -> bool:
+        """If `term` may change the heap or rebind variables other than by its writes,
+        not looking into `func`s.
+        """
+        stack = [term]
+        while stack:
+            term = stack.pop()
+            if not isinstance(term, tuple):
+                continue
+            if term[0] in EFFECTS and not self.is_pure_call(term):
+                return True
+            stack.extend(sub for sub, _ in subterms(term))
+        return False
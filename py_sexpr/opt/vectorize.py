@@ -0,0 +1,227 @@
+"""Rewrite elementwise `for_range` loops into whole-array NumPy expressions.
+
+A loop is elementwise if its body only stores into arrays at the loop index,
+values computed from the items of arrays at the same index,
+constants and other variables, by arithmetic, comparisons and `ite`:
+
+```python
+    for_range("i", 0, var("n"),
+        set_item(var("out"), var("i"), binop(get_item(var("a"), var("i")), BinOp.ADD, var("k"))))
+```
+
+runs as `out[0:n] = a[0:n] + k`.
+At runtime, a guard checks the range has at least `min_size` items,
+as NumPy costs more than a few iterations, the arrays are 1-D `numpy.ndarray`s of numbers covering the range,
+other variables are numbers, i.e., `int`, `float`, `complex` or NumPy scalars,
+and arrays written don't overlap others,
+otherwise the original loop runs.
+NumPy is found in `sys.modules`, so neither the pass nor the generated code imports it.
+
+Both clauses of an `ite` get evaluated, and results follow NumPy's casting of arrays,
+which may differ from the items', e.g., in warnings on division by zero.
+"""
+from typing import List, Optional
+from py_sexpr.serialize import TermView, materialize
+from py_sexpr.stack_vm.instructions import BinOp, UOp
+from bytecode.instr import Compare
+from py_sexpr.opt.walk import map_subterms
+
+__all__ = ["vectorize", "VECTORIZE_PREFIX"]
+
+# prefix of hidden locals, which cannot be written in Python
+VECTORIZE_PREFIX = ".vec"
+
+_BINOPS = frozenset(BinOp) - {BinOp.MATRIX_MULTIPLY, BinOp.SUBSCR}
+_UOPS = frozenset([UOp.POSITIVE, UOp.NEGATIVE, UOp.INVERT])
+_COMPARES = frozenset([Compare.LT, Compare.LE, Compare.EQ, Compare.NE, Compare.GT, Compare.GE])
+_SCALARS = (bool, int, float, complex)
+
+
+def _var(term) -> Optional[str]:
+    if isinstance(term, tuple) and term[0] == "var":
+        return term[1]
+    return None
+
+
+class _Loop:
+    """Arrays and scalars of an elementwise loop over `index`."""
+
+    def __init__(self, index: str):
+        self.index = index
+        self.arrays = []  # type: List[str]
+        self.written = []  # type: List[str]
+        self.scalars = []  # type: List[str]
+
+    def is_item(self, term) -> bool:
+        return (
+            isinstance(term, tuple)
+            and term[0] in ("get_item", "set_item")
+            and _var(term[1]) not in (None, self.index)
+            and _var(term[2]) == self.index
+        )
+
+    def array(self, n: str, written: bool = False):
+        if n not in self.arrays:
+            self.arrays.append(n)
+        if written and n not in self.written:
+            self.written.append(n)
+
+    def elementwise(self, term) -> bool:
+        if not isinstance(term, tuple):
+            return isinstance(term, _SCALARS)
+        hd = term[0]
+        if hd == "var":
+            if term[1] == self.index:
+                return False
+            if term[1] not in self.scalars:
+                self.scalars.append(term[1])
+            return True
+        if hd == "get_item":
+            if not self.is_item(term):
+                return False
+            self.array(term[1][1])
+            return True
+        if hd == "bin":
+            return term[2] in _BINOPS and self.elementwise(term[1]) and self.elementwise(term[3])
+        if hd == "un":
+            return term[1] in _UOPS and self.elementwise(term[2])
+        if hd == "cmp":
+            return (
+                len(term) == 4
+                and term[2] in _COMPARES
+                and self.elementwise(term[1])
+                and self.elementwise(term[3])
+            )
+        if hd == "ite":
+            return all(self.elementwise(each) for each in term[1:])
+        return False
+
+    def stores(self, body) -> Optional[list]:
+        """The `set_item`s of an elementwise body, or `None`."""
+        stmts = body[1:] if isinstance(body, tuple) and body[0] == "block" else (body,)
+        if not stmts:
+            return None
+        for each in stmts:
+            if not (self.is_item(each) and each[0] == "set_item"):
+                return None
+            if not self.elementwise(each[3]):
+                return None
+            self.array(each[1][1], written=True)
+        if set(self.arrays) & set(self.scalars):
+            return None
+        return list(stmts)
+
+
+def _for_range(term) -> Optional[tuple]:
+    """`(index, low, high, body)` of a `for_range` term, or `None`."""
+    if term[0] != "for_in" or not isinstance(term[1], str):
+        return None
+    seq = term[2]
+    if not (isinstance(seq, tuple) and seq[0] == "call" and _var(seq[1]) == "range"):
+        return None
+    if len(seq) != 4:
+        return None
+    return term[1], seq[2], seq[3], term[3]
+
+
+class _Vectorize:
+    def __init__(self, min_size: int):
+        self.min_size = min_size
+        self.n_locals = 0
+
+    def new_local(self) -> str:
+        n = "{}{}".format(VECTORIZE_PREFIX, self.n_locals)
+        self.n_locals += 1
+        return n
+
+    def term(self, term):
+        if not isinstance(term, tuple):
+            return term
+        if term[0] == "func":
+            return term[:2] + (self.term(term[2]),) + term[3:]
+        term = map_subterms(term, lambda sub, _: self.term(sub))
+        if term[0] == "for_in":
+            return self.for_in(term)
+        return term
+
+    def for_in(self, term):
+        matched = _for_range(term)
+        if matched is None:
+            return term
+        index, low, high, body = matched
+        loop = _Loop(index)
+        stmts = loop.stores(body)
+        if stmts is None:
+            return term
+
+        r, np, sl = self.new_local(), self.new_local(), self.new_local()
+        views = {n: self.new_local() for n in loop.arrays}
+
+        def vector(e):
+            if not isinstance(e, tuple):
+                return e
+            if e[0] == "get_item":
+                return ("var", views[e[1][1]])
+            if e[0] == "ite":
+                return ("call_method", ("var", np), "where") + tuple(map(vector, e[1:]))
+            return map_subterms(e, lambda sub, _: vector(sub))
+
+        ndarray = ("get_attr", ("var", np), "ndarray")
+        numbers = (
+            "tuple",
+            ("var", "int"),
+            ("var", "float"),
+            ("var", "complex"),
+            ("get_attr", ("var", np), "number"),
+            ("get_attr", ("var", np), "bool_"),
+        )
+        start = ("get_attr", ("var", r), "start")
+        stop = ("get_attr", ("var", r), "stop")
+        checks = [
+            ("cmp", ("call", ("var", "len"), ("var", r)), Compare.GE, self.min_size),
+            ("cmp", ("var", np), Compare.IS_NOT, None),
+            ("cmp", 0, Compare.LE, start),
+        ]
+        for n in loop.arrays:
+            checks.append(("call", ("var", "isinstance"), ("var", n), ndarray))
+            checks.append(("cmp", ("get_attr", ("var", n), "ndim"), Compare.EQ, 1))
+            kind = ("get_attr", ("get_attr", ("var", n), "dtype"), "kind")
+            checks.append(("cmp", kind, Compare.IN, "biufc"))
+            checks.append(("cmp", stop, Compare.LE, ("call", ("var", "len"), ("var", n))))
+        for n in loop.scalars:
+            checks.append(("call", ("var", "isinstance"), ("var", n), numbers))
+        for n in loop.written:
+            for other in loop.arrays:
+                if other != n:
+                    pair = (("var", n), ("var", other))
+                    shared = ("call_method", ("var", np), "may_share_memory") + pair
+                    same = ("cmp", ("var", n), Compare.IS, ("var", other))
+                    checks.append(("or_", same, ("un", UOp.NOT, shared)))
+
+        vectorized = [("assign_star", sl, ("call", ("var", "slice"), start, stop))]
+        for n in loop.arrays:
+            vectorized.append(("assign_star", views[n], ("get_item", ("var", n), ("var", sl))))
+        for each in stmts:
+            vectorized.append(("set_item", each[1], ("var", sl), vector(each[3])))
+        # the index is left as the last iteration does
+        last = ("assign", index, ("bin", stop, BinOp.SUBTRACT, 1))
+        vectorized.append(("ite", ("var", r), last, None))
+
+        modules = ("get_attr", ("call", ("var", "__import__"), "sys"), "modules")
+        numpy = ("call_method", modules, "get", "numpy")
+        scalar = term[:2] + (("var", r),) + term[3:]
+        return (
+            "block",
+            ("assign_star", r, ("call", ("var", "range"), low, high)),
+            ("assign_star", np, numpy),
+            ("ite", ("and_",) + tuple(checks), ("block",) + tuple(vectorized), scalar),
+        )
+
+
+def vectorize(sexpr, min_size: int = 32):
+    """Rewrite elementwise `for_range` loops into NumPy expressions,
+    guarded by a check falling back to the loops.
+    """
+    if isinstance(sexpr, TermView):
+        sexpr = materialize(sexpr)
+    return _Vectorize(min_size).term(sexpr)
@@ -0,0 +1,209 @@
+"""The shape of s-expressions, for passes rewriting them.
+
+A sub-term is *always* evaluated if it gets evaluated whenever its parent does,
+e.g., the condition of `ite`, but not its clauses.
+`func` terms are opaque, their defaults and bodies are not sub-terms.
+"""
+from typing import Callable, List, Optional, Set, Tuple, Union
+
+__all__ = [
+    "JUMPS",
+    "positions",
+    "subterms",
+    "map_subterms",
+    "contains",
+    "bound_names",
+    "root_var",
+    "writes",
+    "declared",
+]
+
+Position = Union[int, Tuple[int, int]]
+
+# terms leaving the normal flow of control
+JUMPS = frozenset(["ret", "break_", "continue_", "goto", "throw"])
+
+# positions of sub-terms, of terms with a fixed shape, and if each is always evaluated
+_FIXED = {
+    "assign_star": ((2, True),),
+    "assign": ((2, True),),
+    "lens": ((1, True), (2, True)),
+    "get_attr": ((1, True),),
+    "set_attr": ((1, True), (3, True)),
+    "get_item": ((1, True), (2, True)),
+    "set_item": ((1, True), (2, True), (3, True)),
+    "aug_assign": ((3, True),),
+    "aug_set_attr": ((1, True), (4, True)),
+    "aug_set_item": ((1, True), (2, True), (4, True)),
+    "un": ((2, True),),
+    "bin": ((1, True), (3, True)),
+    "doc": ((2, True),),
+    "line": ((2, True),),
+    "filename": ((2, True),),
+    "ite": ((1, True), (2, False), (3, False)),
+    "for_in": ((2, True), (3, False)),
+    "async_for_in": ((2, True), (3, False)),
+    "list_comp": ((2, True), (3, False), (4, False)),
+    "set_comp": ((2, True), (3, False), (4, False)),
+    "dict_comp": ((2, True), (3, False), (4, False), (5, False)),
+    "loop": ((1, True), (2, False)),
+    "break_": ((1, True),),
+    "ret": ((1, True),),
+    "yield_": ((1, True),),
+    "yield_from": ((1, True),),
+    "await_": ((1, True),),
+    "throw": ((1, True),),
+    "eval": ((1, True),),
+    "call_star": ((1, True), (2, True), (3, True)),
+    "var": (),
+    "const": (),
+    "label": (),
+    "goto": (),
+    "continue_": (),
+    "func": (),
+}
+
+# terms whose sub-terms start from an index, all always evaluated
+_VARIADIC = {"call": 1, "new": 1, "tuple": 1}
+
+
+def positions(term) -> List[Tuple[Position, bool]]:
+    """Positions of the sub-terms of `term`, each with if it's always evaluated."""
+    if not isinstance(term, tuple):
+        return []
+    hd = term[0]
+    fixed = _FIXED.get(hd)
+    if fixed is not None:
+        return [each for each in fixed if each[0] < len(term)]
+    n = len(term)
+    start = _VARIADIC.get(hd)
+    if start is not None:
+        return [(i, True) for i in range(start, n)]
+    if hd in ("call_method", "call_kw"):
+        return [(1, True)] + [(i, True) for i in range(3, n)]
+    if hd == "record":
+        return [((i, 1), True) for i in range(1, n)]
+    if hd == "cmp":
+        # operands after the first comparison are short-circuited
+        return [(i, i <= 3) for i in range(1, n, 2)]
+    if hd in ("and_", "or_"):
+        return [(i, i == 1) for i in range(1, n)]
+    if hd == "switch":
+        return [(1, True)] + [(i, False) for i in range(3, n)]
+    if hd == "block":
+        result = []
+        always = True
+        for i in range(1, n):
+            result.append((i, always))
+            always = always and not contains(term[i], JUMPS)
+        return result
+    raise ValueError("unknown term {!r}".format(hd))
+
+
+def _get(term, pos: Position):
+    if isinstance(pos, int):
+        return term[pos]
+    i, j = pos
+    return term[i][j]
+
+
+def subterms(term) -> list:
+    """Sub-terms of `term`, each with if it's always evaluated."""
+    return [(_get(term, pos), always) for pos, always in positions(term)]
+
+
+def map_subterms(term, f: Callable):
+    """Rebuild `term` with each sub-term replaced by `f(sub_term, always)`."""
+    poss = positions(term)
+    if not poss:
+        return term
+    elts = list(term)
+    for pos, always in poss:
+        if isinstance(pos, int):
+            elts[pos] = f(elts[pos], always)
+        else:
+            i, j = pos
+            pair = list(elts[i])
+            pair[j] = f(pair[j], always)
+            elts[i] = tuple(pair)
+    return tuple(elts)
+
+
+def contains(term, heads) -> bool:
+    """If `term` has a sub-term, or is itself, headed by one of `heads`,
+    not looking into `func`s.
+    """
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if not isinstance(term, tuple):
+            continue
+        if term[0] in heads:
+            return True
+        stack.extend(sub for sub, _ in subterms(term))
+    return False
+
+
+def bound_names(pattern) -> List[str]:
+    """Names bound by a pattern of `assign`, `for_in` and comprehensions."""
+    if isinstance(pattern, str):
+        return [pattern]
+    return [n for each in pattern for n in bound_names(each)]
+
+
+def root_var(base) -> Optional[str]:
+    """The variable a chain of attributes and items is rooted at, if any."""
+    while isinstance(base, tuple) and base[0] in ("get_attr", "get_item"):
+        base = base[1]
+    if isinstance(base, tuple) and base[0] == "var":
+        return base[1]
+    return None
+
+
+def writes(term) -> Set[str]:
+    """Names of variables `term` may assign, or mutate the attributes or items of,
+    through names, attributes and items rooted at the variables.
+    Writes by nested functions, when called, are included.
+    """
+    result = set()  # type: Set[str]
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if not isinstance(term, tuple):
+            continue
+        hd = term[0]
+        if hd in ("assign_star", "assign", "aug_assign"):
+            result.update(bound_names(term[1]))
+        elif hd in ("for_in", "async_for_in", "list_comp", "set_comp", "dict_comp"):
+            result.update(bound_names(term[1]))
+        elif hd in ("set_attr", "set_item", "aug_set_attr", "aug_set_item"):
+            root = root_var(term[1])
+            if root is not None:
+                result.add(root)
+        elif hd == "func":
+            _, args, body, name = term[:4]
+            if name:
+                result.add(name)
+            local = set(args)
+            local.update(declared(body))
+            result.update(writes(body) - local)
+            stack.extend(term[4])
+            continue
+        stack.extend(sub for sub, _ in subterms(term))
+    return result
+
+
+def declared(term) -> Set[str]:
+    """Names `assign_star` declares in a function body."""
+    result = set()  # type: Set[str]
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if not isinstance(term, tuple):
+            continue
+        if term[0] == "assign_star":
+            result.update(bound_names(term[1]))
+        elif term[0] == "func" and term[3]:
+            result.add(term[3])
+        stack.extend(sub for sub, _ in subterms(term))
+    return result
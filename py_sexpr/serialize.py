@@ -0,0 +1,396 @@
+"""A compact binary encoding of `SExpr`s.
+
+Layout of an encoded file:
+
+- `MAGIC`
+
+- node records, each of which is a kind byte(tuple or list),
+  a varint count of children, and the children as *items*.
+  Children are always written before their parent, hence the encoder streams.
+
+- a string table, holding head tags, names and string literals
+
+- a constant pool, holding `float`, `complex` and `bytes` literals
+
+- a fixed-size trailer: offsets of the string table, the constant pool and the root item.
+
+An item is a kind byte followed by a varint payload:
+an index into the string table or the constant pool,
+an inline zigzag integer, an enum member, or the offset of a node record.
+
+`load` maps a file into memory and returns lazy `TermView`s,
+which `py_sexpr.stack_vm.emit.Builder` walks without materializing the whole tree.
+"""
+import mmap
+import struct
+from enum import Enum
+from bytecode.instr import Compare
+from py_sexpr.stack_vm.instructions import BinOp, UOp
+
+__all__ = [
+    "MAGIC",
+    "Ref",
+    "TermView",
+    "Encoder",
+    "Decoder",
+    "dump",
+    "dumps",
+    "load",
+    "loads",
+    "materialize",
+]
+
+MAGIC = b"PYSX\x01"
+
+_TRAILER = struct.Struct("<QQQ")
+
+_NODE_TUPLE = 0
+_NODE_LIST = 1
+
+_ITEM_NONE = 0
+_ITEM_TRUE = 1
+_ITEM_FALSE = 2
+_ITEM_STR = 3
+_ITEM_CONST = 4
+_ITEM_ENUM = 5
+_ITEM_NODE = 6
+_ITEM_INT = 7
+
+_CONST_FLOAT = 0
+_CONST_COMPLEX = 1
+_CONST_BYTES = 2
+
+_ENUMS = (Compare, BinOp, UOp)
+_ENUM_INDICES = {e: i for i, e in enumerate(_ENUMS)}
+
+_FLUSH_SIZE = 1 << 16
+
+
+def _varint(i: int) -> bytes:
+    buf = bytearray()
+    while i > 0x7F:
+        buf.append((i & 0x7F) | 0x80)
+        i >>= 7
+    buf.append(i)
+    return bytes(buf)
+
+
+def _zigzag(i: int) -> int:
+    return i << 1 if i >= 0 else ((-i) << 1) - 1
+
+
+def _unzigzag(i: int) -> int:
+    return i >> 1 if not i & 1 else -((i + 1) >> 1)
+
+
+class Ref:
+    """An already encoded subtree, which can be used as a child of later terms."""
+
+    __slots__ = ["item"]
+
+    def __init__(self, item: bytes):
+        self.item = item
+
+    def __repr__(self):
+        return "Ref({!r})".format(self.item)
+
+
+class Encoder:
+    """Streaming encoder.
+
+    ```python
+        with open(path, 'wb') as f:
+            enc = Encoder(f)
+            stmts = [enc.encode(each) for each in generate_statements()]
+            enc.close(block(*stmts))
+    ```
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.strings = {}  # type: dict
+        self.consts = {}  # type: dict
+        self._const_values = []  # type: list
+        self._buf = bytearray(MAGIC)
+        self._offset = 0
+
+    def _write(self, data):
+        buf = self._buf
+        buf.extend(data)
+        if len(buf) >= _FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.file.write(bytes(self._buf))
+        self._offset += len(self._buf)
+        del self._buf[:]
+
+    def _tell(self):
+        return self._offset + len(self._buf)
+
+    def _string(self, s: str):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+        return i
+
+    def _const(self, c):
+        # `repr` tells -0.0 from 0.0
+        key = (type(c), repr(c))
+        i = self.consts.get(key)
+        if i is None:
+            i = self.consts[key] = len(self.consts)
+            self._const_values.append(c)
+        return i
+
+    def _leaf(self, value):
+        """encode a leaf as an item, return `None` for tuples and lists."""
+        if value is None:
+            return bytes([_ITEM_NONE])
+        if value is True:
+            return bytes([_ITEM_TRUE])
+        if value is False:
+            return bytes([_ITEM_FALSE])
+        if isinstance(value, str):
+            return bytes([_ITEM_STR]) + _varint(self._string(value))
+        if isinstance(value, Enum):
+            enum_idx = _ENUM_INDICES[type(value)]
+            return bytes([_ITEM_ENUM, enum_idx]) + _varint(self._string(value.name))
+        if isinstance(value, int):
+            return bytes([_ITEM_INT]) + _varint(_zigzag(value))
+        if isinstance(value, (float, complex, bytes)):
+            return bytes([_ITEM_CONST]) + _varint(self._const(value))
+        if isinstance(value, Ref):
+            return value.item
+        if isinstance(value, (tuple, list)):
+            return None
+        raise TypeError("cannot serialize {!r}".format(value))
+
+    def _node(self, value, items):
+        offset = self._tell()
+        kind = _NODE_LIST if isinstance(value, list) else _NODE_TUPLE
+        self._write(bytes([kind]) + _varint(len(items)) + b"".join(items))
+        return bytes([_ITEM_NODE]) + _varint(offset)
+
+    def _item(self, value) -> bytes:
+        leaf = self._leaf(value)
+        if leaf is not None:
+            return leaf
+        result = []
+        # post-order traversal without recursion
+        stack = [(value, iter(value), [])]
+        while stack:
+            node, it, items = stack[-1]
+            for child in it:
+                leaf = self._leaf(child)
+                if leaf is None:
+                    stack.append((child, iter(child), []))
+                    break
+                items.append(leaf)
+            else:
+                stack.pop()
+                item = self._node(node, items)
+                (stack[-1][2] if stack else result).append(item)
+        return result[0]
+
+    def encode(self, term) -> Ref:
+        """Write a subtree, return a reference to it."""
+        if isinstance(term, Ref):
+            return term
+        return Ref(self._item(term))
+
+    def close(self, root):
+        """Write the root term and all tables."""
+        root_item = self._item(root)
+        root_offset = self._tell()
+        self._write(root_item)
+
+        strings_offset = self._tell()
+        self._write(_varint(len(self.strings)))
+        for s in self.strings:
+            data = s.encode("utf-8")
+            self._write(_varint(len(data)) + data)
+
+        consts_offset = self._tell()
+        self._write(_varint(len(self.consts)))
+        for c in self._const_values:
+            if isinstance(c, float):
+                self._write(bytes([_CONST_FLOAT]) + struct.pack("<d", c))
+            elif isinstance(c, complex):
+                self._write(bytes([_CONST_COMPLEX]) + struct.pack("<dd", c.real, c.imag))
+            else:
+                self._write(bytes([_CONST_BYTES]) + _varint(len(c)) + c)
+
+        self._write(_TRAILER.pack(strings_offset, consts_offset, root_offset))
+        self.flush()
+
+
+class TermView:
+    """A lazily decoded tuple.
+
+    Iterating or indexing it decodes one level of children,
+    and nested tuples are again `TermView`s.
+    The payload of a `const` term is always materialized.
+    """
+
+    __slots__ = ["_decoder", "_offset"]
+
+    def __init__(self, decoder: "Decoder", offset: int):
+        self._decoder = decoder
+        self._offset = offset
+
+    def unfold(self) -> tuple:
+        children = self._decoder.children(self._offset)
+        if children and children[0] == "const":
+            children = tuple(map(materialize, children))
+        return children
+
+    def __iter__(self):
+        return iter(self.unfold())
+
+    def __getitem__(self, i):
+        return self.unfold()[i]
+
+    def __len__(self):
+        decoder = self._decoder
+        return decoder.varint(self._offset + 1)[0]
+
+    def __repr__(self):
+        return "TermView{!r}".format(self.unfold())
+
+
+class Decoder:
+    """Decoder over any buffer, such as `bytes` or `mmap.mmap`."""
+
+    def __init__(self, buf):
+        self.buf = buf
+        if buf[: len(MAGIC)] != MAGIC:
+            raise ValueError("not an encoded s-expression")
+        strings_offset, consts_offset, self.root_offset = _TRAILER.unpack_from(
+            buf, len(buf) - _TRAILER.size
+        )
+
+        n, i = self.varint(strings_offset)
+        strings = []
+        for _ in range(n):
+            size, i = self.varint(i)
+            strings.append(bytes(buf[i : i + size]).decode("utf-8"))
+            i += size
+        self.strings = strings
+
+        n, i = self.varint(consts_offset)
+        consts = []
+        for _ in range(n):
+            kind = buf[i]
+            i += 1
+            if kind == _CONST_FLOAT:
+                consts.append(struct.unpack_from("<d", buf, i)[0])
+                i += 8
+            elif kind == _CONST_COMPLEX:
+                consts.append(complex(*struct.unpack_from("<dd", buf, i)))
+                i += 16
+            else:
+                size, i = self.varint(i)
+                consts.append(bytes(buf[i : i + size]))
+                i += size
+        self.consts = consts
+
+    def varint(self, i: int):
+        buf = self.buf
+        shift = 0
+        result = 0
+        while True:
+            b = buf[i]
+            i += 1
+            result |= (b & 0x7F) << shift
+            if not b & 0x80:
+                return result, i
+            shift += 7
+
+    def item(self, i: int):
+        """Decode the item at offset `i`, return the value and the next offset."""
+        kind = self.buf[i]
+        i += 1
+        if kind == _ITEM_NONE:
+            return None, i
+        if kind == _ITEM_TRUE:
+            return True, i
+        if kind == _ITEM_FALSE:
+            return False, i
+        if kind == _ITEM_ENUM:
+            enum = _ENUMS[self.buf[i]]
+            name, i = self.varint(i + 1)
+            return enum[self.strings[name]], i
+        payload, i = self.varint(i)
+        if kind == _ITEM_STR:
+            return self.strings[payload], i
+        if kind == _ITEM_INT:
+            return _unzigzag(payload), i
+        if kind == _ITEM_CONST:
+            return self.consts[payload], i
+        if kind == _ITEM_NODE:
+            return self.node(payload), i
+        raise ValueError("unknown item kind {}".format(kind))
+
+    def node(self, offset: int):
+        if self.buf[offset] == _NODE_LIST:
+            return list(self.children(offset))
+        return TermView(self, offset)
+
+    def children(self, offset: int) -> tuple:
+        n, i = self.varint(offset + 1)
+        item = self.item
+        children = []
+        append = children.append
+        for _ in range(n):
+            value, i = item(i)
+            append(value)
+        return tuple(children)
+
+    def root(self):
+        return self.item(self.root_offset)[0]
+
+
+def dump(term, file):
+    enc = Encoder(file)
+    enc.close(term)
+
+
+def dumps(term) -> bytes:
+    import io
+
+    f = io.BytesIO()
+    dump(term, f)
+    return f.getvalue()
+
+
+def loads(data):
+    """Lazily decode a buffer, return the root term."""
+    return Decoder(data).root()
+
+
+def load(path: str):
+    """Map the file into memory and lazily decode it, return the root term."""
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(buf)
+
+
+def materialize(term):
+    """Turn `TermView`s into plain tuples, recursively."""
+    if not isinstance(term, (TermView, list)):
+        return term
+    result = []
+    stack = [(term, iter(term), [])]
+    while stack:
+        node, it, elts = stack[-1]
+        for child in it:
+            if isinstance(child, (TermView, list)):
+                stack.append((child, iter(child), []))
+                break
+            elts.append(child)
+        else:
+            stack.pop()
+            value = elts if isinstance(node, list) else tuple(elts)
+            (stack[-1][2] if stack else result).append(value)
+    return result[0]
@@ -0,0 +1,100 @@
+"""Compile s-expressions inside an `asyncio` event loop.
+
+`module_code` runs to completion once called,
+which stalls the event loop when the s-expression is large.
+`module_code_async` drives the same builders with `scheduling_steps`,
+and gives control back to the loop after a number of sub-terms or a slice of time.
+
+```python
+    code = await module_code_async(main, time_slice=0.005, timeout=1.0, offload=True)
+```
+
+Cancelling the awaiting task stops the compilation at its next pause.
+"""
+import asyncio
+from typing import Optional
+from py_sexpr.stack_vm.emit import (
+    Builder,
+    SharedState,
+    Origins,
+    Counters,
+    Profile,
+    scheduling_steps,
+    toplevel_code,
+)
+
+__all__ = ["module_code_async"]
+
+# how often the clock is read when pausing by time
+_CLOCK_STEPS = 64
+
+
+async def module_code_async(
+    sexpr,
+    name: str = "<unknown>",
+    filename: str = "<unknown>",
+    lineno: int = 1,
+    doc: str = "",
+    origins: Optional[Origins] = None,
+    counters: Optional[Counters] = None,
+    profile: Optional[Profile] = None,
+    lazy: bool = False,
+    *,
+    steps: Optional[int] = 1000,
+    time_slice: Optional[float] = None,
+    timeout: Optional[float] = None,
+    deadline: Optional[float] = None,
+    offload: bool = False,
+    executor=None
+):
+    """The asynchronous `module_code`.
+
+    - `steps`: pause after entering this many sub-terms.
+    - `time_slice`: pause after running this many seconds.
+    - `timeout`/`deadline`: raise `asyncio.TimeoutError` if compilation isn't done
+      in `timeout` seconds, or by `deadline` in the clock of `loop.time()`.
+    - `offload`: lower the builders and create code objects, i.e., `make_code_obj`,
+      with `loop.run_in_executor(executor, ...)`.
+      The executor thread runs to the end even if the task gets cancelled.
+    """
+    loop = asyncio.get_event_loop()
+    clock = loop.time
+    if timeout is not None:
+        end = clock() + timeout
+        deadline = end if deadline is None else min(deadline, end)
+    if steps is None and time_slice is None:
+        every = _CLOCK_STEPS if deadline is not None else 0
+    elif time_slice is None and deadline is None:
+        every = steps
+    else:
+        every = _CLOCK_STEPS if steps is None else min(steps, _CLOCK_STEPS)
+
+    if (counters is not None or profile is not None) and origins is None:
+        origins = Origins()
+    st = SharedState(doc, lineno, filename, origins, counters, profile, lazy=lazy)
+    root = -1 if origins is None else len(origins.paths)
+    builder = Builder.toplevel(st)
+
+    entered = 0
+    start = clock()
+    for _ in scheduling_steps(builder.body(sexpr), every):
+        entered += every
+        now = clock()
+        if deadline is not None and now >= deadline:
+            raise asyncio.TimeoutError
+        if (steps is not None and entered >= steps) or (
+            time_slice is not None and now - start >= time_slice
+        ):
+            await asyncio.sleep(0)
+            entered = 0
+            start = clock()
+    builder.sc.resolve()
+
+    if not offload:
+        return toplevel_code(builder, root, name, filename, lineno, doc)
+    future = loop.run_in_executor(
+        executor, toplevel_code, builder, root, name, filename, lineno, doc
+    )
+    if deadline is None:
+        return await future
+    return await asyncio.wait_for(future, max(deadline - clock(), 0))
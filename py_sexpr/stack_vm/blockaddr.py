@@ -1,12 +1,33 @@
 """This module preserved for further advanced features, like `Label as Value`, switch expressions.
+
+Named labels are the targets of `label`/`goto` terms,
+whose jumps are validated by `check_stack_depth`.
 """
 from bytecode import Label, Instr
-from typing import List
+from typing import List, Dict, Union
+from sys import version_info
 
-__all__ = ["NamedLabel", "merge_labels"]
+__all__ = ["NamedLabel", "merge_labels", "check_stack_depth"]
 
 WHY_CONTINUE = 0x0020
 
+# effects when falling through and jumping, where `Instr.stack_effect` of Python 3.6
+# gives upper bounds, e.g., 6 for `SETUP_EXCEPT` not jumping
+_STACK_EFFECTS_36 = {
+    "SETUP_EXCEPT": (0, 6),
+    "SETUP_FINALLY": (0, 6),
+    "POP_EXCEPT": (-3, -3),
+    "END_FINALLY": (-6, -6),
+}
+
+
+def _stack_effect(instr: Instr, jump: bool) -> int:
+    if version_info < (3, 7):
+        effect = _STACK_EFFECTS_36.get(instr.name)
+        if effect is not None:
+            return effect[jump]
+    return instr.stack_effect(jump=jump)
+
 
 class NamedLabel(Label):
     name = None  # type: object
@@ -47,3 +68,35 @@ def merge_labels(xs: List[Instr]):
             if isinstance(each, Instr) and each.has_jump():
                 each.arg = equals_to[each.arg]
         yield each
+
+
+def check_stack_depth(xs: List[Union[Instr, Label]]) -> Dict[Label, int]:
+    """Check that each label is reached with the same stack depth from all paths,
+    relative to the entry. Return the depth of each reachable label.
+    """
+    positions = {each: i for i, each in enumerate(xs) if isinstance(each, Label)}
+    depths = {}  # type: Dict[Label, int]
+    todo = [(0, 0)]
+    while todo:
+        i, depth = todo.pop()
+        while i < len(xs):
+            each = xs[i]
+            if isinstance(each, Label):
+                known = depths.get(each)
+                if known is not None:
+                    if known != depth:
+                        raise ValueError(
+                            "inconsistent stack depth at label {}: {} != {}".format(
+                                getattr(each, "name", each), known, depth
+                            )
+                        )
+                    break
+                depths[each] = depth
+            elif isinstance(each, Instr):
+                if each.has_jump():
+                    todo.append((positions[each.arg], depth + _stack_effect(each, True)))
+                if each.is_final():
+                    break
+                depth += _stack_effect(each, False)
+            i += 1
+    return depths
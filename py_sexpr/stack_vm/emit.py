@@ -1,19 +1,42 @@
 import attr
 import bytecode as BC
-from typing import List, Dict, Callable, Optional, Set, Union
+from typing import List, Dict, Optional, Set, Union, Iterable
 from enum import Enum
 from functools import lru_cache
 from py_sexpr.stack_vm import instructions as I
-from py_sexpr.stack_vm.blockaddr import NamedLabel, merge_labels
+from py_sexpr.stack_vm import ir as ir_ops
+from py_sexpr.stack_vm.ir import IR, TrackedIR
+from py_sexpr.stack_vm.blockaddr import merge_labels, check_stack_depth, NamedLabel
+from py_sexpr.serialize import TermView
 from sys import version_info
+import sys
 import types
+import threading
+import weakref
+import dis
+from array import array
 
 PY38 = version_info >= (3, 8)
 PY35 = version_info < (3, 6)
+HAS_LOAD_METHOD = version_info >= (3, 7)
+# `GET_AITER` gives an awaitable wrapping the iterator before Python 3.7
+AWAIT_AITER = version_info < (3, 7)
 _app = lambda arg: lambda f: f(arg)
 
 RECORD_TYPE_FIELD = ".t"
 
+# version of the code generation, bumped when the generated code changes,
+# which invalidates the code objects cached by `py_sexpr.importer`
+COMPILER_VERSION = 1
+
+# `switch` with at most this many cases is a chain of comparisons
+SWITCH_CHAIN_MAX = 6
+# `switch` over integer keys with at most this many cases is a binary search,
+# otherwise, case indices are looked up in a `dict` first
+SWITCH_TREE_MAX = 1024
+# cases in a leaf of the binary search
+SWITCH_LEAF_SIZE = 2
+
 
 def scheduling(application):
     GeneratorType = types.GeneratorType
@@ -41,28 +64,39 @@ def scheduling(application):
     return last
 
 
-class NamedObj:
-    def __init__(self, n):
-        self.n = n
-
-    def __repr__(self):
-        return self.n
-
-
-def _new_unique_label(s):
-    """create a label whose identity is its address.
+def scheduling_steps(application, every: int):
+    """Like `scheduling`, but a generator pausing each time
+    `every` sub-terms have been entered.
+    The result of `application` is the return value of the generator.
     """
-
-    # noinspection PyArgumentList
-    return NamedLabel(NamedObj(s))
-
-
-def _new_structural_label(s):
-    """create a label whose identity is its name.
-    """
-
-    # noinspection PyArgumentList
-    return NamedLabel(s)
+    GeneratorType = types.GeneratorType
+    coroutines = [application]
+    append = coroutines.append
+    pop = coroutines.pop
+    last = None
+    entered = 0
+    while coroutines:
+        end = coroutines[-1]
+        try:
+            value = end.send(last)
+            if isinstance(value, GeneratorType):
+                append(value)
+                last = None
+                entered += 1
+                if entered == every:
+                    entered = 0
+                    yield
+            else:
+                last = value
+                pop()
+        except StopIteration as e:
+            if isinstance(e.value, GeneratorType):
+                append(e.value)
+                last = None
+            else:
+                pop()
+                last = e.value
+    return last
 
 
 class SymType(Enum):
@@ -99,18 +133,6 @@ class Analysed:
     syms_bound = None  # type: Dict[str, Sym]
 
 
-def _set_lineno(i: int, f):
-    def apply():
-        instructions = f()
-        Instr = BC.Instr
-        for instr in instructions:
-            if isinstance(instr, Instr):
-                instr.lineno = i
-        return instructions
-
-    return apply
-
-
 @attr.s
 class ScopeSolver:
     """We use a simple scoping rule, that all assignments enter symbols
@@ -176,68 +198,377 @@ class ScopeSolver:
             child.resolve()
 
 
+def format_path(path) -> str:
+    """Format the path of an s-expression node, e.g., `/2/0/1`.
+    The root is `/`.
+    """
+    return "/" + "/".join(map(str, path))
+
+
+def parse_path(s: str) -> tuple:
+    return tuple(int(each) for each in s.split("/") if each)
+
+
+class Origins:
+    """Track which s-expression node each instruction originates from.
+
+    A node is identified by its path, i.e., the indices from the root term to it,
+    which is stable as long as the s-expression stays the same.
+    Indices into a list or a pair inside a term, like `defaults` of `define`,
+    take two steps in the path.
+    """
+
+    def __init__(self):
+        self.paths = []  # type: List[tuple]
+        self.terms = []  # type: list
+        self.irs = []  # type: List[IR]
+        # line, column and filename when visiting each node
+        self.locations = []  # type: List[tuple]
+        # code objects, their instruction offsets and the node of each instruction
+        self.codes = []  # type: List[tuple]
+        self.current = -1
+        self._cursors = {}  # type: Dict[int, int]
+
+    def _child_path(self, parent: int, term) -> tuple:
+        path = self.paths[parent]
+        parent_term = self.terms[parent]
+        n = len(parent_term)
+        start = self._cursors.get(parent, 0)
+        # children are mostly visited in order
+        for k in range(n):
+            i = (start + k) % n
+            if parent_term[i] is term:
+                self._cursors[parent] = i + 1
+                return path + (i,)
+        for i, each in enumerate(parent_term):
+            if isinstance(each, (list, tuple)):
+                for j, elt in enumerate(each):
+                    if elt is term:
+                        return path + (i, j)
+        return path + (-1,)
+
+    def visit(self, builder: "Builder", term):
+        parent = self.current
+        path = () if parent < 0 else self._child_path(parent, term)
+        if isinstance(term, TermView):
+            term = term.unfold()
+        node = len(self.paths)
+        self.paths.append(path)
+        self.terms.append(term)
+        st = builder.st
+        self.locations.append((st.line, st.column, st.filename))
+        self.current = node
+        try:
+            return (yield builder.eval_untracked(term))
+        finally:
+            self.current = parent
+
+    def instruction_counts(self) -> Dict[int, int]:
+        """Number of lowered IR instructions emitted by each node itself."""
+        counts = {}  # type: Dict[int, int]
+        for ir in self.irs:
+            for node in ir.nodes:
+                counts[node] = counts.get(node, 0) + 1
+        return counts
+
+    def map_code(self, code: types.CodeType, node: int, instructions: list, lowered):
+        """Record the node of each instruction of a code object created from `instructions`.
+        `lowered` holds the nodes of `instructions`,
+        and instructions appended by `make_code_obj` are attributed to `node`.
+        """
+        nodes = array("i", lowered)
+        nodes.extend([node] * (len(instructions) - len(nodes)))
+        nodes = array("i", (n for each, n in zip(instructions, nodes) if isinstance(each, BC.Instr)))
+        offsets = array(
+            "i",
+            (each.offset for each in dis.get_instructions(code) if each.opname != "EXTENDED_ARG"),
+        )
+        if len(offsets) != len(nodes):
+            raise ValueError(
+                "{} has {} instructions, but {} were lowered".format(
+                    code.co_name, len(offsets), len(nodes)
+                )
+            )
+        self.codes.append((code, node, offsets, nodes))
+
+
+class Counters:
+    """Hit counters injected into generated code,
+    see `module_code`.
+
+    All counts live in one preallocated `array`, so hitting a counter creates no container,
+    though the `int`s read and written are allocated once counts exceed 256.
+    Counters are placed at each arm of `ite`, each body of `loop` and `for_in`,
+    and each function entry.
+    """
+
+    def __init__(self):
+        self.counts = array("q")
+        self.sites = []  # type: List[tuple]
+
+    def new(self, path: tuple, kind: str) -> int:
+        self.counts.append(0)
+        self.sites.append((path, kind))
+        return len(self.sites) - 1
+
+    def reset(self):
+        counts = self.counts
+        for i in range(len(counts)):
+            counts[i] = 0
+
+    def export(self) -> Dict[str, Dict[str, int]]:
+        """Counts keyed by formatted node paths and counter kinds,
+        e.g., `{"/1/2": {"ite.true": 10, "ite.false": 0}}`.
+        """
+        result = {}  # type: Dict[str, Dict[str, int]]
+        for (path, kind), count in zip(self.sites, self.counts):
+            counts = result.setdefault(format_path(path), {})
+            # a node can be emitted more than once, e.g., the condition of a rotated loop
+            counts[kind] = counts.get(kind, 0) + count
+        return result
+
+
+class Profile:
+    """Branch and loop counts guiding the code layout, see `module_code`.
+
+    `counts` is in the format of `Counters.export`.
+
+    - The more frequent arm of an `ite` falls through.
+    - If an `ite` is hot, i.e., executed at least `hot_threshold` times,
+      and an arm is taken at most `cold_ratio` of the time,
+      the arm is moved out of line, to the end of the function.
+    - Hot `loop`s get rotated, i.e., the condition is duplicated
+      to the bottom, saving a jump per iteration.
+    - Bodies of hot `for_in`s are unrolled twice.
+    """
+
+    def __init__(
+        self,
+        counts: Dict[str, Dict[str, int]],
+        hot_threshold: int = 1000,
+        cold_ratio: float = 0.01,
+    ):
+        self.counts = counts
+        self.hot_threshold = hot_threshold
+        self.cold_ratio = cold_ratio
+
+    def get(self, path: tuple) -> Dict[str, int]:
+        return self.counts.get(format_path(path), {})
+
+    def is_hot(self, count: int) -> bool:
+        return count >= self.hot_threshold
+
+    def is_cold(self, count: int, total: int) -> bool:
+        return self.is_hot(total) and count <= total * self.cold_ratio
+
+
 @attr.s
 class SharedState:
     doc = attr.ib()  # type: str
     line = attr.ib()  # type: int
     filename = attr.ib()  # type: str
+    origins = attr.ib(default=None)  # type: Optional[Origins]
+    counters = attr.ib(default=None)  # type: Optional[Counters]
+    profile = attr.ib(default=None)  # type: Optional[Profile]
+    column = attr.ib(default=0)  # type: int
+    # create nested functions as stubs compiling on first call, see `LazyCode`
+    lazy = attr.ib(default=False)  # type: bool
 
     def copy(self):
-        return SharedState(self.doc, self.line, self.filename)
+        return SharedState(
+            self.doc,
+            self.line,
+            self.filename,
+            self.origins,
+            self.counters,
+            self.profile,
+            self.column,
+            self.lazy,
+        )
+
+
+@attr.s
+class FuncInfo:
+    """A nested function, whose code object is created when lowering."""
+
+    builder = attr.ib()  # type: Builder
+    name = attr.ib()  # type: str
+    anonymous = attr.ib()  # type: bool
+    filename = attr.ib()  # type: str
+    line = attr.ib()  # type: int
+    doc = attr.ib()  # type: str
+    args = attr.ib()  # type: List[str]
+    mk_fn_flag = attr.ib()  # type: int
+    # the `func` node, if tracked
+    node = attr.ib(default=-1)  # type: int
+    is_async = attr.ib(default=False)  # type: bool
 
 
 @attr.s
 class Builder:
     sc = attr.ib()  # type: ScopeSolver
-    builders = attr.ib()  # type: List[Callable[[Analysed], List[BC.Instr]]]
+    ir = attr.ib()  # type: IR
     st = attr.ib()  # type: SharedState
 
-    def __lshift__(self, other: Callable[[], List[Union[BC.Instr, BC.Label]]]):
+    # out-of-line code, emitted after the function body
+    cold = attr.ib(default=attr.Factory(list))  # type: List[tuple]
+    # if emitting an async function
+    is_async = attr.ib(default=False)  # type: bool
+    # targets of `goto`, from names to label ids and if marked
+    labels = attr.ib(default=attr.Factory(dict))  # type: Dict[str, list]
+    # enclosing loops, as (kind, label of break, label of continue)
+    loops = attr.ib(default=attr.Factory(list))  # type: List[tuple]
+    # if any jump needs `check_stack_depth`
+    irregular_jumps = attr.ib(default=False)  # type: bool
+
+    @classmethod
+    def toplevel(cls, st: SharedState) -> "Builder":
+        ir = IR() if st.origins is None else TrackedIR(st.origins)
+        return cls(ScopeSolver.outermost(), ir, st)
 
-        self.builders.append(_set_lineno(self.st.line, other))
+    def emit(self, op: int, arg: int = 0):
+        self.ir.emit(op, arg, self.st.line)
 
-    def build(self):
-        # TODO: detect why `sum(..., [])` not work here
-        seq = []
-        for b in self.builders:
-            seq.extend(b())
+    def emit_const(self, value):
+        ir = self.ir
+        ir.emit(ir_ops.LOAD_CONST, ir.operand(value), self.st.line)
+
+    def emit_name(self, op: int, n: str):
+        ir = self.ir
+        ir.emit(op, ir.name(n), self.st.line)
 
-        n = len(seq)
+    def new_label(self) -> int:
+        return self.ir.new_label()
+
+    def mark(self, label: int):
+        self.ir.emit(ir_ops.LABEL, label, self.st.line)
+
+    def build(self) -> List[Union[BC.Instr, BC.Label]]:
+        """Lower the IR to instructions, after symbols get resolved."""
+        ir = self.ir
+        ir.peephole()
+
+        analysed = self.sc.output
+        operands = ir.operands
+        labels = [BC.Label() for _ in range(ir.n_labels)]
+        for name, (label, marked) in self.labels.items():
+            if not marked:
+                raise ValueError("undefined label {!r}".format(name))
+            labels[label] = NamedLabel(name)
+        arg_kinds = ir_ops.ARG_KINDS
+        opnames = dis.opname
         Instr = BC.Instr
+        LABEL = ir_ops.LABEL
+        LOAD_SYM = ir_ops.LOAD_SYM
+        STORE_SYM = ir_ops.STORE_SYM
+        MAKE_FUNC = ir_ops.MAKE_FUNC
 
-        # remove redundant load/pop pairs
-        def _build(seq):
-            i = 0
-            n = len(seq)
-            while i < n:
-                each = seq[i]
-                if isinstance(each, Instr) and each.name.startswith("LOAD_"):
-                    nxt = i + 1
-                    if nxt < n:
-                        nxt_instr = seq[nxt]
-                        if isinstance(nxt_instr, Instr) and nxt_instr.name == "POP_TOP":
-                            i = nxt + 1
-                            continue
-                yield each
-                i += 1
-
-        while True:
-            seq = list(_build(seq))
-            if len(seq) == n:
-                break
-            n = len(seq)
+        seq = []
+        append = seq.append
+        func_widths = {}  # type: Dict[int, int]
+        for op, arg, line in zip(ir.ops, ir.args, ir.lines):
+            if 0 <= op < 256:
+                kind = arg_kinds[op]
+                if kind == ir_ops.ARG_NONE:
+                    append(Instr(opnames[op], lineno=line))
+                elif kind == ir_ops.ARG_OPERAND:
+                    append(Instr(opnames[op], operands[arg], lineno=line))
+                elif kind == ir_ops.ARG_LABEL:
+                    append(Instr(opnames[op], labels[arg], lineno=line))
+                else:
+                    append(Instr(opnames[op], arg, lineno=line))
+            elif op < 0:
+                # raise for instructions unsupported by current Python
+                append(Instr(ir_ops.opname(op), arg, lineno=line))
+            elif op == LABEL:
+                append(labels[arg])
+            elif op == LOAD_SYM:
+                append(_load_sym(analysed, operands[arg], line))
+            elif op == STORE_SYM:
+                append(_store_sym(analysed, operands[arg], line))
+            elif op == MAKE_FUNC:
+                ins = _make_func(analysed, ir.funcs[arg], line)
+                func_widths[arg] = len(ins)
+                seq.extend(ins)
+            else:
+                raise ValueError(op)
+
+        if self.irregular_jumps:
+            check_stack_depth(seq)
+
+        if isinstance(ir, TrackedIR):
+            lowered = ir.lowered = array("i")
+            for op, arg, node in zip(ir.ops, ir.args, ir.nodes):
+                lowered.extend([node] * (func_widths[arg] if op == MAKE_FUNC else 1))
         return seq
 
+    def profiled(self) -> Dict[str, int]:
+        """Profiled counts of current node."""
+        profile = self.st.profile
+        if profile is None:
+            return {}
+        origins = self.st.origins
+        return profile.get(origins.paths[origins.current])
+
+    def defer(self, label: int, kind: str, term, label_back: int):
+        """Emit `term` out of line, which jumps back to `label_back` when done."""
+        origins = self.st.origins
+        self.cold.append(
+            (label, kind, term, label_back, self.st.line, origins.current, list(self.loops))
+        )
+
+    def body(self, term):
+        """Emit a function body and its out-of-line code."""
+        yield self.eval(term)
+        cold = self.cold
+        if not cold:
+            return
+        self.emit(ir_ops.RETURN_VALUE)
+        origins = self.st.origins
+        current = origins.current
+        while cold:
+            label, kind, term, label_back, self.st.line, origins.current, self.loops = cold.pop(0)
+            self.mark(label)
+            self.count(kind)
+            yield self.eval(term)
+            self.emit(ir_ops.JUMP_ABSOLUTE, label_back)
+        origins.current = current
+        self.loops = []
+
+    def count(self, kind: str):
+        """Count hits of current node, if instrumented."""
+        counters = self.st.counters
+        if counters is None:
+            return
+        i = counters.new(self.st.origins.paths[self.st.origins.current], kind)
+        emit = self.emit
+        self.emit_const(counters.counts)
+        self.emit_const(i)
+        emit(ir_ops.DUP_TOP_TWO)
+        emit(ir_ops.BINARY_SUBSCR)
+        self.emit_const(1)
+        emit(ir_ops.INPLACE[I.BinOp.ADD])
+        emit(ir_ops.ROT_THREE)
+        emit(ir_ops.STORE_SUBSCR)
+
     def inside(self):
-        return Builder(self.sc.sub_scope(), [], self.st.copy(),)
+        return Builder(self.sc.sub_scope(), self.ir.sub(), self.st.copy(),)
 
     def eval(self, term):
+        origins = self.st.origins
+        if origins is not None:
+            return origins.visit(self, term)
+        return self.eval_untracked(term)
+
+    def eval_untracked(self, term):
         if isinstance(term, tuple):
             hd, *tl = term
             if hd == "eval":
                 return (yield self.eval(*tl))
             else:
                 return getattr(self, hd)(*tl)
+        if isinstance(term, TermView):
+            return self.eval(term.unfold())
 
         return self.const(term)
 
@@ -247,98 +578,144 @@ class Builder:
             yield eval(each)
 
     def const(self, value):
-        def build():
-            return [I.LOAD_CONST(value)]
-
-        self << build
+        self.emit_const(value)
 
     def call(self, f, *args):
         yield self.eval(f)
         yield self.eval_all(args)
-        n = len(args)
-
-        def build():
-            i = I.CALL_FUNCTION(n)
-            return [i]
-
-        self << build
+        self.emit(ir_ops.CALL_FUNCTION, len(args))
+
+    def call_method(self, obj, n: str, *args):
+        yield self.eval(obj)
+        if HAS_LOAD_METHOD:
+            self.emit_name(ir_ops.LOAD_METHOD, n)
+            yield self.eval_all(args)
+            self.emit(ir_ops.CALL_METHOD, len(args))
+        else:
+            self.emit_name(ir_ops.LOAD_ATTR, n)
+            yield self.eval_all(args)
+            self.emit(ir_ops.CALL_FUNCTION, len(args))
+
+    def call_kw(self, f, kwnames, *args):
+        kwnames = tuple(kwnames)
+        n_kw = len(kwnames)
+        n_pos = len(args) - n_kw
+        yield self.eval(f)
+        yield self.eval_all(args[:n_pos])
+        if PY35:
+            for name, each in zip(kwnames, args[n_pos:]):
+                self.emit_const(name)
+                yield self.eval(each)
+            self.emit(ir_ops.CALL_FUNCTION, n_pos | n_kw << 8)
+            return
+        yield self.eval_all(args[n_pos:])
+        if not n_kw:
+            self.emit(ir_ops.CALL_FUNCTION, n_pos)
+            return
+        self.emit_const(kwnames)
+        self.emit(ir_ops.CALL_FUNCTION_KW, len(args))
+
+    def call_star(self, f, args, kwargs=None):
+        yield self.eval(f)
+        yield self.eval(args)
+        if kwargs is not None:
+            yield self.eval(kwargs)
+        if PY35:
+            self.emit(ir_ops.CALL_FUNCTION_VAR if kwargs is None else ir_ops.CALL_FUNCTION_VAR_KW, 0)
+        else:
+            # non-tuple arguments and non-dict keywords get converted by the interpreter
+            self.emit(ir_ops.CALL_FUNCTION_EX, 0 if kwargs is None else 1)
 
     def var(self, n: str):
-        analysed = self.sc.output
         self.sc.require(n)
-
-        def build():
-            sym = analysed.syms_bound.get(n)
-            if sym:
-                if sym.ty is SymType.cell:
-                    i = I.LOAD_DEREF(n, I.CellVar)
-                else:
-                    i = I.LOAD_FAST(n)
-                return [i]
-            if n in analysed.syms_free:
-                i = I.LOAD_DEREF(n, I.FreeVar)
-            else:
-                i = I.LOAD_GLOBAL(n)
-            return [i]
-
-        self << build
+        self.emit_name(ir_ops.LOAD_SYM, n)
 
     def tuple(self, *elts):
         yield self.eval_all(elts)
-        n = len(elts)
-        self << (lambda: [I.BUILD_TUPLE(n)])
+        self.emit(ir_ops.BUILD_TUPLE, len(elts))
 
     def record(self, *kwargs):
         n = len(kwargs)
         if not kwargs:
-            self << (lambda: [I.BUILD_MAP(0)])
+            self.emit(ir_ops.BUILD_MAP, 0)
         elif PY35:
             eval = self.eval
             for key, val in kwargs:
                 yield eval(key)
                 yield eval(val)
-            self << (lambda: [I.BUILD_MAP(n)])
+            self.emit(ir_ops.BUILD_MAP, n)
         else:
             keys, vals = zip(*kwargs)
             yield self.eval_all(vals)
             self.const(keys)
-            self << (lambda: [I.BUILD_CONST_KET_MAP(n)])
+            self.emit(ir_ops.BUILD_CONST_KEY_MAP, n)
 
     def lens(self, l, r):
         yield self.eval(l)
         yield self.eval(r)
-        self << (lambda: [I.BUILD_MAP_UNPACK(2)])
+        self.emit(ir_ops.BUILD_MAP_UNPACK, 2)
 
     def assign_star(self, n: str, v):
         yield self.eval(v)
         self._bind(n, True)
-        self << (lambda: [I.LOAD_CONST(None)])
+        self.emit_const(None)
 
     def assign(self, n: str, v):
         yield self.eval(v)
         self._bind(n, False)
-        self << (lambda: [I.LOAD_CONST(None)])
+        self.emit_const(None)
 
     def get_attr(self, val, n: str):
         yield self.eval(val)
-        self << (lambda: [I.LOAD_ATTR(n)])
+        self.emit_name(ir_ops.LOAD_ATTR, n)
 
     def set_attr(self, base, n: str, val):
         yield self.eval(val)
         yield self.eval(base)
-        self << (lambda: [I.STORE_ATTR(n), I.LOAD_CONST(None)])
+        self.emit_name(ir_ops.STORE_ATTR, n)
+        self.emit_const(None)
 
     def get_item(self, base, item: str):
         yield self.eval(base)
         yield self.eval(item)
-
-        self << (lambda: [I.BINARY(I.BinOp.SUBSCR)])
+        self.emit(ir_ops.BINARY_SUBSCR)
 
     def set_item(self, base, item, val):
         yield self.eval(val)
         yield self.eval(base)
         yield self.eval(item)
-        self << (lambda: [I.STORE_SUBSCR(), I.LOAD_CONST(None)])
+        self.emit(ir_ops.STORE_SUBSCR)
+        self.emit_const(None)
+
+    def aug_assign(self, n: str, op: I.BinOp, val):
+        self.var(n)
+        yield self.eval(val)
+        self.emit(ir_ops.INPLACE[op])
+        self._bind(n, False)
+        self.emit_const(None)
+
+    def aug_set_attr(self, base, n: str, op: I.BinOp, val):
+        emit = self.emit
+        yield self.eval(base)
+        emit(ir_ops.DUP_TOP)
+        self.emit_name(ir_ops.LOAD_ATTR, n)
+        yield self.eval(val)
+        emit(ir_ops.INPLACE[op])
+        emit(ir_ops.ROT_TWO)
+        self.emit_name(ir_ops.STORE_ATTR, n)
+        self.emit_const(None)
+
+    def aug_set_item(self, base, item, op: I.BinOp, val):
+        emit = self.emit
+        yield self.eval(base)
+        yield self.eval(item)
+        emit(ir_ops.DUP_TOP_TWO)
+        emit(ir_ops.BINARY_SUBSCR)
+        yield self.eval(val)
+        emit(ir_ops.INPLACE[op])
+        emit(ir_ops.ROT_THREE)
+        emit(ir_ops.STORE_SUBSCR)
+        self.emit_const(None)
 
     def new(self, ty, *args):
         """
@@ -353,61 +730,87 @@ class Builder:
         yield self.eval(ty)
 
         # build this object
-        self << (lambda: [I.DUP()])
+        self.emit(ir_ops.DUP_TOP)
 
         yield self.eval_all(args)
         n = len(args) + 1
 
         # initialize this object
-        self << (
-            lambda: [
-                I.BUILD_MAP(0),
-                I.CALL_FUNCTION(n),
-                I.DUP(),
-                I.ROT3(),
-                I.LOAD_CONST(RECORD_TYPE_FIELD),
-                I.STORE_SUBSCR(),
-            ]
-        )
+        emit = self.emit
+        emit(ir_ops.BUILD_MAP, 0)
+        emit(ir_ops.CALL_FUNCTION, n)
+        emit(ir_ops.DUP_TOP)
+        emit(ir_ops.ROT_THREE)
+        self.emit_const(RECORD_TYPE_FIELD)
+        emit(ir_ops.STORE_SUBSCR)
 
     def un(self, op: I.UOp, term):
         """emit unary operation"""
         yield self.eval(term)
-        self << (lambda: [I.UNARY(op)])
+        self.emit(ir_ops.UNARY[op])
 
     def bin(self, l, op: I.BinOp, r):
         """emit binary operation"""
         yield self.eval(l)
         yield self.eval(r)
-        self << (lambda: [I.BINARY(op)])
+        self.emit(ir_ops.BINARY[op])
 
-    def cmp(self, l, op: BC.Compare, r):
+    def cmp(self, l, op: BC.Compare, r, *more):
+        ir = self.ir
+        emit = self.emit
         yield self.eval(l)
         yield self.eval(r)
-        self << (lambda: [I.COMPARE_OP(op)])
-
-    def _bind(self, n: str, bound: bool):
-        analysed = self.sc.output
+        if not more:
+            ir.emit(ir_ops.COMPARE_OP, ir.operand(op), self.st.line)
+            return
+
+        # a chained comparison keeps each operand for the next comparison
+        label_cleanup = self.new_label()
+        label_end = self.new_label()
+        for i in range(0, len(more), 2):
+            emit(ir_ops.DUP_TOP)
+            emit(ir_ops.ROT_THREE)
+            ir.emit(ir_ops.COMPARE_OP, ir.operand(op), self.st.line)
+            emit(ir_ops.JUMP_IF_FALSE_OR_POP, label_cleanup)
+            op = more[i]
+            yield self.eval(more[i + 1])
+        ir.emit(ir_ops.COMPARE_OP, ir.operand(op), self.st.line)
+        emit(ir_ops.JUMP_FORWARD, label_end)
+        self.mark(label_cleanup)
+        emit(ir_ops.ROT_TWO)
+        emit(ir_ops.POP_TOP)
+        self.mark(label_end)
+
+    def _short_circuit(self, terms: tuple, empty: bool, jump: int):
+        if not terms:
+            return self.const(empty)
+        label_end = self.new_label()
+        *init, end = terms
+        for each in init:
+            yield self.eval(each)
+            self.emit(jump, label_end)
+        yield self.eval(end)
+        self.mark(label_end)
+
+    def and_(self, *terms):
+        return self._short_circuit(terms, True, ir_ops.JUMP_IF_FALSE_OR_POP)
+
+    def or_(self, *terms):
+        return self._short_circuit(terms, False, ir_ops.JUMP_IF_TRUE_OR_POP)
+
+    def _bind(self, n: Union[str, list], bound: bool):
+        if not isinstance(n, str):
+            # a pattern, which is a list or a tuple
+            elts = tuple(n)
+            self.emit(ir_ops.UNPACK_SEQUENCE, len(elts))
+            for each in elts:
+                self._bind(each, bound)
+            return
         if bound:
             self.sc.enter(n)
         else:
             self.sc.require(n)
-
-        def build():
-            sym = analysed.syms_bound.get(n)
-            if sym:
-                if sym.ty is SymType.cell:
-                    i = I.STORE_DEREF(n, I.CellVar)
-                else:
-                    i = I.STORE_FAST(n)
-                return [i]
-            if n in analysed.syms_free:
-                i = I.STORE_DEREF(n, I.FreeVar)
-            else:
-                i = I.STORE_GLOBAL(n)
-            return [i]
-
-        self << build
+        self.emit_name(ir_ops.STORE_SYM, n)
 
     def block(self, *suite):
         if not suite:
@@ -415,15 +818,17 @@ class Builder:
         *init, end = suite
         for each in init:
             yield self.eval(each)
-            self << (lambda: [I.POP_TOP()])
+            self.emit(ir_ops.POP_TOP)
         yield self.eval(end)
 
     def doc(self, doc: str, it):
         self.st.doc = doc
         return (yield self.eval(it))
 
-    def line(self, line: int, it):
+    def line(self, line: int, it, column: int = None):
         self.st.line = line
+        if column is not None:
+            self.st.column = column
         return (yield self.eval(it))
 
     def filename(self, fname: str, it):
@@ -431,41 +836,327 @@ class Builder:
         return (yield self.eval(it))
 
     def ite(self, cond, true_clause, false_clause):
-        label_true = _new_unique_label("if.true")
-        label_end = _new_unique_label("if.end")
+        label_other = self.new_label()
+        label_end = self.new_label()
+
+        # the likely arm falls through
+        jump = ir_ops.POP_JUMP_IF_TRUE
+        likely, likely_kind = false_clause, "ite.false"
+        other, other_kind = true_clause, "ite.true"
+        counts = self.profiled()
+        n_true = counts.get("ite.true", 0)
+        n_false = counts.get("ite.false", 0)
+        if n_true > n_false:
+            jump = ir_ops.POP_JUMP_IF_FALSE
+            likely, likely_kind, other, other_kind = other, other_kind, likely, likely_kind
+            n_true, n_false = n_false, n_true
 
         yield self.eval(cond)
-        self << (lambda: [I.POP_JUMP_IF_TRUE(label_true)])
-        yield self.eval(false_clause)
-        self << (lambda: [I.JUMP_ABSOLUTE(label_end), label_true])
-        yield self.eval(true_clause)
-        self << (lambda: [label_end])
+        self.emit(jump, label_other)
+        self.count(likely_kind)
+        yield self.eval(likely)
+        if counts and self.st.profile.is_cold(n_true, n_true + n_false):
+            self.mark(label_end)
+            self.defer(label_other, other_kind, other, label_end)
+            return
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_end)
+        self.mark(label_other)
+        self.count(other_kind)
+        yield self.eval(other)
+        self.mark(label_end)
+
+    def _switch_leaf(self, keys: list, labels: list, label_default: int):
+        ir = self.ir
+        emit = self.emit
+        eq = ir.operand(BC.Compare.EQ)
+        for key, label in zip(keys, labels):
+            emit(ir_ops.DUP_TOP)
+            self.emit_const(key)
+            ir.emit(ir_ops.COMPARE_OP, eq, self.st.line)
+            emit(ir_ops.POP_JUMP_IF_TRUE, label)
+        emit(ir_ops.JUMP_ABSOLUTE, label_default)
+
+    def _switch_tree(self, keys: list, labels: list, label_default: Optional[int]):
+        """Binary search of sorted integer keys.
+        Without `label_default`, the value is known to be one of the keys.
+        """
+        ir = self.ir
+        lt = ir.operand(BC.Compare.LT)
+        # ranges of keys to search, the left half is emitted after the right one
+        todo = [(0, len(keys), None)]
+        while todo:
+            low, high, label = todo.pop()
+            if label is not None:
+                self.mark(label)
+            if label_default is None and high - low == 1:
+                self.emit(ir_ops.JUMP_ABSOLUTE, labels[low])
+            elif label_default is not None and high - low <= SWITCH_LEAF_SIZE:
+                self._switch_leaf(keys[low:high], labels[low:high], label_default)
+            else:
+                mid = (low + high) // 2
+                label_left = self.new_label()
+                self.emit(ir_ops.DUP_TOP)
+                self.emit_const(keys[mid])
+                ir.emit(ir_ops.COMPARE_OP, lt, self.st.line)
+                self.emit(ir_ops.POP_JUMP_IF_TRUE, label_left)
+                todo.append((low, mid, label_left))
+                todo.append((mid, high, None))
+
+    def switch(self, value, keys, default, *bodies):
+        # the first case of equal keys wins
+        indices = {}  # type: Dict[object, int]
+        for i, key in enumerate(keys):
+            indices.setdefault(key, i)
+        labels = [self.new_label() for _ in bodies]
+        label_default = self.new_label()
+        label_end = self.new_label()
+        unique_keys = list(indices)
+        unique_labels = [labels[i] for i in indices.values()]
+        n = len(unique_keys)
+
+        if n <= SWITCH_CHAIN_MAX:
+            yield self.eval(value)
+            self._switch_leaf(unique_keys, unique_labels, label_default)
+        elif n <= SWITCH_TREE_MAX and all(type(key) is int for key in unique_keys):
+            yield self.eval(value)
+            pairs = sorted(zip(unique_keys, unique_labels))
+            self._switch_tree([k for k, _ in pairs], [l for _, l in pairs], label_default)
+        else:
+            # look up the index of the case, where `n` stands for the default
+            table = {key: i for i, key in enumerate(unique_keys)}
+            self.emit_const(table)
+            if HAS_LOAD_METHOD:
+                self.emit_name(ir_ops.LOAD_METHOD, "get")
+            else:
+                self.emit_name(ir_ops.LOAD_ATTR, "get")
+            yield self.eval(value)
+            self.emit_const(n)
+            self.emit(ir_ops.CALL_METHOD if HAS_LOAD_METHOD else ir_ops.CALL_FUNCTION, 2)
+            self._switch_tree(list(range(n + 1)), unique_labels + [label_default], None)
+
+        for i in indices.values():
+            self.mark(labels[i])
+            self.emit(ir_ops.POP_TOP)
+            yield self.eval(bodies[i])
+            self.emit(ir_ops.JUMP_ABSOLUTE, label_end)
+        self.mark(label_default)
+        self.emit(ir_ops.POP_TOP)
+        yield self.eval(default)
+        self.mark(label_end)
 
     def for_in(self, n: str, seq, body):
-        label_end = _new_unique_label("end.loop")
-        label_iter = _new_unique_label("iter.loop")
+        label_end = self.new_label()
+        label_iter = self.new_label()
+
+        # unroll hot loops
+        unroll = 1
+        counts = self.profiled()
+        # labels are unique per function, hence bodies with labels are emitted once
+        if (
+            counts
+            and self.st.profile.is_hot(counts.get("for_in.body", 0))
+            and not _has_label(body)
+        ):
+            unroll = 2
 
         yield self.eval(seq)
-        self << (lambda: [I.GET_ITER(), label_iter, I.FOR_ITER(label_end)])
-
+        self.emit(ir_ops.GET_ITER)
+        self.mark(label_iter)
+        for _ in range(unroll):
+            self.emit(ir_ops.FOR_ITER, label_end)
+            self._bind(n, bound=False)
+            self.count("for_in.body")
+            yield self._loop_body("for_in", label_end, label_iter, body)
+            self.emit(ir_ops.POP_TOP)
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_iter)
+        self.mark(label_end)
+        self.emit_const(None)
+
+    def _comp(self, n: str, seq, elts: tuple, cond, build: int, add: int):
+        label_end = self.new_label()
+        label_iter = self.new_label()
+
+        self.emit(build, 0)
+        yield self.eval(seq)
+        self.emit(ir_ops.GET_ITER)
+        self.mark(label_iter)
+        self.emit(ir_ops.FOR_ITER, label_end)
         self._bind(n, bound=False)
+        if cond is not None:
+            yield self.eval(cond)
+            self.emit(ir_ops.POP_JUMP_IF_FALSE, label_iter)
+        yield self.eval_all(elts)
+        # the collection is below the iterator
+        self.emit(add, 2)
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_iter)
+        self.mark(label_end)
+
+    def list_comp(self, n: str, seq, elt, cond=None):
+        return self._comp(n, seq, (elt,), cond, ir_ops.BUILD_LIST, ir_ops.LIST_APPEND)
+
+    def set_comp(self, n: str, seq, elt, cond=None):
+        return self._comp(n, seq, (elt,), cond, ir_ops.BUILD_SET, ir_ops.SET_ADD)
+
+    def dict_comp(self, n: str, seq, key, value, cond=None):
+        # `MAP_ADD` takes the value on the top since Python 3.8
+        elts = (key, value) if PY38 else (value, key)
+        return self._comp(n, seq, elts, cond, ir_ops.BUILD_MAP, ir_ops.MAP_ADD)
+
+    def _named_label(self, name: str) -> list:
+        entry = self.labels.get(name)
+        if entry is None:
+            entry = self.labels[name] = [self.new_label(), False]
+        return entry
+
+    def label(self, name: str):
+        entry = self._named_label(name)
+        if entry[1]:
+            raise ValueError("duplicate label {!r}".format(name))
+        entry[1] = True
+        self.irregular_jumps = True
+        self.mark(entry[0])
+        self.emit_const(None)
+
+    def goto(self, name: str):
+        self.irregular_jumps = True
+        self.emit(ir_ops.JUMP_ABSOLUTE, self._named_label(name)[0])
+        # unreachable, but keeps the stack shape of an expression
+        self.emit_const(None)
+
+    def _loop_body(self, kind: str, label_break: int, label_continue: int, body):
+        loops = self.loops
+        loops.append((kind, label_break, label_continue))
         yield self.eval(body)
-        self << (
-            lambda: [
-                I.POP_TOP(),
-                I.JUMP_ABSOLUTE(label_iter),
-                label_end,
-                I.LOAD_CONST(None),
-            ]
-        )
+        loops.pop()
+
+    def _innermost_loop(self, hd: str) -> tuple:
+        if not self.loops:
+            raise ValueError("{} outside loop".format(hd))
+        self.irregular_jumps = True
+        return self.loops[-1]
+
+    def break_(self, value=None):
+        kind, label_break, _ = self._innermost_loop("break_")
+        if kind == "loop":
+            # the value of the loop
+            yield self.eval(value)
+        elif value is not None:
+            raise ValueError("break_ of {} takes no value".format(kind))
+        else:
+            # pop the iterator
+            self.emit(ir_ops.POP_TOP)
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_break)
+        self.emit_const(None)
+
+    def continue_(self):
+        kind, _, label_continue = self._innermost_loop("continue_")
+        if kind == "loop":
+            # in place of the value of the body
+            self.emit_const(None)
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_continue)
+        self.emit_const(None)
 
     def ret(self, v):
         yield self.eval(v)
-        self << (lambda: [I.RETURN_VALUE(), I.LOAD_CONST(None)])
+        self.emit(ir_ops.RETURN_VALUE)
+        self.emit_const(None)
+
+    def _check_in_function(self, hd: str):
+        if self.sc.parent is None:
+            raise ValueError("{} outside function".format(hd))
+
+    def yield_(self, v=None):
+        """The code object becomes a generator, see `make_code_obj`."""
+        self._check_in_function("yield_")
+        yield self.eval(v)
+        self.emit(ir_ops.YIELD_VALUE)
+
+    def yield_from(self, v):
+        self._check_in_function("yield_from")
+        if self.is_async:
+            raise ValueError("yield_from inside async function")
+        yield self.eval(v)
+        self.emit(ir_ops.GET_YIELD_FROM_ITER)
+        self.emit_const(None)
+        self.emit(ir_ops.YIELD_FROM)
+
+    def _check_async(self, hd: str):
+        if not self.is_async:
+            raise ValueError("{} outside async function".format(hd))
+
+    def await_(self, v):
+        self._check_async("await_")
+        yield self.eval(v)
+        self.emit(ir_ops.GET_AWAITABLE)
+        self.emit_const(None)
+        self.emit(ir_ops.YIELD_FROM)
+
+    def async_for_in(self, n: str, seq, body):
+        self._check_async("async_for_in")
+        emit = self.emit
+        label_iter = self.new_label()
+        label_end = self.new_label()
+        label_exit = self.new_label()
+
+        yield self.eval(seq)
+        emit(ir_ops.GET_AITER)
+        if AWAIT_AITER:
+            self.emit_const(None)
+            emit(ir_ops.YIELD_FROM)
+        self.mark(label_iter)
+        if PY38:
+            # `END_ASYNC_FOR` pops the iterator if `StopAsyncIteration` is raised
+            emit(ir_ops.SETUP_FINALLY, label_end)
+            emit(ir_ops.GET_ANEXT)
+            self.emit_const(None)
+            emit(ir_ops.YIELD_FROM)
+            emit(ir_ops.POP_BLOCK)
+            self._bind(n, bound=False)
+            yield self._loop_body("async_for_in", label_exit, label_iter, body)
+            emit(ir_ops.POP_TOP)
+            emit(ir_ops.JUMP_ABSOLUTE, label_iter)
+            self.mark(label_end)
+            emit(ir_ops.END_ASYNC_FOR)
+            self.mark(label_exit)
+            self.emit_const(None)
+            return
+
+        label_except = self.new_label()
+        label_body = self.new_label()
+        emit(ir_ops.SETUP_EXCEPT, label_except)
+        emit(ir_ops.GET_ANEXT)
+        self.emit_const(None)
+        emit(ir_ops.YIELD_FROM)
+        self._bind(n, bound=False)
+        emit(ir_ops.POP_BLOCK)
+        emit(ir_ops.JUMP_FORWARD, label_body)
+
+        # re-raise unless it's `StopAsyncIteration`
+        self.mark(label_except)
+        emit(ir_ops.DUP_TOP)
+        self.emit_name(ir_ops.LOAD_GLOBAL, "StopAsyncIteration")
+        ir = self.ir
+        ir.emit(ir_ops.COMPARE_OP, ir.operand(BC.Compare.EXC_MATCH), self.st.line)
+        emit(ir_ops.POP_JUMP_IF_TRUE, label_end)
+        emit(ir_ops.END_FINALLY)
+
+        self.mark(label_body)
+        yield self._loop_body("async_for_in", label_exit, label_iter, body)
+        emit(ir_ops.POP_TOP)
+        emit(ir_ops.JUMP_ABSOLUTE, label_iter)
+
+        # pop the exception, the handler block and the iterator
+        self.mark(label_end)
+        for _ in range(3):
+            emit(ir_ops.POP_TOP)
+        emit(ir_ops.POP_EXCEPT)
+        emit(ir_ops.POP_TOP)
+        self.mark(label_exit)
+        self.emit_const(None)
 
     def throw(self, v):
         yield self.eval(v)
-        self << (lambda: [I.RAISE_VARARGS(1)])
+        self.emit(ir_ops.RAISE_VARARGS, 1)
         self.const(None)
 
     def loop(self, cond, body):
@@ -479,16 +1170,48 @@ class Builder:
             }
         The value of `f` is 8
         """
-        label_setup = _new_unique_label("while.setup")
-        label_end = _new_unique_label("while.end")
-
-        self << (lambda: [I.LOAD_CONST(None), label_setup])
+        label_setup = self.new_label()
+        label_end = self.new_label()
+
+        counts = self.profiled()
+        if (
+            counts
+            and self.st.profile.is_hot(counts.get("loop.body", 0))
+            and not _has_label(cond)
+        ):
+            # rotate hot loops, whose conditions get emitted twice
+            self.emit_const(None)
+            yield self.eval(cond)
+            self.emit(ir_ops.POP_JUMP_IF_FALSE, label_end)
+            self.mark(label_setup)
+            self.emit(ir_ops.POP_TOP)
+            self.count("loop.body")
+            label_cond = self.new_label()
+            yield self._loop_body("loop", label_end, label_cond, body)
+            self.mark(label_cond)
+            yield self.eval(cond)
+            self.emit(ir_ops.POP_JUMP_IF_TRUE, label_setup)
+            self.mark(label_end)
+            return
+
+        self.emit_const(None)
+        self.mark(label_setup)
         yield self.eval(cond)
-        self << (lambda: [I.POP_JUMP_IF_FALSE(label_end), I.POP_TOP()])
-        yield self.eval(body)
-        self << (lambda: [I.JUMP_ABSOLUTE(label_setup), label_end])
-
-    def func(self, args: List[str], body, name: str = None, defaults: list = ()):
+        self.emit(ir_ops.POP_JUMP_IF_FALSE, label_end)
+        self.emit(ir_ops.POP_TOP)
+        self.count("loop.body")
+        yield self._loop_body("loop", label_end, label_setup, body)
+        self.emit(ir_ops.JUMP_ABSOLUTE, label_setup)
+        self.mark(label_end)
+
+    def func(
+        self,
+        args: List[str],
+        body,
+        name: str = None,
+        defaults: list = (),
+        is_async: bool = False,
+    ):
         line = self.st.line
         filename = self.st.filename
         doc = self.st.doc
@@ -510,78 +1233,219 @@ class Builder:
 
                 for each in defaults:
                     yield self.eval(each)
-                n_defaults = len(defaults)
-
-                def build_defaults():
-                    i = I.BUILD_TUPLE(n_defaults)
-                    i.lineno = line
-                    return [i]
-
-                self << build_defaults
+                self.ir.emit(ir_ops.BUILD_TUPLE, len(defaults), line)
         sub = self.inside()
+        sub.is_async = is_async
 
         # visit arguments
         sub_sc_enter = sub.sc.enter
         for each in args:
             sub_sc_enter(each)
 
-        yield sub.eval(body)
+        sub.count("func.entry")
+        yield sub.body(body)
+
+        ir = self.ir
+        info = FuncInfo(sub, name, anonymous, filename, line, doc, args, mk_fn_flag)
+        info.is_async = is_async
+        if self.st.origins is not None:
+            info.node = self.st.origins.current
+        ir.funcs.append(info)
+        self.emit(ir_ops.MAKE_FUNC, len(ir.funcs) - 1)
+
+
+def _has_label(term) -> bool:
+    """If a `label` term is inside `term`."""
+    stack = [term]
+    while stack:
+        term = stack.pop()
+        if isinstance(term, (tuple, TermView)):
+            if len(term) and term[0] == "label":
+                return True
+            stack.extend(term)
+        elif isinstance(term, list):
+            stack.extend(term)
+    return False
+
+
+def _load_sym(analysed: Analysed, n: str, line: int):
+    sym = analysed.syms_bound.get(n)
+    if sym:
+        if sym.ty is SymType.cell:
+            i = I.LOAD_DEREF(n, I.CellVar)
+        else:
+            i = I.LOAD_FAST(n)
+    elif n in analysed.syms_free:
+        i = I.LOAD_DEREF(n, I.FreeVar)
+    else:
+        i = I.LOAD_GLOBAL(n)
+    i.lineno = line
+    return i
+
+
+def _store_sym(analysed: Analysed, n: str, line: int):
+    sym = analysed.syms_bound.get(n)
+    if sym:
+        if sym.ty is SymType.cell:
+            i = I.STORE_DEREF(n, I.CellVar)
+        else:
+            i = I.STORE_FAST(n)
+    elif n in analysed.syms_free:
+        i = I.STORE_DEREF(n, I.FreeVar)
+    else:
+        i = I.STORE_GLOBAL(n)
+    i.lineno = line
+    return i
+
+
+def _make_func(analysed: Analysed, info: FuncInfo, line: int):
+    mk_fn_flag = info.mk_fn_flag
+    name = info.name
+    sub = info.builder
+    sub_a = sub.sc.output
+    ins = []
+    frees = list(sub_a.syms_free)
+
+    # get all cell names from bound variables
+    cells = [n for n, sym in sub_a.syms_bound.items() if sym.ty is SymType.cell]
+
+    if frees:  # handle closure conversions
+        if not PY35:
+            mk_fn_flag |= I.MK_FN_HAS_CLOSURE
+
+        for n in frees:
+            if n in analysed.syms_bound:
+                var_type = I.CellVar
+            else:
+                var_type = I.FreeVar
+            ins.append(I.LOAD_CLOSURE(n, var_type))
+        ins.append(I.BUILD_TUPLE(len(frees)))
+
+    # create code object of subroutine,
+    # stubs of generators and coroutines would not have their code flags
+    if sub.st.lazy and not info.is_async and not _yields(sub.ir):
+        lazy = LazyCode(info, frees, cells)
+        py_code = lazy.stub()
+    else:
+        lazy = None
+        py_code = _func_code(info, frees, cells)
+    ins.extend(
+        [
+            I.LOAD_CONST(py_code),
+            I.LOAD_CONST(name),
+            I.MAKE_CLOSURE(mk_fn_flag) if PY35 and frees else I.MAKE_FUNCTION(mk_fn_flag),
+        ]
+    )
+    if lazy is not None:
+        ins.extend([I.LOAD_CONST(lazy.register), I.ROT2(), I.CALL_FUNCTION(1)])
+
+    # if not anonymous function,
+    # we shall assign the function to a variable
+    if not info.anonymous:
+        fn_sym = analysed.syms_bound.get(name)
+        if not fn_sym:
+            store = I.STORE_GLOBAL(name)
+        elif fn_sym.ty is SymType.bound:
+            store = I.STORE_FAST(name)
+        elif fn_sym.ty is SymType.cell:
+            store = I.STORE_DEREF(name, I.CellVar)
+        else:
+            raise ValueError
+        ins.extend([I.DUP(), store])
+
+    for each in ins:
+        each.lineno = line
+    return ins
+
+
+def _yields(ir: IR) -> bool:
+    return any(op in (ir_ops.YIELD_VALUE, ir_ops.YIELD_FROM) for op in ir.ops)
+
+
+def _func_code(info: FuncInfo, frees: List[str], cells: List[str]) -> types.CodeType:
+    sub = info.builder
+    instructions = sub.build()
+    py_code = make_code_obj(
+        info.name,
+        info.filename,
+        info.line,
+        info.doc,
+        info.args,
+        frees,
+        cells,
+        instructions,
+        info.is_async,
+    )
+    if isinstance(sub.ir, TrackedIR):
+        sub.ir.origins.map_code(py_code, info.node, instructions, sub.ir.lowered)
+    return py_code
 
-        analysed = self.sc.output
 
-        def build_mk_func():
-            nonlocal mk_fn_flag
-            sub_a = sub.sc.output
-            ins = []
-            frees = list(sub_a.syms_free)
-
-            # get all cell names from bound variables
-            cells = [n for n, sym in sub_a.syms_bound.items() if sym.ty is SymType.cell]
-
-            if frees:  # handle closure conversions
-                if not PY35:
-                    mk_fn_flag |= I.MK_FN_HAS_CLOSURE
-
-                for n in frees:
-                    if n in analysed.syms_bound:
-                        var_type = I.CellVar
-                    else:
-                        var_type = I.FreeVar
-                    ins.append(I.LOAD_CLOSURE(n, var_type))
-                ins.append(I.BUILD_TUPLE(len(frees)))
-
-            # create code object of subroutine
-            instructions = sub.build()
-            py_code = make_code_obj(
-                name, filename, line, doc, args, frees, cells, instructions
-            )
-            ins.extend(
-                [
-                    I.LOAD_CONST(py_code),
-                    I.LOAD_CONST(name),
-                    I.MAKE_CLOSURE(mk_fn_flag)
-                    if PY35 and frees
-                    else I.MAKE_FUNCTION(mk_fn_flag),
-                ]
-            )
+class LazyCode:
+    """The code object of a nested function, lowered on its first call.
 
-            # if not anonymous function,
-            # we shall assign the function to a variable
-            if not anonymous:
-                fn_sym = analysed.syms_bound.get(name)
-                if not fn_sym:
-                    store = I.STORE_GLOBAL(name)
-                elif fn_sym.ty is SymType.bound:
-                    store = I.STORE_FAST(name)
-                elif fn_sym.ty is SymType.cell:
-                    store = I.STORE_DEREF(name, I.CellVar)
-                else:
-                    raise ValueError
-                ins.extend([I.DUP(), store])
+    Functions are created with a stub code object, which has the same arguments
+    and free variables, and calls `LazyCode` with its closure and arguments.
+    The first call lowers the body, and sets `__code__` of every function
+    created from the stub so far; functions created later get the code when registered.
+    Concurrent first calls lower the body once, under a lock.
+    Generators and async functions are not lazy, as code flags like `CO_GENERATOR`
+    tell callers, e.g., `inspect` and `asyncio`, how to call them.
+    """
 
-            return ins
+    def __init__(self, info: FuncInfo, frees: List[str], cells: List[str]):
+        self.info = info  # type: Optional[FuncInfo]
+        self.frees = frees
+        self.cells = cells
+        self.code = None  # type: Optional[types.CodeType]
+        self.functions = weakref.WeakSet()  # type: Optional[weakref.WeakSet]
+        self.lock = threading.Lock()
+
+    def stub(self) -> types.CodeType:
+        info = self.info
+        ins = [I.LOAD_CONST(self)]
+        if self.frees:
+            ins.extend(I.LOAD_CLOSURE(n, I.FreeVar) for n in self.frees)
+            ins.append(I.BUILD_TUPLE(len(self.frees)))
+        else:
+            ins.append(I.LOAD_CONST(None))
+        ins.extend(I.LOAD_FAST(n) for n in info.args)
+        ins.append(I.CALL_FUNCTION(len(info.args) + 1))
+        for each in ins:
+            each.lineno = info.line
+        return make_code_obj(
+            info.name, info.filename, info.line, info.doc, info.args, self.frees, [], ins
+        )
 
-        self << build_mk_func
+    def compile(self) -> types.CodeType:
+        """Lower the body if not yet, and replace the stub of registered functions."""
+        code = self.code
+        if code is not None:
+            return code
+        with self.lock:
+            if self.code is None:
+                code = _func_code(self.info, self.frees, self.cells)
+                for fn in self.functions:
+                    fn.__code__ = code
+                # release the builder
+                self.code, self.info, self.functions = code, None, None
+        return self.code
+
+    def register(self, fn: types.FunctionType) -> types.FunctionType:
+        code = self.code
+        if code is None:
+            with self.lock:
+                code = self.code
+                if code is None:
+                    self.functions.add(fn)
+                    return fn
+        fn.__code__ = code
+        return fn
+
+    def __call__(self, closure, *args):
+        code = self.compile()
+        f_globals = sys._getframe(1).f_globals
+        return types.FunctionType(code, f_globals, code.co_name, None, closure)(*args)
 
 
 def make_code_obj(
@@ -593,8 +1457,10 @@ def make_code_obj(
     frees: List[str],
     cells: List[str],
     instructions: List[BC.Instr],
+    is_async: bool = False,
 ):
-    """Create code object from given metadata and instructions
+    """Create code object from given metadata and instructions.
+    If `is_async`, it's a coroutine, or an async generator if yielding.
     """
     if not instructions:
         instructions.append(I.LOAD_CONST(None))
@@ -613,31 +1479,134 @@ def make_code_obj(
     stack_size = bc_code.compute_stacksize()
 
     c_code = bc_code.to_concrete_bytecode()
-    c_code.flags = BC.flags.infer_flags(c_code)
+    # a code object yielding is a generator
+    c_code.flags = BC.flags.infer_flags(c_code, is_async)
     py_code = c_code.to_code(stacksize=stack_size)
     return py_code
 
 
+def toplevel_builder(sexpr, st: SharedState) -> Builder:
+    """Emit a top-level s-expression and resolve its symbols, ready for `Builder.build`.
+
+    All symbols of the outermost scope are globals,
+    hence a top-level s-expression can be compiled without knowing its siblings.
+    """
+    module_builder = Builder.toplevel(st)
+
+    # incompletely build instruction
+    scheduling(module_builder.body(sexpr))
+
+    # resolve symbols, complete building requirements
+    module_builder.sc.resolve()
+    return module_builder
+
+
+def toplevel_instructions(sexpr, st: SharedState) -> List[BC.Instr]:
+    """Compile a top-level s-expression into instructions."""
+    return toplevel_builder(sexpr, st).build()
+
+
 def module_code(
     sexpr,
     name: str = "<unknown>",
     filename: str = "<unknown>",
     lineno: int = 1,
     doc: str = "",
+    origins: Optional[Origins] = None,
+    counters: Optional[Counters] = None,
+    profile: Optional[Profile] = None,
+    lazy: bool = False,
 ):
     """Create a module's code object from given metadata and s-expression.
+
+    If `origins` is given, it records the s-expression node of each instruction,
+    see also `py_sexpr.stack_vm.sourcemap`.
+
+    If `counters` is given, the code is instrumented with hit counters.
+    As counters are referenced as constants, instrumented code cannot be marshalled.
+
+    If `profile` is given, it guides the code layout of branches and loops.
+
+    If `lazy`, the bodies of nested functions other than generators and async functions
+    are lowered on their first calls, see `LazyCode`. Bodies are still emitted to resolve closures,
+    and lazy code cannot be marshalled either.
     """
-    module_builder = Builder(
-        ScopeSolver.outermost(), [], SharedState(doc, lineno, filename)
-    )
+    if (counters is not None or profile is not None) and origins is None:
+        origins = Origins()
+    st = SharedState(doc, lineno, filename, origins, counters, profile, lazy=lazy)
+    root = -1 if origins is None else len(origins.paths)
+    builder = toplevel_builder(sexpr, st)
+    return toplevel_code(builder, root, name, filename, lineno, doc)
 
-    # incompletely build instruction
-    scheduling(module_builder.eval(sexpr))
 
-    # resolve symbols, complete building requirements
-    module_builder.sc.resolve()
+def toplevel_code(
+    builder: Builder, root: int, name: str, filename: str, lineno: int, doc: str
+):
+    """Lower a resolved top-level builder into a module's code object.
+    `root` is the node of the top-level s-expression, if tracked.
+    """
+    instructions = builder.build()
+    code = make_code_obj(name, filename, lineno, doc, [], [], [], instructions)
+    origins = builder.st.origins
+    if origins is not None:
+        origins.map_code(code, root, instructions, builder.ir.lowered)
+    return code
+
 
-    # complete building requirements
-    instructions = module_builder.build()
+def module_code_stream(
+    sexprs: Iterable,
+    name: str = "<unknown>",
+    filename: str = "<unknown>",
+    lineno: int = 1,
+    doc: str = "",
+):
+    """Create a module's code object from an iterable of top-level s-expressions.
+
+    It's equivalent to `module_code(block(*sexprs), ...)`,
+    but each s-expression is lowered and released before the next one is taken,
+    so that the s-expressions and builders of the whole module are never alive together.
+    The lowered instructions are still kept until the module's code object is assembled,
+    hence the peak memory grows with the module, only more slowly.
+    """
+    st = SharedState(doc, lineno, filename)
+    instructions = []  # type: List[BC.Instr]
+    Instr = BC.Instr
+    for sexpr in sexprs:
+        seq = toplevel_instructions(sexpr, st)
+        if instructions:
+            # discard the value of the previous s-expression
+            last = instructions[-1]
+            if isinstance(last, Instr) and last.name in ir_ops.PURE_LOAD_NAMES:
+                instructions.pop()
+            else:
+                instructions.append(I.POP_TOP())
+        instructions.extend(seq)
     code = make_code_obj(name, filename, lineno, doc, [], [], [], instructions)
     return code
+
+
+class Session:
+    """Compile top-level s-expressions one at a time against a shared namespace,
+    like a REPL.
+
+    Module-level symbols are globals, so each s-expression is compiled alone
+    into a small code object, names introduced earlier keep resolving
+    to the same globals, and the cost of compilation doesn't grow with the session.
+    """
+
+    def __init__(
+        self, namespace: dict = None, name: str = "<session>", filename: str = "<session>"
+    ):
+        self.namespace = {} if namespace is None else namespace
+        self.name = name
+        self.st = SharedState("", 1, filename)
+
+    def compile(self, sexpr):
+        st = self.st
+        lineno = st.line
+        instructions = toplevel_instructions(sexpr, st)
+        return make_code_obj(self.name, st.filename, lineno, "", [], [], [], instructions)
+
+    def eval(self, sexpr):
+        """Compile and evaluate `sexpr` in the shared namespace, return its value."""
+        return eval(self.compile(sexpr), self.namespace)
@@ -0,0 +1,235 @@
+"""A flat intermediate representation of stack instructions.
+
+Instead of Python objects, a function body is stored in parallel arrays:
+
+- `ops`: opcodes, or the pseudo opcodes defined in this module,
+- `args`: integer operands,
+- `lines`: line numbers.
+
+The meaning of an operand depends on its opcode:
+
+- for jumps and `LABEL`, it's an integer label id,
+- for instructions taking names or constants, it's an index of `IR.operands`,
+- for `LOAD_SYM`/`STORE_SYM`, it's the index of a symbol name,
+  which is resolved to fast, deref or global access after `ScopeSolver.resolve`,
+- for `MAKE_FUNC`, it's an index of `IR.funcs`,
+- otherwise, it's the operand itself.
+"""
+import dis
+from array import array
+from py_sexpr.stack_vm.instructions import BinOp, UOp
+
+__all__ = ["IR", "TrackedIR", "opcode", "opname", "ARG_NONE", "ARG_INT", "ARG_OPERAND", "ARG_LABEL"]
+
+_unsupported = {}  # type: dict
+
+
+def opcode(name: str) -> int:
+    """Opcode of given instruction name.
+    Instructions unsupported by current Python get negative opcodes,
+    and fail when lowered.
+    """
+    code = dis.opmap.get(name)
+    if code is None:
+        code = _unsupported.get(name)
+        if code is None:
+            code = _unsupported[name] = -1 - len(_unsupported)
+    return code
+
+
+def opname(code: int) -> str:
+    if code >= 0:
+        return dis.opname[code]
+    for name, each in _unsupported.items():
+        if each == code:
+            return name
+    raise ValueError(code)
+
+
+# pseudo instructions
+LABEL = 256
+LOAD_SYM = 257
+STORE_SYM = 258
+MAKE_FUNC = 259
+
+POP_TOP = opcode("POP_TOP")
+ROT_TWO = opcode("ROT_TWO")
+ROT_THREE = opcode("ROT_THREE")
+DUP_TOP = opcode("DUP_TOP")
+DUP_TOP_TWO = opcode("DUP_TOP_TWO")
+
+LOAD_CONST = opcode("LOAD_CONST")
+LOAD_FAST = opcode("LOAD_FAST")
+STORE_FAST = opcode("STORE_FAST")
+LOAD_GLOBAL = opcode("LOAD_GLOBAL")
+STORE_GLOBAL = opcode("STORE_GLOBAL")
+LOAD_DEREF = opcode("LOAD_DEREF")
+STORE_DEREF = opcode("STORE_DEREF")
+LOAD_CLOSURE = opcode("LOAD_CLOSURE")
+LOAD_ATTR = opcode("LOAD_ATTR")
+STORE_ATTR = opcode("STORE_ATTR")
+STORE_SUBSCR = opcode("STORE_SUBSCR")
+BINARY_SUBSCR = opcode("BINARY_SUBSCR")
+COMPARE_OP = opcode("COMPARE_OP")
+
+CALL_FUNCTION = opcode("CALL_FUNCTION")
+CALL_FUNCTION_KW = opcode("CALL_FUNCTION_KW")
+CALL_FUNCTION_EX = opcode("CALL_FUNCTION_EX")
+CALL_FUNCTION_VAR = opcode("CALL_FUNCTION_VAR")
+CALL_FUNCTION_VAR_KW = opcode("CALL_FUNCTION_VAR_KW")
+LOAD_METHOD = opcode("LOAD_METHOD")
+CALL_METHOD = opcode("CALL_METHOD")
+RETURN_VALUE = opcode("RETURN_VALUE")
+RAISE_VARARGS = opcode("RAISE_VARARGS")
+MAKE_FUNCTION = opcode("MAKE_FUNCTION")
+MAKE_CLOSURE = opcode("MAKE_CLOSURE")
+
+BUILD_TUPLE = opcode("BUILD_TUPLE")
+BUILD_LIST = opcode("BUILD_LIST")
+BUILD_MAP = opcode("BUILD_MAP")
+BUILD_CONST_KEY_MAP = opcode("BUILD_CONST_KEY_MAP")
+BUILD_MAP_UNPACK = opcode("BUILD_MAP_UNPACK")
+BUILD_SET = opcode("BUILD_SET")
+LIST_APPEND = opcode("LIST_APPEND")
+SET_ADD = opcode("SET_ADD")
+MAP_ADD = opcode("MAP_ADD")
+
+POP_JUMP_IF_TRUE = opcode("POP_JUMP_IF_TRUE")
+POP_JUMP_IF_FALSE = opcode("POP_JUMP_IF_FALSE")
+JUMP_ABSOLUTE = opcode("JUMP_ABSOLUTE")
+JUMP_FORWARD = opcode("JUMP_FORWARD")
+JUMP_IF_TRUE_OR_POP = opcode("JUMP_IF_TRUE_OR_POP")
+JUMP_IF_FALSE_OR_POP = opcode("JUMP_IF_FALSE_OR_POP")
+UNPACK_SEQUENCE = opcode("UNPACK_SEQUENCE")
+GET_ITER = opcode("GET_ITER")
+GET_YIELD_FROM_ITER = opcode("GET_YIELD_FROM_ITER")
+YIELD_VALUE = opcode("YIELD_VALUE")
+YIELD_FROM = opcode("YIELD_FROM")
+GET_AWAITABLE = opcode("GET_AWAITABLE")
+GET_AITER = opcode("GET_AITER")
+GET_ANEXT = opcode("GET_ANEXT")
+SETUP_FINALLY = opcode("SETUP_FINALLY")
+SETUP_EXCEPT = opcode("SETUP_EXCEPT")
+POP_BLOCK = opcode("POP_BLOCK")
+POP_EXCEPT = opcode("POP_EXCEPT")
+END_FINALLY = opcode("END_FINALLY")
+END_ASYNC_FOR = opcode("END_ASYNC_FOR")
+FOR_ITER = opcode("FOR_ITER")
+
+BINARY = {op: opcode("BINARY_" + op.name) for op in BinOp}
+INPLACE = {op: opcode("INPLACE_" + op.name) for op in BinOp if op is not BinOp.SUBSCR}
+UNARY = {op: opcode("UNARY_" + op.name) for op in UOp}
+
+# instructions that push a value without any side effect,
+# so that they can be eliminated together with a following `POP_TOP`.
+PURE_LOADS = frozenset([LOAD_CONST, LOAD_FAST, LOAD_GLOBAL, LOAD_DEREF, LOAD_SYM])
+PURE_LOAD_NAMES = frozenset(["LOAD_CONST", "LOAD_FAST", "LOAD_GLOBAL", "LOAD_DEREF"])
+
+ARG_NONE = 0
+ARG_INT = 1
+ARG_OPERAND = 2
+ARG_LABEL = 3
+
+
+def _arg_kinds():
+    kinds = bytearray(256)
+    for code in range(dis.HAVE_ARGUMENT, 256):
+        kinds[code] = ARG_INT
+    for code in dis.hasconst + dis.hasname + dis.haslocal + dis.hascompare + dis.hasfree:
+        kinds[code] = ARG_OPERAND
+    for code in dis.hasjrel + dis.hasjabs:
+        kinds[code] = ARG_LABEL
+    return bytes(kinds)
+
+
+ARG_KINDS = _arg_kinds()
+
+
+class IR:
+    """Instructions of a function body."""
+
+    __slots__ = ["ops", "args", "lines", "operands", "names", "funcs", "n_labels"]
+
+    def __init__(self):
+        self.ops = array("i")
+        self.args = array("i")
+        self.lines = array("i")
+        self.operands = []  # type: list
+        self.names = {}  # type: dict
+        self.funcs = []  # type: list
+        self.n_labels = 0
+
+    def __len__(self):
+        return len(self.ops)
+
+    def emit(self, op: int, arg: int, line: int):
+        self.ops.append(op)
+        self.args.append(arg)
+        self.lines.append(line)
+
+    def operand(self, value) -> int:
+        """Add a constant to the operand pool."""
+        operands = self.operands
+        operands.append(value)
+        return len(operands) - 1
+
+    def name(self, n) -> int:
+        """Add a name to the operand pool, names are shared."""
+        i = self.names.get(n)
+        if i is None:
+            i = self.names[n] = self.operand(n)
+        return i
+
+    def new_label(self) -> int:
+        i = self.n_labels
+        self.n_labels = i + 1
+        return i
+
+    def sub(self) -> "IR":
+        """Create the IR of a nested function."""
+        return IR()
+
+    def _keep(self, kept):
+        self.ops = array("i", (self.ops[i] for i in kept))
+        self.args = array("i", (self.args[i] for i in kept))
+        self.lines = array("i", (self.lines[i] for i in kept))
+
+    def peephole(self):
+        """Remove redundant load/pop pairs in place."""
+        ops = self.ops
+        kept = []
+        pure_loads = PURE_LOADS
+        for i, op in enumerate(ops):
+            if op == POP_TOP and kept and ops[kept[-1]] in pure_loads:
+                kept.pop()
+                continue
+            kept.append(i)
+        if len(kept) != len(ops):
+            self._keep(kept)
+
+
+class TrackedIR(IR):
+    """IR recording the s-expression node each instruction originates from.
+    See `py_sexpr.stack_vm.emit.Origins`.
+    """
+
+    __slots__ = ["nodes", "origins", "lowered"]
+
+    def __init__(self, origins):
+        IR.__init__(self)
+        self.nodes = array("i")
+        self.origins = origins
+        # nodes of lowered instructions and labels, see `Builder.build`
+        self.lowered = array("i")
+        origins.irs.append(self)
+
+    def emit(self, op: int, arg: int, line: int):
+        IR.emit(self, op, arg, line)
+        self.nodes.append(self.origins.current)
+
+    def sub(self) -> "IR":
+        return TrackedIR(self.origins)
+
+    def _keep(self, kept):
+        IR._keep(self, kept)
+        self.nodes = array("i", (self.nodes[i] for i in kept))
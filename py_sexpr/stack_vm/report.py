@@ -0,0 +1,164 @@
+"""Static cost reports of generated code objects.
+
+`code_report` inspects any code object, e.g., the output of `module_code`.
+`cost_report` additionally compiles the s-expression itself, to find out
+the subtrees contributing the most instructions.
+
+Reports are made of `dict`s, `list`s, strings and integers, hence can be dumped as JSON.
+Run `python -m py_sexpr.stack_vm.report <file.sexpr>` to get the report of a file,
+the exit code is 1 if any given limit is exceeded.
+"""
+import dis
+import types
+from typing import List
+from py_sexpr.stack_vm.emit import module_code, Origins, format_path
+from py_sexpr.stack_vm.instructions import MK_FN_HAS_CLOSURE
+
+__all__ = ["code_report", "cost_report", "check_limits"]
+
+# terms that only forward to their sub-terms
+_WRAPPERS = frozenset(["block", "line", "filename", "doc", "eval"])
+
+
+def _loop_ranges(instructions: List[dis.Instruction]):
+    """Offset ranges of loops, found by backward jumps."""
+    ranges = []
+    for instr in instructions:
+        if instr.opcode in dis.hasjabs or instr.opcode in dis.hasjrel:
+            if instr.argval <= instr.offset:
+                ranges.append((instr.argval, instr.offset))
+    return ranges
+
+
+def _function_report(code: types.CodeType, qualname: str):
+    instructions = [
+        each for each in dis.get_instructions(code) if each.opname != "EXTENDED_ARG"
+    ]
+    loops = _loop_ranges(instructions)
+    load_globals = sorted(
+        {each.argval for each in instructions if each.opname == "LOAD_GLOBAL"}
+    )
+    closures_in_loops = []
+    for i, each in enumerate(instructions):
+        if each.opname == "MAKE_CLOSURE" or (
+            each.opname == "MAKE_FUNCTION" and each.arg & MK_FN_HAS_CLOSURE
+        ):
+            if any(low <= each.offset <= high for low, high in loops):
+                # the function name is loaded right before `MAKE_FUNCTION`
+                closures_in_loops.append(instructions[i - 1].argval)
+
+    return {
+        "name": code.co_name,
+        "qualname": qualname,
+        "filename": code.co_filename,
+        "firstlineno": code.co_firstlineno,
+        "instructions": len(instructions),
+        "stacksize": code.co_stacksize,
+        "locals": code.co_nlocals,
+        "cells": len(code.co_cellvars),
+        "frees": len(code.co_freevars),
+        "consts": len(code.co_consts),
+        "globals": load_globals,
+        "closures_in_loops": closures_in_loops,
+    }
+
+
+def code_report(code: types.CodeType) -> dict:
+    """Report the costs of a code object and all nested ones."""
+    functions = []
+    stack = [(code, code.co_name)]
+    while stack:
+        code, qualname = stack.pop()
+        functions.append(_function_report(code, qualname))
+        nested = [each for each in code.co_consts if isinstance(each, types.CodeType)]
+        for each in reversed(nested):
+            stack.append((each, qualname + "/" + each.co_name))
+    return {"functions": functions}
+
+
+def cost_report(sexpr, top: int = 10, **kwargs) -> dict:
+    """Compile `sexpr` with `module_code`, and report the costs.
+
+    Besides `code_report`, `hot_subtrees` lists at most `top` s-expression nodes
+    with the most instructions, in which `instructions` counts the whole subtree
+    while `self` counts only instructions emitted by the node itself.
+    """
+    origins = Origins()
+    code = module_code(sexpr, origins=origins, **kwargs)
+    report = code_report(code)
+
+    self_counts = origins.instruction_counts()
+    node_of_path = {path: node for node, path in enumerate(origins.paths)}
+    totals = {}
+    for node, count in self_counts.items():
+        path = origins.paths[node]
+        for i in range(len(path) + 1):
+            ancestor = node_of_path.get(path[:i])
+            if ancestor is not None:
+                totals[ancestor] = totals.get(ancestor, 0) + count
+
+    hot = []
+    for node, total in totals.items():
+        term = origins.terms[node]
+        path = origins.paths[node]
+        if not path or not isinstance(term, tuple) or term[0] in _WRAPPERS:
+            continue
+        hot.append(
+            {
+                "path": format_path(path),
+                "head": term[0],
+                "instructions": total,
+                "self": self_counts.get(node, 0),
+            }
+        )
+    hot.sort(key=lambda each: (-each["instructions"], each["path"]))
+    report["hot_subtrees"] = hot[:top]
+    return report
+
+
+def check_limits(report: dict, **limits: int) -> List[str]:
+    """Check each function against limits, e.g., `check_limits(report, stacksize=50)`.
+    Return the violations.
+    """
+    violations = []
+    for function in report["functions"]:
+        for key, limit in limits.items():
+            if function[key] > limit:
+                violations.append(
+                    "{}: {} {} > {}".format(function["qualname"], key, function[key], limit)
+                )
+    return violations
+
+
+def main(argv=None) -> int:
+    import argparse
+    import json
+    from py_sexpr.importer import loads
+
+    parser = argparse.ArgumentParser(
+        prog="python -m py_sexpr.stack_vm.report",
+        description="Report the static costs of a serialized s-expression.",
+    )
+    parser.add_argument("path")
+    parser.add_argument("--top", type=int, default=10)
+    for key in ("instructions", "stacksize", "locals", "cells", "frees", "consts"):
+        parser.add_argument("--max-" + key, type=int, dest=key)
+    args = parser.parse_args(argv)
+
+    with open(args.path, "rb") as f:
+        sexpr = loads(f.read())
+    report = cost_report(sexpr, top=args.top, filename=args.path)
+    limits = {
+        key: getattr(args, key)
+        for key in ("instructions", "stacksize", "locals", "cells", "frees", "consts")
+        if getattr(args, key) is not None
+    }
+    report["violations"] = check_limits(report, **limits)
+    print(json.dumps(report, indent=2))
+    return 1 if report["violations"] else 0
+
+
+if __name__ == "__main__":
+    import sys
+
+    sys.exit(main())
@@ -0,0 +1,161 @@
+"""Map bytecode offsets of generated code back to s-expression nodes.
+
+Profilers and tracebacks only know code objects, instruction offsets and line numbers.
+`source_mapped_code` compiles an s-expression together with a `SourceMap`,
+a side table holding, for each code object, the instruction offsets and
+the path of the node each instruction originates from,
+as well as the line, column and filename given by `metadata`.
+
+```python
+    code, smap = source_mapped_code(main, filename="main.txt")
+    try:
+        exec(code, scope)
+    except Exception as e:
+        for loc in smap.traceback(e.__traceback__):
+            print(loc.path, smap.term(loc.path))
+```
+"""
+import types
+from bisect import bisect_right
+from collections import namedtuple
+from typing import Dict, List, Optional
+from py_sexpr.stack_vm.emit import module_code, Origins, format_path, parse_path
+
+__all__ = ["Location", "SourceMap", "source_mapped_code"]
+
+Location = namedtuple("Location", ["path", "line", "column", "filename"])
+
+
+def _code_key(code: types.CodeType) -> tuple:
+    return code.co_filename, code.co_name, code.co_firstlineno
+
+
+class SourceMap:
+    """Offset to node tables of the code objects recorded by an `Origins`.
+
+    Code objects are looked up by identity first,
+    and then by filename, name, first line number and bytecode,
+    so that code loaded from `.pyc` caches is also supported.
+    """
+
+    def __init__(self, root, origins: Origins):
+        self.root = root
+        self.origins = origins
+        self._by_id = {}  # type: Dict[int, tuple]
+        self._by_key = {}  # type: Dict[tuple, List[tuple]]
+        for entry in origins.codes:
+            code = entry[0]
+            self._by_id[id(code)] = entry
+            self._by_key.setdefault(_code_key(code), []).append(entry)
+
+    def _entry(self, code: types.CodeType) -> Optional[tuple]:
+        entry = self._by_id.get(id(code))
+        if entry is not None and entry[0] is code:
+            return entry
+        for entry in self._by_key.get(_code_key(code), ()):
+            if entry[0].co_code == code.co_code:
+                return entry
+        return None
+
+    def _functions(self, filename: str, lineno: int, name: str) -> List[tuple]:
+        return self._by_key.get((filename, name, lineno), [])
+
+    def location(self, node: int) -> Location:
+        origins = self.origins
+        line, column, filename = origins.locations[node]
+        return Location(format_path(origins.paths[node]), line, column, filename)
+
+    def lookup(self, code: types.CodeType, offset: int) -> Optional[Location]:
+        """Location of the instruction at `offset`,
+        or `None` if `code` is not generated with this map.
+        """
+        entry = self._entry(code)
+        if entry is None:
+            return None
+        _, _, offsets, nodes = entry
+        i = bisect_right(offsets, offset) - 1
+        return self.location(nodes[max(i, 0)])
+
+    def function(self, code: types.CodeType) -> Optional[Location]:
+        """Location of the term creating `code`, i.e., a `func` or the root."""
+        entry = self._entry(code)
+        if entry is None:
+            return None
+        return self.location(entry[1])
+
+    def frame(self, frame: types.FrameType) -> Optional[Location]:
+        """Location of the instruction a frame is executing."""
+        return self.lookup(frame.f_code, frame.f_lasti)
+
+    def stack(self, frame: types.FrameType) -> List[Location]:
+        """Locations of a sampled stack, e.g., from `sys._current_frames()`,
+        innermost first. Frames of other code are skipped.
+        """
+        locations = []
+        while frame is not None:
+            loc = self.frame(frame)
+            if loc is not None:
+                locations.append(loc)
+            frame = frame.f_back
+        return locations
+
+    def traceback(self, tb: types.TracebackType) -> List[Location]:
+        """Locations of a traceback, outermost first. Frames of other code are skipped."""
+        locations = []
+        while tb is not None:
+            loc = self.lookup(tb.tb_frame.f_code, tb.tb_lasti)
+            if loc is not None:
+                locations.append(loc)
+            tb = tb.tb_next
+        return locations
+
+    def profile_stats(self, stats) -> Dict[str, dict]:
+        """Map the function statistics of `cProfile`/`pstats` to `func` terms.
+
+        `stats` is a `pstats.Stats`, or its `stats` dictionary.
+        Return `{path: {"calls": ..., "tottime": ..., "cumtime": ...}}`.
+        """
+        stats = getattr(stats, "stats", stats)
+        result = {}  # type: Dict[str, dict]
+        for (filename, lineno, name), (_, calls, tottime, cumtime, _) in stats.items():
+            for entry in self._functions(filename, lineno, name):
+                path = self.location(entry[1]).path
+                each = result.setdefault(path, {"calls": 0, "tottime": 0.0, "cumtime": 0.0})
+                each["calls"] += calls
+                each["tottime"] += tottime
+                each["cumtime"] += cumtime
+        return result
+
+    def term(self, path):
+        """The subterm at `path`, which is a tuple or a formatted string."""
+        if isinstance(path, str):
+            path = parse_path(path)
+        term = self.root
+        for i in path:
+            term = term[i]
+        return term
+
+    def export(self) -> List[dict]:
+        """The tables in JSON-compatible form."""
+        tables = []
+        for code, node, offsets, nodes in self.origins.codes:
+            tables.append(
+                {
+                    "name": code.co_name,
+                    "filename": code.co_filename,
+                    "firstlineno": code.co_firstlineno,
+                    "path": self.location(node).path,
+                    "offsets": [
+                        [offset] + list(self.location(each))
+                        for offset, each in zip(offsets, nodes)
+                    ],
+                }
+            )
+        return tables
+
+
+def source_mapped_code(sexpr, **kwargs):
+    """Compile `sexpr` with `module_code`, return the code object and its `SourceMap`."""
+    origins = kwargs.pop("origins", None) or Origins()
+    code = module_code(sexpr, origins=origins, **kwargs)
+    return code, SourceMap(sexpr, origins)
@@ -36,6 +36,9 @@ __all__ = [
     'BinOp',
     'UOp',
     'call',
+    'call_method',
+    'call_kw',
+    'call_star',
     'assign',
     'assign_star',
     'define',
@@ -45,6 +48,8 @@ __all__ = [
     'throw',
     'isa',
     'cmp',
+    'and_',
+    'or_',
     'uop',
     'binop',
     'document',
@@ -54,14 +59,29 @@ __all__ = [
     'mktuple',
     'set_item',
     'set_attr',
+    'aug_assign',
+    'aug_set_item',
+    'aug_set_attr',
     'get_item',
     'get_attr',
     'block',
     'for_range',
     'for_in',
+    'list_comp',
+    'set_comp',
+    'dict_comp',
     'ite',
+    'switch',
     'loop',
+    'label',
+    'goto',
+    'break_',
+    'continue_',
     'ret',
+    'yield_',
+    'yield_from',
+    'await_',
+    'async_for_in',
  ]
 
 if __debug__:
@@ -85,17 +105,46 @@ def call(f: SExpr, *args: SExpr) -> SExpr:
     return ('call', f, *args)
 
 
-def assign_star(n: str, value: SExpr) -> SExpr:
-    """assign* can introduce new variables into current scope."""
+def call_method(obj: SExpr, attr: str, *args: SExpr) -> SExpr:
+    """Basically, `obj.attr(*args)`, without creating a bound method when possible."""
+    return ('call_method', obj, attr, *args)
+
+
+def call_kw(f: SExpr, *args: SExpr, **kwargs: SExpr) -> SExpr:
+    """Basically, `f(*args, **kwargs)`, with keyword arguments known statically."""
+    return ('call_kw', f, tuple(kwargs), *args, *kwargs.values())
+
+
+def call_star(f: SExpr, args: SExpr, kwargs: SExpr = None) -> SExpr:
+    """Basically, `f(*args, **kwargs)`, where `args` evaluates to an iterable,
+    and `kwargs`, if given, evaluates to a mapping.
+    """
+    return 'call_star', f, args, kwargs
+
+
+def assign_star(n: Union[str, list], value: SExpr) -> SExpr:
+    """assign* can introduce new variables into current scope.
+
+    `n` can be a pattern, i.e., a list of names or patterns,
+    e.g., `assign_star(["k", ["a", "b"]], value)` is `k, (a, b) = value`.
+    """
     return 'assign_star', n, value
 
 
-def assign(n: str, value: SExpr) -> SExpr:
-    """NOTE: assign cannot introduce new variables."""
+def assign(n: Union[str, list], value: SExpr) -> SExpr:
+    """NOTE: assign cannot introduce new variables.
+
+    `n` can be a pattern like the one of `assign_star`.
+    """
     return 'assign', n, value
 
 
-def define(func_name: Optional[str], args: List[str], body: SExpr, defaults: Union[List[SExpr], Tuple[SExpr, ...]]=()):
+def define(func_name: Optional[str], args: List[str], body: SExpr, defaults: Union[List[SExpr], Tuple[SExpr, ...]]=(), is_async: bool=False):
+    """
+    If `is_async`, it's an `async def`, which can use `await_` and `async_for_in`.
+    """
+    if is_async:
+        return "func", args, body, func_name, defaults, True
     return "func", args, body, func_name, defaults
 
 
@@ -143,8 +192,30 @@ def isa(value: SExpr, ty: SExpr) -> SExpr:
     return 'cmp', lhs, Compare.IS, ty
 
 
-def cmp(l: SExpr, op: Compare, r: SExpr) -> SExpr:
-    return 'cmp', l, op, r
+def cmp(l: SExpr, op: Compare, r: SExpr, *more: Union[Compare, SExpr]) -> SExpr:
+    """
+    `cmp(a, op1, b, op2, c, ...)` is a chained comparison like `a < b < c`,
+    where each operand is evaluated at most once.
+    """
+    if len(more) % 2:
+        raise ValueError("expect pairs of comparison operators and operands")
+    return ('cmp', l, op, r, *more)
+
+
+def and_(*terms: SExpr) -> SExpr:
+    """
+    Basically it's `a and b and ...`, which short-circuits.
+    `and_()` is `True`.
+    """
+    return ('and_', *terms)
+
+
+def or_(*terms: SExpr) -> SExpr:
+    """
+    Basically it's `a or b or ...`, which short-circuits.
+    `or_()` is `False`.
+    """
+    return ('or_', *terms)
 
 
 def uop(op: UOp, term: SExpr) -> SExpr:
@@ -214,6 +285,25 @@ def get_attr(base: SExpr, attr: str) -> SExpr:
     return "get_attr", base, attr
 
 
+def aug_assign(n: str, op: BinOp, val: SExpr) -> SExpr:
+    """Basically, `n op= val`, e.g., `n += val` for `BinOp.ADD`,
+    and the return value is `None`.
+
+    Like `assign`, it cannot introduce new variables.
+    """
+    return "aug_assign", n, op, val
+
+
+def aug_set_item(base: SExpr, item: SExpr, op: BinOp, val: SExpr) -> SExpr:
+    """Basically, `base[item] op= val`, and the return value is `None`"""
+    return "aug_set_item", base, item, op, val
+
+
+def aug_set_attr(base: SExpr, attr: str, op: BinOp, val: SExpr) -> SExpr:
+    """Basically, `base.attr op= val`, and the return value is `None`"""
+    return "aug_set_attr", base, attr, op, val
+
+
 def block(*suite: SExpr) -> SExpr:
     """A block of s-expressions.
 
@@ -237,7 +327,7 @@ def for_range(n: str, low: SExpr, high: SExpr, body: SExpr) -> SExpr:
     return for_in(n, call(var("range"), low, high), body)
 
 
-def for_in(n: str, obj: SExpr, body: SExpr) -> SExpr:
+def for_in(n: Union[str, list], obj: SExpr, body: SExpr) -> SExpr:
     """
    Basically it's
    ```python
@@ -246,10 +336,49 @@ def for_in(n: str, obj: SExpr, body: SExpr) -> SExpr:
    ```
 
    The return value is `None`.
+   `n` can be a pattern like the one of `assign_star`, which is bound like `assign`.
    """
     return 'for_in', n, obj, body
 
 
+def list_comp(n: str, obj: SExpr, elt: SExpr, cond: SExpr = None) -> SExpr:
+    """
+    Basically it's
+    ```python
+    [elt for n in obj if cond]
+    ```
+
+    Without `cond`, all elements are taken.
+    Unlike Python, no function is created for the comprehension,
+    and `n` is bound like the one of `for_in`.
+    """
+    return 'list_comp', n, obj, elt, cond
+
+
+def set_comp(n: str, obj: SExpr, elt: SExpr, cond: SExpr = None) -> SExpr:
+    """
+    Basically it's
+    ```python
+    {elt for n in obj if cond}
+    ```
+
+    See `list_comp`.
+    """
+    return 'set_comp', n, obj, elt, cond
+
+
+def dict_comp(n: str, obj: SExpr, key: SExpr, value: SExpr, cond: SExpr = None) -> SExpr:
+    """
+    Basically it's
+    ```python
+    {key: value for n in obj if cond}
+    ```
+
+    See `list_comp`.
+    """
+    return 'dict_comp', n, obj, key, value, cond
+
+
 def ite(cond: SExpr, te: SExpr, fe: SExpr) -> SExpr:
     """
     Basically it's
@@ -262,6 +391,23 @@ def ite(cond: SExpr, te: SExpr, fe: SExpr) -> SExpr:
     return 'ite', cond, te, fe
 
 
+def switch(value: SExpr, cases: List[Tuple[object, SExpr]], default: SExpr = None) -> SExpr:
+    """
+    Basically it's
+    ```python
+    body1 if value == key1 else body2 if value == key2 else ... else default
+    ```
+    where keys are distinct hashable constants, and `value` is evaluated only once.
+
+    Depending on the number of cases, it's compiled to a chain of comparisons,
+    a binary search over integer keys,
+    or a lookup of a constant `dict` from keys to case indices followed by a binary search.
+    The latter two require `value` to be comparable with integers, or hashable respectively.
+    """
+    keys = tuple(key for key, _ in cases)
+    return ('switch', value, keys, default, *(body for _, body in cases))
+
+
 def loop(cond: SExpr, body: SExpr) -> SExpr:
     """
     Basically it's
@@ -277,11 +423,88 @@ def loop(cond: SExpr, body: SExpr) -> SExpr:
     return 'loop', cond, body
 
 
+def label(name: str) -> SExpr:
+    """
+    Mark a position of current function as the target of `goto(name)`.
+    The return value is `None`.
+    """
+    return 'label', name
+
+
+def goto(name: str) -> SExpr:
+    """
+    Jump to `label(name)` in the same function.
+
+    The stack depth must be the same at both places,
+    i.e., neither of them is inside a pending expression like call arguments,
+    nor is one of them inside a loop while the other isn't;
+    otherwise a `ValueError` is raised at compile time.
+    """
+    return 'goto', name
+
+
+def break_(value: SExpr = None) -> SExpr:
+    """
+    Exit the innermost `loop`, `for_in` or `async_for_in` of current function.
+
+    `value` becomes the return of `loop`, and must be omitted for `for_in`s.
+    Like `goto`, it cannot be used inside a pending expression like call arguments.
+    """
+    return 'break_', value
+
+
+def continue_() -> SExpr:
+    """
+    Start the next iteration of the innermost loop, see `break_`.
+    If `loop` ends right after, it returns `None`.
+    """
+    return 'continue_',
+
+
 def ret(value: SExpr = None) -> SExpr:
     return 'ret', value
 
 
+def yield_(value: SExpr = None) -> SExpr:
+    """
+    Basically it's `(yield value)`, whose return is the value sent to the generator.
+
+    A function containing `yield_` or `yield_from` is a generator function,
+    and they cannot be used outside functions.
+    """
+    return 'yield_', value
+
+
+def yield_from(iterable: SExpr) -> SExpr:
+    """
+    Basically it's `(yield from iterable)`, whose return is the return of the sub-generator.
+
+    See `yield_`.
+    """
+    return 'yield_from', iterable
+
+
+def await_(awaitable: SExpr) -> SExpr:
+    """
+    Basically it's `await awaitable`, which can only be used in async functions.
+    """
+    return 'await_', awaitable
+
+
+def async_for_in(n: Union[str, list], obj: SExpr, body: SExpr) -> SExpr:
+    """
+    Basically it's
+    ```python
+    async for n in obj:
+        body
+    ```
+
+    The return value is `None`. See `for_in` and `await_`.
+    """
+    return 'async_for_in', n, obj, body
+
+
 def metadata(line: int, column: int, filename: str, term: SExpr) -> SExpr:
     """Set metadata to s-expressions.
     """
-    return 'line', line, ('filename', filename, term)
+    return 'line', line, ('filename', filename, term), column
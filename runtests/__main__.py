@@ -266,3 +266,1098 @@ def deep_ite(depth):
 main = deep_ite(100)
 code = module_code(main)
 assert eval(code) == "good"
+
+
+import os
+import sys
+import tempfile
+import importlib
+from py_sexpr import importer
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    main = block(assign_star("x", 21), define("double", [], binop(var("x"), BinOp.MULTIPLY, 2)))
+    with open(os.path.join(tmpdir, "sexpr_mod.sexpr"), "wb") as f:
+        f.write(importer.dumps(main))
+    sys.path.insert(0, tmpdir)
+    importer.install()
+    dont_write_bytecode = sys.dont_write_bytecode
+    sys.dont_write_bytecode = False
+    try:
+        import sexpr_mod
+
+        assert sexpr_mod.double() == 42
+        assert os.path.exists(importer.cache_path(sexpr_mod.__file__))
+        del sys.modules["sexpr_mod"]
+
+        # the second import must load from the .pyc
+        _module_code = importer.module_code
+        importer.module_code = None
+        try:
+            sexpr_mod = importlib.import_module("sexpr_mod")
+        finally:
+            importer.module_code = _module_code
+        assert sexpr_mod.double() == 42
+        del sys.modules["sexpr_mod"]
+
+        # caches of other compiler versions are stale
+        with open(importer.cache_path(sexpr_mod.__file__), "rb") as f:
+            data = f.read()
+        with open(sexpr_mod.__file__, "rb") as f:
+            source = f.read()
+        mtime = os.stat(sexpr_mod.__file__).st_mtime
+        assert importer._pyc_to_code(data, source, mtime) is not None
+        importer.COMPILER_VERSION += 1
+        try:
+            assert importer._pyc_to_code(data, source, mtime) is None
+            assert importer.compile_file(sexpr_mod.__file__, quiet=True)
+            with open(importer.cache_path(sexpr_mod.__file__), "rb") as f:
+                assert f.read() != data
+        finally:
+            importer.COMPILER_VERSION -= 1
+
+        os.remove(importer.cache_path(sexpr_mod.__file__))
+        assert importer.main(["-q", tmpdir]) == 0
+        assert os.path.exists(importer.cache_path(sexpr_mod.__file__))
+    finally:
+        sys.dont_write_bytecode = dont_write_bytecode
+        importer.uninstall()
+        sys.path.remove(tmpdir)
+
+from py_sexpr import serialize
+
+main = block(
+    assign_star("x", const((1, 2.5, -3j, b"b", None, True))),
+    define("f", ["a"], ite(cmp(var("a"), Compare.GT, 0), uop(UOp.NEGATIVE, var("a")), -(2 ** 70))),
+    record(("var", 1), a=0.0, b=-0.0),
+    mktuple(var("x"), call(var("f"), 5), call(var("f"), 0)),
+)
+data = serialize.dumps(main)
+assert serialize.materialize(serialize.loads(data)) == main
+assert eval(module_code(serialize.loads(data))) == eval(module_code(main))
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = os.path.join(tmpdir, "stream.sexpr")
+    with open(path, "wb") as f:
+        enc = serialize.Encoder(f)
+        stmts = [enc.encode(assign_star("s{}".format(i), i)) for i in range(100)]
+        enc.close(block(*stmts, binop(var("s98"), BinOp.ADD, var("s99"))))
+    root = serialize.load(path)
+    assert isinstance(root, serialize.TermView)
+    assert len(root) == 102
+    assert eval(module_code(root), {}) == 98 + 99
+    del root
+
+from py_sexpr.stack_vm.emit import module_code_stream
+
+
+def stmts():
+    yield assign_star("acc", const(()))
+    for i in range(1000):
+        yield assign("acc", binop(var("acc"), BinOp.ADD, mktuple(i)))
+    yield define("get", [], var("acc"))
+    yield call(var("get"))
+
+
+code = module_code_stream(stmts())
+assert eval(code, {}) == tuple(range(1000))
+assert eval(module_code_stream([]), {}) is None
+assert eval(module_code_stream([1, 2]), {}) == 2
+
+from py_sexpr.stack_vm.emit import Session
+
+session = Session()
+assert session.eval(assign_star("n", 1)) is None
+assert session.eval(define("inc", ["x"], binop(var("x"), BinOp.ADD, var("n")))) is session.namespace["inc"]
+assert session.eval(assign("n", 10)) is None
+assert session.eval(call(var("inc"), 5)) == 15
+assert session.eval(metadata(7, 0, "rules.txt", define("get_n", [], var("n"))))() == 10
+assert session.namespace["get_n"].__code__.co_filename == "rules.txt"
+
+# attribute access is not a pure load and must not be eliminated
+RES = None
+try:
+    exec(module_code(block(get_attr(var("o"), "missing"), 1)), dict(o=object()))
+except AttributeError:
+    RES = True
+assert RES
+
+from py_sexpr.stack_vm.report import cost_report, check_limits
+import json
+
+main = block(
+    define(
+        "f",
+        ["a", "xs"],
+        block(
+            for_in("i", var("xs"), define(None, [], binop(var("i"), BinOp.ADD, var("a")))),
+            call(var("print"), get_attr(var("a"), "x")),
+        ),
+    ),
+    call(var("f"), 1, const(())),
+)
+report = cost_report(main, top=3)
+json.dumps(report)
+module_report, f_report, _ = report["functions"]
+assert f_report["qualname"] == "<unknown>/f"
+assert f_report["globals"] == ["print"]
+assert f_report["cells"] == 1 and f_report["closures_in_loops"] == ["lambda:1"]
+assert module_report["closures_in_loops"] == []
+assert [each["path"] for each in report["hot_subtrees"]] == ["/1", "/1/2/1", "/1/2/1/3"]
+assert check_limits(report, stacksize=100) == []
+assert check_limits(report, instructions=1)
+
+from py_sexpr.stack_vm.emit import Counters
+
+counters = Counters()
+main = define(
+    "f",
+    ["n"],
+    block(
+        for_range("i", 0, var("n"), ite(cmp(var("i"), Compare.LT, 3), None, None)),
+        loop(cmp(var("n"), Compare.GT, 0), assign("n", binop(var("n"), BinOp.SUBTRACT, 1))),
+    ),
+)
+f = eval(module_code(main, counters=counters), {})
+f(10)
+f(2)
+assert counters.export() == {
+    "/": {"func.entry": 2},
+    "/2/1": {"for_in.body": 12},
+    "/2/1/3": {"ite.false": 7, "ite.true": 5},
+    "/2/2": {"loop.body": 12},
+}
+counters.reset()
+assert set(counters.counts) == {0}
+
+from py_sexpr.stack_vm.emit import Profile
+
+
+def make_main():
+    return define(
+        "f",
+        ["x", "n"],
+        mktuple(
+            ite(cmp(var("x"), Compare.LT, 0), "neg", "pos"),
+            ite(cmp(var("x"), Compare.GT, 100), "big", "small"),
+            loop(cmp(var("n"), Compare.GT, 0), assign("n", binop(var("n"), BinOp.SUBTRACT, 1))),
+            block(
+                assign_star("s", 0),
+                for_in("i", call(var("range"), var("x")), assign("s", binop(var("s"), BinOp.ADD, var("i")))),
+                var("s"),
+            ),
+        ),
+    )
+
+
+counters = Counters()
+f = eval(module_code(make_main(), counters=counters), {})
+for x in range(1000):
+    f(x + 101, 2)
+for x in range(100):
+    f(x, 2)
+f(-1, 0)
+profile = Profile(counters.export(), hot_threshold=500)
+
+f = eval(module_code(make_main(), profile=profile), {})
+for x in [-1, 0, 1, 7, 101, 1000]:
+    assert f(x, 3) == ("neg" if x < 0 else "pos", "big" if x > 100 else "small", None, sum(range(x)))
+
+instrs = list(dis.get_instructions(f.__code__))
+first_return = min(each.offset for each in instrs if each.opname == "RETURN_VALUE")
+offset_of = {each.argval: each.offset for each in instrs if each.opname == "LOAD_CONST"}
+# rarely taken arms are out of line, and likely arms fall through
+assert offset_of["neg"] > first_return
+assert offset_of["big"] < offset_of["small"] < first_return
+# the hot loop is rotated and the hot for-in loop is unrolled
+assert sum(each.opname == "COMPARE_OP" for each in instrs) == 4
+assert sum(each.opname == "FOR_ITER" for each in instrs) == 2
+
+# code objects not created from the instructions are rejected
+from py_sexpr.stack_vm.emit import Origins
+
+try:
+    Origins().map_code((lambda: None).__code__, 0, [], [])
+    assert False
+except ValueError:
+    pass
+
+from py_sexpr.stack_vm.sourcemap import source_mapped_code
+import types
+import marshal
+import pstats
+import cProfile
+
+main = block(
+    define(
+        "f",
+        ["x"],
+        metadata(
+            5,
+            7,
+            "f.txt",
+            block(call(var("g"), var("x")), ret(binop(var("x"), BinOp.TRUE_DIVIDE, 0))),
+        ),
+    ),
+    call(var("f"), 1),
+)
+code, smap = source_mapped_code(main, filename="m.txt")
+samples = []
+try:
+    exec(code, {"g": lambda x: samples.append(smap.stack(sys._getframe(1)))})
+except ZeroDivisionError as e:
+    locations = smap.traceback(e.__traceback__)
+assert [smap.term(each.path) for each in locations] == [
+    call(var("f"), 1),
+    binop(var("x"), BinOp.TRUE_DIVIDE, 0),
+]
+assert locations[1] == ("/1/2/2/2/2/1", 5, 7, "f.txt")
+assert [each.path for each in samples[0]] == ["/1/2/2/2/1", "/2"]
+
+f_code = next(each for each in code.co_consts if isinstance(each, types.CodeType))
+assert smap.function(f_code).path == "/1"
+# code objects loaded from `.pyc`s are found by their contents
+assert smap.function(marshal.loads(marshal.dumps(f_code))).path == "/1"
+assert smap.lookup(make_main.__code__, 0) is None
+
+tables = smap.export()
+assert [each["path"] for each in tables] == ["/1", "/"]
+assert all(offset % 2 == 0 for offset, *_ in tables[0]["offsets"])
+
+profiler = cProfile.Profile()
+try:
+    profiler.runctx("exec(code, {'g': id})", {"code": code}, {})
+except ZeroDivisionError:
+    pass
+stats = smap.profile_stats(pstats.Stats(profiler))
+assert stats["/1"]["calls"] == 1 and stats["/"]["calls"] == 1
+
+import asyncio
+from py_sexpr.stack_vm.aio import module_code_async
+
+main = block(*[define("f{}".format(i), ["x"], ret(binop(var("x"), BinOp.ADD, i))) for i in range(300)])
+
+
+async def compile_with_ticks(**kwargs):
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(None)
+            await asyncio.sleep(0)
+
+    task = asyncio.ensure_future(ticker())
+    try:
+        code = await module_code_async(main, **kwargs)
+    finally:
+        task.cancel()
+    return code, len(ticks)
+
+
+event_loop = asyncio.new_event_loop()
+for kwargs in [dict(steps=100), dict(steps=None, time_slice=0.0), dict(offload=True)]:
+    code, ticks = event_loop.run_until_complete(compile_with_ticks(**kwargs))
+    scope = {}
+    exec(code, scope)
+    assert scope["f299"](1) == 300
+    assert ticks > 1
+
+try:
+    event_loop.run_until_complete(module_code_async(main, steps=None, time_slice=0.0, timeout=0.0))
+    assert False
+except asyncio.TimeoutError:
+    pass
+
+task = event_loop.create_task(module_code_async(main, steps=10))
+event_loop.call_soon(task.cancel)
+try:
+    event_loop.run_until_complete(task)
+    assert False
+except asyncio.CancelledError:
+    pass
+event_loop.close()
+
+main = define(
+    "f",
+    ["xs"],
+    mktuple(
+        list_comp("x", var("xs"), binop(var("x"), BinOp.MULTIPLY, 2)),
+        list_comp("x", var("xs"), var("x"), cmp(binop(var("x"), BinOp.MODULO, 2), Compare.EQ, 0)),
+        set_comp("x", var("xs"), binop(var("x"), BinOp.FLOOR_DIVIDE, 2)),
+        dict_comp("x", var("xs"), var("x"), uop(UOp.NEGATIVE, var("x")), cmp(var("x"), Compare.GT, 1)),
+        list_comp("x", var("xs"), list_comp("y", var("xs"), mktuple(var("x"), var("y")))),
+    ),
+)
+f = eval(module_code(main), {})
+xs = [1, 2, 3]
+assert f(xs) == (
+    [2, 4, 6],
+    [2],
+    {0, 1},
+    {2: -2, 3: -3},
+    [[(x, y) for y in xs] for x in xs],
+)
+assert f([]) == ([], [], set(), {}, [])
+opnames = {each.opname for each in dis.get_instructions(f.__code__)}
+assert {"LIST_APPEND", "SET_ADD", "MAP_ADD"} <= opnames and "LOAD_ATTR" not in opnames
+
+main = define(
+    "f",
+    ["d"],
+    block(
+        assign_star(["a", ["b", "c"]], mktuple(1, mktuple(2, 3))),
+        assign_star("s", 0),
+        for_in(["k", "v"], call(get_attr(var("d"), "items")), assign("s", binop(var("s"), BinOp.ADD, var("v")))),
+        assign(["a", "b"], mktuple(var("b"), var("a"))),
+        # `c` is captured, hence a cell
+        define("g", [], var("c")),
+        mktuple(var("a"), var("b"), call(var("g")), var("s"), list_comp(["x", "y"], call(var("zip"), var("d"), var("d")), var("y"))),
+    ),
+)
+for each in [main, serialize.loads(serialize.dumps(main))]:
+    f = eval(module_code(each), {"zip": zip})
+    assert f({"x": 1, "y": 2}) == (2, 1, 3, 3, ["x", "y"])
+opnames = [each.opname for each in dis.get_instructions(f.__code__)]
+assert opnames.count("UNPACK_SEQUENCE") == 5 and "BINARY_SUBSCR" not in opnames
+
+
+class Box:
+    pass
+
+
+main = define(
+    "f",
+    ["xs", "box", "d"],
+    block(
+        assign_star("ys", var("xs")),
+        aug_assign("ys", BinOp.ADD, mktuple(1)),
+        aug_set_attr(var("box"), "items", BinOp.ADD, mktuple(2)),
+        aug_set_item(var("d"), "k", BinOp.MULTIPLY, 3),
+        aug_set_item(var("d"), "n", BinOp.SUBTRACT, 1),
+        var("ys"),
+    ),
+)
+f = eval(module_code(main), {})
+xs = []
+box = Box()
+box.items = items = [0]
+d = {"k": [1], "n": 5}
+assert f(xs, box, d) is xs
+# in-place protocols mutate the original objects
+assert xs == [1] and box.items is items and items == [0, 2]
+assert d == {"k": [1, 1, 1], "n": 4}
+assert f(xs, box, d) is xs and xs == [1, 1]
+
+calls = []
+
+
+def probe(x):
+    calls.append(x)
+    return x
+
+
+main = define(
+    "f",
+    ["a", "b", "c"],
+    mktuple(
+        and_(call(var("probe"), var("a")), call(var("probe"), var("b")), call(var("probe"), var("c"))),
+        or_(call(var("probe"), var("a")), call(var("probe"), var("b"))),
+        cmp(call(var("probe"), var("a")), Compare.LT, call(var("probe"), var("b")), Compare.LE, call(var("probe"), var("c"))),
+        and_(),
+        or_(),
+        and_(var("a")),
+    ),
+)
+f = eval(module_code(main), {"probe": probe})
+assert f(1, 2, 3) == (3, 1, True, True, False, 1)
+assert calls == [1, 2, 3, 1, 1, 2, 3]
+del calls[:]
+assert f(0, 2, 1) == (0, 2, False, True, False, 0)
+assert calls == [0, 0, 2, 0, 2, 1]
+del calls[:]
+# short-circuits at the first failed comparison
+assert f(3, 2, 1)[2] is False
+assert calls == [3, 2, 1, 3, 3, 2]
+opnames = [each.opname for each in dis.get_instructions(f.__code__)]
+assert "JUMP_IF_FALSE_OR_POP" in opnames and "JUMP_IF_TRUE_OR_POP" in opnames
+try:
+    cmp(1, Compare.LT, 2, Compare.LT)
+    assert False
+except ValueError:
+    pass
+
+
+def kw(a, b=0, *rest, c=0, **others):
+    return a, b, rest, c, others
+
+
+main = define(
+    "f",
+    ["xs", "d"],
+    mktuple(
+        call_method(var("xs"), "append", 1),
+        call_method(var("xs"), "copy"),
+        call_kw(var("kw"), 1, c=2, z=3),
+        call_kw(var("kw"), 1, 2),
+        call_star(var("kw"), var("xs")),
+        call_star(var("kw"), var("xs"), var("d")),
+        call_star(var("kw"), mktuple(5), record(c=6)),
+    ),
+)
+f = eval(module_code(main), {"kw": kw})
+xs = []
+assert f(xs, {"c": 4}) == (
+    None,
+    [1],
+    (1, 0, (), 2, {"z": 3}),
+    (1, 2, (), 0, {}),
+    (1, 0, (), 0, {}),
+    (1, 0, (), 4, {}),
+    (5, 0, (), 6, {}),
+)
+opnames = {each.opname for each in dis.get_instructions(f.__code__)}
+assert {"CALL_FUNCTION_KW", "CALL_FUNCTION_EX"} <= opnames
+assert ("CALL_METHOD" in opnames) == (sys.version_info >= (3, 7))
+assert "LOAD_ATTR" not in opnames or sys.version_info < (3, 7)
+
+import inspect
+
+main = block(
+    define(
+        "numbers",
+        ["n"],
+        block(
+            assign_star("i", 0),
+            loop(
+                cmp(var("i"), Compare.LT, var("n")),
+                block(yield_(var("i")), aug_assign("i", BinOp.ADD, 1)),
+            ),
+            ret("done"),
+        ),
+    ),
+    define(
+        "evens",
+        ["n"],
+        block(
+            assign_star("r", yield_from(call(var("numbers"), var("n")))),
+            for_in("x", call(var("numbers"), var("n")), ite(cmp(binop(var("x"), BinOp.MODULO, 2), Compare.EQ, 0), yield_(var("x")), None)),
+            ret(var("r")),
+        ),
+    ),
+    define("echo", [], block(assign_star("got", None), loop(True, assign_star("got", yield_(var("got")))))),
+)
+scope = {}
+exec(module_code(main), scope)
+assert inspect.isgeneratorfunction(scope["numbers"]) and inspect.isgeneratorfunction(scope["evens"])
+assert list(scope["evens"](5)) == [0, 1, 2, 3, 4, 0, 2, 4]
+gen = scope["evens"](0)
+try:
+    next(gen)
+    assert False
+except StopIteration as e:
+    assert e.value == "done"
+gen = scope["echo"]()
+next(gen)
+assert gen.send(1) == 1 and gen.send("x") == "x"
+try:
+    module_code(yield_(1))
+    assert False
+except ValueError:
+    pass
+
+
+class Ticks:
+    def __init__(self, n):
+        self.n = n
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await asyncio.sleep(0)
+        if self.n == 0:
+            raise StopAsyncIteration
+        self.n -= 1
+        return self.n
+
+
+main = block(
+    define("fetch", ["x"], block(await_(call(get_attr(var("asyncio"), "sleep"), 0)), binop(var("x"), BinOp.ADD, 1)), is_async=True),
+    define(
+        "collect",
+        ["n"],
+        block(
+            assign_star("xs", call(var("list"))),
+            async_for_in("i", call(var("Ticks"), var("n")), call_method(var("xs"), "append", await_(call(var("fetch"), var("i"))))),
+            var("xs"),
+        ),
+        is_async=True,
+    ),
+    define("agen", ["n"], async_for_in("i", call(var("Ticks"), var("n")), yield_(var("i"))), is_async=True),
+    define("fails", [], async_for_in("i", call(var("Ticks"), 1), throw(call(var("KeyError"), var("i")))), is_async=True),
+)
+scope = {"asyncio": asyncio, "Ticks": Ticks, "list": list, "KeyError": KeyError}
+exec(module_code(main), scope)
+assert inspect.iscoroutinefunction(scope["fetch"]) and inspect.iscoroutinefunction(scope["collect"])
+assert inspect.isasyncgenfunction(scope["agen"])
+
+
+async def drain(agen):
+    xs = []
+    while True:
+        try:
+            xs.append(await agen.__anext__())
+        except StopAsyncIteration:
+            return xs
+
+
+event_loop = asyncio.new_event_loop()
+assert event_loop.run_until_complete(scope["collect"](3)) == [3, 2, 1]
+assert event_loop.run_until_complete(scope["collect"](0)) == []
+assert event_loop.run_until_complete(drain(scope["agen"](2))) == [1, 0]
+try:
+    event_loop.run_until_complete(scope["fails"]())
+    assert False
+except KeyError as e:
+    assert e.args == (0,)
+event_loop.close()
+
+for term in [await_(1), define("f", [], await_(1)), define("f", [], yield_from(1), is_async=True)]:
+    try:
+        module_code(term)
+        assert False
+    except ValueError:
+        pass
+
+# each size exercises one lowering of `switch`: a chain, a binary search, or a table lookup
+for n in [0, 3, 10, 2000]:
+    for keys in [list(range(0, 3 * n, 3)), ["k{}".format(i) for i in range(n)], [1.5, 1] + list(range(n, 0, -1))]:
+        cases = [(key, mktuple("case", key)) for key in keys]
+        main = define("f", ["x"], switch(call(var("probe"), var("x")), cases, "default"))
+        code = module_code(serialize.loads(serialize.dumps(main)))
+        marshal.loads(marshal.dumps(code))
+        f = eval(code, {"probe": probe})
+        for key in keys:
+            del calls[:]
+            # the first case of equal keys wins, and the value is evaluated once
+            assert f(key) == ("case", key) and calls == [key]
+        for key in [-1, 2, 100000, "k"]:
+            if key not in keys and (n <= 6 or not isinstance(key, str) or not isinstance(keys[0], int)):
+                assert f(key) == "default"
+
+
+def state(name, tag, next_state):
+    return block(
+        label(name),
+        ite(cmp(var("n"), Compare.EQ, 0), ret(var("acc")), None),
+        call_method(var("acc"), "append", tag),
+        aug_assign("n", BinOp.SUBTRACT, 1),
+        goto(next_state),
+    )
+
+
+main = define(
+    "f",
+    ["n"],
+    block(assign_star("acc", call(var("list"))), goto("even"), state("odd", "o", "even"), state("even", "e", "odd")),
+)
+f = eval(module_code(main), {"list": list})
+assert f(3) == ["e", "o", "e"] and f(0) == []
+
+from bytecode import Instr, Label
+from py_sexpr.stack_vm.blockaddr import check_stack_depth
+
+end = Label()
+assert check_stack_depth(
+    [Instr("LOAD_CONST", 1), Instr("POP_JUMP_IF_TRUE", end), Instr("LOAD_CONST", 2), Instr("POP_TOP"), end]
+) == {end: 0}
+
+bad = [
+    # jumping from inside pending call arguments
+    block(label("a"), call(var("print"), goto("a"))),
+    # jumping out of a loop, leaving its iterator on the stack
+    block(for_in("i", var("xs"), goto("out")), label("out")),
+    block(goto("nowhere")),
+    block(label("a"), label("a")),
+]
+for each in bad:
+    try:
+        module_code(define("f", ["xs"], each))
+        assert False
+    except ValueError:
+        pass
+# labels are local to functions
+try:
+    module_code(block(label("a"), define("f", [], goto("a"))))
+    assert False
+except ValueError:
+    pass
+
+main = define(
+    "f",
+    ["xs", "target"],
+    mktuple(
+        # search with an early exit
+        block(
+            assign_star("found", None),
+            for_in("x", var("xs"), ite(cmp(var("x"), Compare.EQ, var("target")), block(assign("found", var("x")), break_()), None)),
+            var("found"),
+        ),
+        # `loop` returns the value of `break_`
+        block(
+            assign_star("i", 0),
+            loop(True, block(aug_assign("i", BinOp.ADD, 1), ite(cmp(var("i"), Compare.GE, var("target")), break_(var("i")), var("i")))),
+        ),
+        list_comp("x", var("xs"), block(assign_star("s", 0), for_in("y", var("xs"), block(ite(cmp(var("y"), Compare.EQ, var("x")), continue_(), None), aug_assign("s", BinOp.ADD, var("y")))), var("s"))),
+        block(assign_star("i", 0), loop(cmp(var("i"), Compare.LT, 3), block(aug_assign("i", BinOp.ADD, 1), continue_()))),
+    ),
+)
+f = eval(module_code(main), {})
+assert f([1, 2, 3], 2) == (2, 2, [5, 4, 3], None)
+assert f([1, 2, 3], 5) == (None, 5, [5, 4, 3], None)
+
+# hot loops are rotated or unrolled, with cold arms out of line
+counters = Counters()
+f = eval(module_code(main, counters=counters), {})
+for _ in range(100):
+    f([1, 2, 3], 2)
+f = eval(module_code(main, profile=Profile(counters.export(), hot_threshold=50)), {})
+assert f([1, 2, 3], 2) == (2, 2, [5, 4, 3], None)
+assert f(list(range(7)), 5) == (5, 5, [21 - i for i in range(7)], None)
+
+# hot bodies with labels are not unrolled, as labels are unique per function
+main = define(
+    "f",
+    ["xs"],
+    block(
+        assign_star("ys", call(var("list"))),
+        assign_star("x", 0),
+        assign_star("j", 0),
+        for_in(
+            "x",
+            var("xs"),
+            block(
+                assign("j", 0),
+                label("top"),
+                aug_assign("j", BinOp.ADD, 1),
+                ite(cmp(var("j"), Compare.LT, var("x")), goto("top"), None),
+                call_method(var("ys"), "append", var("j")),
+            ),
+        ),
+        var("ys"),
+    ),
+)
+counters = Counters()
+f = eval(module_code(block(main, var("f")), counters=counters), {})
+assert f([3, 1, 2] * 40) == [3, 1, 2] * 40
+f = eval(module_code(block(main, var("f")), profile=Profile(counters.export(), hot_threshold=50)), {})
+assert f([3, 1, 2]) == [3, 1, 2]
+# nor hot loops rotated, if their conditions have labels
+main = define(
+    "f",
+    ["n"],
+    block(
+        assign_star("i", 0),
+        loop(block(label("l"), cmp(var("i"), Compare.LT, var("n"))), aug_assign("i", BinOp.ADD, 1)),
+        var("i"),
+    ),
+)
+counters = Counters()
+f = eval(module_code(block(main, var("f")), counters=counters), {})
+assert f(100) == 100
+f = eval(module_code(block(main, var("f")), profile=Profile(counters.export(), hot_threshold=50)), {})
+assert f(3) == 3
+
+main = define(
+    "collect",
+    ["n"],
+    block(
+        assign_star("xs", call(var("list"))),
+        async_for_in("i", call(var("Ticks"), var("n")), block(ite(cmp(var("i"), Compare.EQ, 2), continue_(), None), ite(cmp(var("i"), Compare.EQ, 0), break_(), None), call_method(var("xs"), "append", var("i")))),
+        var("xs"),
+    ),
+    is_async=True,
+)
+scope = {"list": list, "Ticks": Ticks}
+exec(module_code(main), scope)
+event_loop = asyncio.new_event_loop()
+assert event_loop.run_until_complete(scope["collect"](5)) == [4, 3, 1]
+event_loop.close()
+
+for each in [break_(), define("f", [], break_()), for_in("x", var("xs"), break_(1)), for_in("x", var("xs"), call(var("f"), break_()))]:
+    try:
+        module_code(each)
+        assert False
+    except ValueError:
+        pass
+
+# lazy functions are lowered on first call, closures keep their cells
+main = block(
+    assign_star("k", 10),
+    define("add", ["x", "y"], binop(binop(var("x"), BinOp.ADD, var("y")), BinOp.ADD, var("k")), defaults=[1]),
+    define(
+        "counter",
+        ["a"],
+        block(
+            define("get", [], var("a")),
+            define("bump", [], aug_assign("a", BinOp.ADD, 1)),
+            mktuple(var("get"), var("bump")),
+        ),
+    ),
+    define("gen", ["n"], for_range("i", 0, var("n"), yield_(var("i")))),
+    define("twice", ["n"], binop(var("n"), BinOp.MULTIPLY, 2), is_async=True),
+)
+scope = {"Ticks": Ticks}
+exec(module_code(main, lazy=True), scope)
+add = scope["add"]
+stub = add.__code__
+# generators and coroutines are lowered eagerly, with their code flags
+assert inspect.isgeneratorfunction(scope["gen"]) and inspect.iscoroutinefunction(scope["twice"])
+assert add(1) == 12 and add.__code__ is not stub and add(1, 2) == 13
+get1, bump1 = scope["counter"](1)
+get2, bump2 = scope["counter"](5)
+bump1()
+bump1()
+bump2()
+assert (get1(), get2()) == (3, 6)
+assert get1.__code__ is get2.__code__ and bump1.__code__ is bump2.__code__
+get3, _ = scope["counter"](0)
+assert get3.__code__ is get1.__code__ and get3() == 0
+assert list(scope["gen"](3)) == [0, 1, 2]
+event_loop = asyncio.new_event_loop()
+assert event_loop.run_until_complete(scope["twice"](4)) == 8
+event_loop.close()
+
+# concurrent first calls lower the body once
+import threading
+
+main = define("total", ["n"], block(*[assign_star("x{}".format(i), binop(var("n"), BinOp.ADD, i)) for i in range(300)] + [binop(var("x299"), BinOp.ADD, var("x0"))]))
+for _ in range(5):
+    scope = {}
+    exec(module_code(main, lazy=True), scope)
+    barrier = threading.Barrier(8)
+    results, errors = [], []
+
+    def first_call():
+        barrier.wait()
+        try:
+            results.append(scope["total"](1))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=first_call) for _ in range(8)]
+    for each in threads:
+        each.start()
+    for each in threads:
+        each.join()
+    assert not errors and results == [301] * 8
+
+scope = {}
+event_loop = asyncio.new_event_loop()
+exec(event_loop.run_until_complete(module_code_async(main, lazy=True)), scope)
+event_loop.close()
+stub = scope["total"].__code__
+assert scope["total"](1) == 301 and scope["total"].__code__ is not stub
+
+# chains of pure bases are computed once per block, until written
+from py_sexpr.opt import cse
+
+
+class Env:
+    pass
+
+
+def env_x():
+    return get_attr(get_attr(var("ctx"), "env"), "x")
+
+
+main = define(
+    "f",
+    ["ctx", "flag"],
+    block(
+        ite(var("flag"), env_x(), None),
+        assign_star("a", binop(env_x(), BinOp.ADD, get_attr(get_attr(var("ctx"), "env"), "y"))),
+        assign_star("b", binop(env_x(), BinOp.MULTIPLY, get_item(get_attr(var("ctx"), "d"), "k"))),
+        set_attr(get_attr(var("ctx"), "env"), "x", 100),
+        mktuple(var("a"), var("b"), env_x(), env_x()),
+    ),
+)
+
+
+def load_attrs(sexpr):
+    f = eval(module_code(block(sexpr, var("f"))), {})
+    return f, sum(1 for each in dis.get_instructions(f) if each.opname == "LOAD_ATTR")
+
+
+def make_ctx():
+    ctx = Env()
+    ctx.env = Env()
+    ctx.env.x, ctx.env.y, ctx.d = 3, 4, {"k": 2}
+    return ctx
+
+
+f, n_plain = load_attrs(main)
+g, n_cse = load_attrs(cse(main, ["ctx"]))
+assert n_cse < n_plain
+assert f(make_ctx(), True) == g(make_ctx(), True) == (7, 6, 100, 100)
+assert g(make_ctx(), False) == (7, 6, 100, 100)
+assert cse(main, ["other"]) == main
+
+# a chain first used conditionally is not computed before the condition
+main = define("f", ["ctx"], block(ite(var("ctx"), env_x(), None), ite(var("ctx"), env_x(), None)))
+assert eval(module_code(block(cse(main, ["ctx"]), var("f"))), {})(None) is None
+
+# nested functions may write the bases when called
+main = define(
+    "f",
+    ["ctx"],
+    block(
+        define("reset", [], set_attr(get_attr(var("ctx"), "env"), "x", 0)),
+        assign_star("a", env_x()),
+        call(var("reset")),
+        mktuple(var("a"), env_x()),
+    ),
+)
+assert eval(module_code(block(cse(main, ["ctx"]), var("f"))), {})(make_ctx()) == (3, 0)
+
+# invariant subterms of loops are computed before them
+from py_sexpr.opt import licm, Purity
+
+main = define(
+    "f",
+    ["ctx", "n", "a", "b"],
+    block(
+        assign_star("s", 0),
+        assign_star("i", 0),
+        assign_star("j", 0),
+        for_range(
+            "i",
+            0,
+            var("n"),
+            for_range(
+                "j",
+                0,
+                var("n"),
+                aug_assign("s", BinOp.ADD, binop(binop(var("a"), BinOp.MULTIPLY, var("b")), BinOp.ADD, binop(get_attr(var("ctx"), "k"), BinOp.MULTIPLY, var("i")))),
+            ),
+        ),
+        var("s"),
+    ),
+)
+
+
+def loop_body_ops(sexpr):
+    f = eval(module_code(block(sexpr, var("f"))), {})
+    ins = list(dis.get_instructions(f))
+    start = min(i for i, each in enumerate(ins) if each.opname == "FOR_ITER")
+    return f, [each.opname for each in ins[start:]]
+
+
+class K:
+    k = 5
+
+
+f, plain_ops = loop_body_ops(main)
+g, licm_ops = loop_body_ops(licm(main, Purity(bases=["ctx"])))
+assert f(K, 30, 2, 3) == g(K, 30, 2, 3) == 70650
+assert "LOAD_ATTR" in plain_ops and "LOAD_ATTR" not in licm_ops
+assert licm_ops.count("BINARY_MULTIPLY") < plain_ops.count("BINARY_MULTIPLY")
+# attributes of other objects may change by calls in the loop
+assert "LOAD_ATTR" in loop_body_ops(licm(main))[1]
+_, ops = loop_body_ops(licm(main, Purity(bases=["ctx"], operators=False)))
+assert "LOAD_ATTR" not in ops and ops.count("BINARY_MULTIPLY") == plain_ops.count("BINARY_MULTIPLY")
+
+# variables written in the loop, or by calls, are not invariant
+main = block(
+    assign_star("xs", call(var("list"))),
+    assign_star("k", 1),
+    assign_star("i", 0),
+    loop(
+        cmp(var("i"), Compare.LT, binop(var("k"), BinOp.ADD, 3)),
+        block(
+            call_method(var("xs"), "append", binop(var("k"), BinOp.MULTIPLY, 10)),
+            aug_assign("i", BinOp.ADD, 1),
+            ite(cmp(var("i"), Compare.EQ, 2), assign("k", 2), None),
+        ),
+    ),
+    var("xs"),
+)
+assert licm(main) == main
+assert eval(module_code(licm(main))) == [10, 10, 20, 20, 20]
+main = define("f", ["n"], block(assign_star("i", 0), for_range("i", 0, var("n"), call(var("len"), var("xs")))))
+assert licm(main, Purity(functions=["len"])) != main
+assert licm(main) == main
+main = define("f", ["n"], block(assign_star("i", 0), for_range("i", 0, var("n"), call_method(var("xs"), "append", call(var("len"), var("xs"))))))
+assert licm(main, Purity(functions=["len"])) == main
+
+# the iterable of `for_in` runs before the hoisted terms
+main = define(
+    "f",
+    ["o", "mk"],
+    block(
+        assign_star("acc", call(var("list"))),
+        assign_star("x", None),
+        for_in("x", call(var("mk")), assign("acc", get_attr(var("o"), "y"))),
+        var("acc"),
+    ),
+)
+
+
+class O:
+    y = 1
+
+
+def mk():
+    O.y = 2
+    return [0]
+
+
+assert eval(module_code(block(main, var("f"))), {})(O, mk) == 2
+O.y = 1
+assert eval(module_code(block(licm(main, Purity(bases=["o"])), var("f"))), {})(O, mk) == 2
+
+# iterators may change globals in each iteration
+main = block(
+    assign_star("s", 0),
+    assign_star("x", None),
+    for_in("x", var("it"), assign("s", binop(var("s"), BinOp.ADD, binop(var("G"), BinOp.MULTIPLY, 1)))),
+    var("s"),
+)
+
+
+def gen(scope):
+    for i in range(3):
+        scope["G"] = i
+        yield i
+
+
+for each in (main, licm(main)):
+    scope = {"G": 100}
+    scope["it"] = gen(scope)
+    assert eval(module_code(each), scope) == 3
+
+# hoisted terms run even if the loop doesn't, hence those which may fail stay
+main = define("f", ["o", "xs"], block(assign_star("x", None), for_in("x", var("xs"), get_attr(var("o"), "missing"))))
+assert licm(main) == main
+assert eval(module_code(block(licm(main), var("f"))), {})(O, []) is None
+main = define(
+    "f",
+    ["a", "b", "n"],
+    block(
+        assign_star("s", 0),
+        assign_star("i", 0),
+        for_range("i", 0, var("n"), aug_assign("s", BinOp.ADD, binop(var("a"), BinOp.TRUE_DIVIDE, var("b")))),
+        var("s"),
+    ),
+)
+assert licm(main) == main
+assert eval(module_code(block(licm(main), var("f"))), {})(1, 0, 0) == 0
+assert eval(module_code(block(licm(main, Purity(failing_operators=True)), var("f"))), {})(1, 2, 4) == 2.0
+assert licm(main, Purity(failing_operators=True)) != main
+
+# elementwise loops over arrays run as NumPy expressions, falling back to the loops
+from py_sexpr.opt import vectorize
+
+
+def item(n):
+    return get_item(var(n), var("i"))
+
+
+main = define(
+    "f",
+    ["out", "a", "b", "k", "n"],
+    block(
+        assign_star("i", -1),
+        for_range(
+            "i",
+            0,
+            var("n"),
+            block(
+                set_item(var("out"), var("i"), binop(item("a"), BinOp.ADD, binop(item("b"), BinOp.MULTIPLY, var("k")))),
+                set_item(var("out"), var("i"), ite(cmp(item("out"), Compare.GT, 10), uop(UOp.NEGATIVE, item("out")), item("out"))),
+            ),
+        ),
+        var("i"),
+    ),
+)
+f = eval(module_code(block(main, var("f"))), {})
+g = eval(module_code(block(vectorize(main, min_size=1), var("f"))), {})
+out = [0] * 6
+assert g(out, [1, 2, 3, 4, 5, 6], [1] * 6, 4, 6) == 5 and out == [5, 6, 7, 8, 9, 10]
+assert g(out, [1, 2, 3, 4, 5, 7], [1] * 6, 4, 6) == 5 and out[-1] == -11
+assert g(out, [], [], 4, 0) == -1
+# not elementwise
+for each in [var("i"), get_item(var("a"), binop(var("i"), BinOp.ADD, 1)), call(var("g"), item("a"))]:
+    main = for_range("i", 0, 3, set_item(var("out"), var("i"), each))
+    assert vectorize(main) == main
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    for n in [8, 5, 0]:
+        out1, out2 = numpy.zeros(8), numpy.zeros(8)
+        assert f(out1, numpy.arange(8.0), numpy.ones(8), 3, n) == g(out2, numpy.arange(8.0), numpy.ones(8), 3, n)
+        assert out1.tolist() == out2.tolist()
+    # overlapping arrays and short arrays take the loop
+    a1, a2 = numpy.arange(9.0) ** 2, numpy.arange(9.0) ** 2
+    f(a1[1:], a1[:-1], numpy.ones(8), 1, 8)
+    g(a2[1:], a2[:-1], numpy.ones(8), 1, 8)
+    assert a1.tolist() == a2.tolist()
+    for each in (f, g):
+        try:
+            each(numpy.zeros(3), numpy.zeros(3), numpy.zeros(3), 1, 5)
+            assert False
+        except IndexError:
+            pass
+    # so do other variables not numbers
+    for each in (f, g):
+        try:
+            each(numpy.zeros(3), numpy.ones(3), numpy.ones(3), [10, 20, 30], 3)
+            assert False
+        except (TypeError, ValueError):
+            pass
+    out1, out2 = numpy.zeros(3), numpy.zeros(3)
+    assert f(out1, numpy.ones(3), numpy.ones(3), numpy.float32(2), 3) == g(out2, numpy.ones(3), numpy.ones(3), numpy.float32(2), 3)
+    assert out1.tolist() == out2.tolist()
+    # and arrays of objects, for which NumPy evaluates both clauses of `ite`
+    main = define(
+        "f",
+        ["out", "a", "b", "n"],
+        block(
+            assign_star("i", 0),
+            for_range(
+                "i",
+                0,
+                var("n"),
+                set_item(var("out"), var("i"), ite(cmp(item("b"), Compare.NE, 0), binop(item("a"), BinOp.FLOOR_DIVIDE, item("b")), 0)),
+            ),
+        ),
+    )
+    g = eval(module_code(block(vectorize(main, min_size=1), var("f"))), {})
+    out = numpy.zeros(3, dtype=object)
+    g(out, numpy.array([1, 2, 3], dtype=object), numpy.array([1, 0, 1], dtype=object), 3)
+    assert out.tolist() == [1, 0, 3]
+
+# stack depths of exception handlers
+from bytecode import Instr, Label
+from py_sexpr.stack_vm.blockaddr import check_stack_depth
+
+handler, end = Label(), Label()
+depths = check_stack_depth(
+    [
+        Instr("SETUP_FINALLY", handler),
+        Instr("LOAD_CONST", 1),
+        Instr("POP_TOP"),
+        Instr("POP_BLOCK"),
+        Instr("JUMP_FORWARD", end),
+        handler,
+        Instr("POP_TOP"),
+        Instr("POP_TOP"),
+        Instr("POP_TOP"),
+        Instr("POP_EXCEPT"),
+        end,
+    ]
+)
+assert depths == {handler: 6, end: 0}
@@ -19,7 +19,7 @@ setup(
     author="thautawarm",
     author_email="twshere@outlook.com",
     packages=find_packages(),
-    entry_points={"console_scripts": []},
+    entry_points={"console_scripts": ["pysexpr-compile=py_sexpr.importer:main"]},
     install_requires=["attrs", "bytecode>=0.10.0, <0.12.0"],
     platforms="any",
     classifiers=[